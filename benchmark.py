@@ -0,0 +1,467 @@
+"""Offline load benchmark for download-youtube.py
+
+Runs the service under uvicorn against a local fake media origin, so changes
+can be measured without touching YouTube:
+
+    python benchmark.py --jobs 200 --concurrency 20 --size-mb 4 --output run.json
+
+- A stub yt-dlp extractor claims https://bench.invalid/watch/<id> URLs and
+  returns formats served by the origin: a progressive MP4 and, with --dash
+  (needs ffmpeg), separate video-only / audio-only streams that get merged.
+- The origin (in this process) adds --origin-latency-ms before the first byte,
+  throttles each connection to --origin-rate-kbps and answers a --forbid-rate
+  fraction of media requests with 403.
+- Jobs go through POST /download (completion via a local webhook receiver)
+  and/or POST /download/async (completion via the SSE progress stream), then
+  the file is fetched from /files. --distinct below --jobs makes repeats hit
+  the download cache.
+
+The JSON report has jobs/s, end-to-end latency percentiles (submit -> file
+fully fetched), job latency (submit -> completion seen), /files throughput and
+the service's event-loop lag, measured by a probe task inside the server.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import random
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+from yt_dlp.extractor import _extractors_context, import_extractors
+from yt_dlp.extractor.common import InfoExtractor
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+STREAM_CHUNK_SIZE = 64 * 1024
+LAG_PROBE_INTERVAL = 0.05
+
+# --- Stub extractor -----------------------------------------------------------
+# Registered in the server process AND in its download pool processes: spawned
+# pool children re-import this file as __mp_main__, with BENCH_ORIGIN inherited.
+
+
+class BenchIE(InfoExtractor):
+    IE_NAME = 'bench'
+    _VALID_URL = r'https?://bench\.invalid/watch/(?P<id>[\w-]+)'
+
+    def _real_extract(self, url):
+        video_id = self._match_id(url)
+        time.sleep(float(os.environ.get('BENCH_EXTRACT_SECONDS', '0')))
+        origin = os.environ['BENCH_ORIGIN']
+        sizes = json.loads(os.environ['BENCH_SIZES'])
+        expire = int(time.time()) + 6 * 3600  # Like googlevideo URLs, so the info cache keeps it
+
+        def media(name, ext):
+            return f"{origin}/media/{video_id}/{name}.{ext}?expire={expire}"
+
+        formats = [{
+            'format_id': '18', 'url': media('progressive', 'mp4'), 'ext': 'mp4', 'width': 640, 'height': 360,
+            'vcodec': 'avc1.42001E', 'acodec': 'mp4a.40.2', 'fps': 30, 'filesize': sizes['progressive'],
+        }]
+        if 'video' in sizes:
+            formats += [{
+                'format_id': '137', 'url': media('video', 'mp4'), 'ext': 'mp4', 'width': 1920, 'height': 1080,
+                'vcodec': 'avc1.640028', 'acodec': 'none', 'fps': 30, 'filesize': sizes['video'],
+            }, {
+                'format_id': '140', 'url': media('audio', 'm4a'), 'ext': 'm4a', 'vcodec': 'none',
+                'acodec': 'mp4a.40.2', 'abr': 128, 'filesize': sizes['audio'],
+            }]
+        return {'id': video_id, 'title': f'Bench {video_id}', 'formats': formats}
+
+
+def _register_stub_extractor():
+    import_extractors()
+    # First in the table, so URL -> extractor resolution finds it before Generic
+    _extractors_context.value = {'BenchIE': BenchIE, **_extractors_context.value}
+
+
+if os.environ.get('BENCH_ORIGIN'):
+    _register_stub_extractor()
+
+# --- Server process -------------------------------------------------------------
+
+
+def serve(port: int):
+    """`python benchmark.py serve`: the service plus an event-loop lag probe"""
+    import uvicorn
+
+    sys.path.insert(0, REPO_DIR)
+    service = importlib.import_module('download-youtube')
+    lag_samples = []
+
+    async def probe_loop_lag():
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(LAG_PROBE_INTERVAL)
+            lag_samples.append(time.monotonic() - started - LAG_PROBE_INTERVAL)
+
+    @service.app.on_event("startup")
+    async def _start_lag_probe():
+        asyncio.create_task(probe_loop_lag())
+
+    async def loop_lag(reset: bool = False):
+        samples = list(lag_samples)
+        if reset:
+            lag_samples.clear()
+        return {"samples": samples}
+
+    service.app.add_api_route('/bench/loop-lag', loop_lag, methods=['GET'])
+    uvicorn.run(service.app, host='127.0.0.1', port=port, log_level='warning')
+
+# --- Fake origin ----------------------------------------------------------------
+
+
+class Origin:
+    """Threaded HTTP server for media files, plus the webhook receiver"""
+
+    def __init__(self, files: dict, latency: float, rate: float, forbid_rate: float, on_webhook):
+        self.files = files  # name -> bytes
+        self.latency = latency
+        self.rate = rate  # bytes/s per connection, 0 = unthrottled
+        self.forbid_rate = forbid_rate
+        self.on_webhook = on_webhook
+        self.stats = {"requests": 0, "bytes": 0, "forbidden": 0}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name='bench-origin', daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+
+    def _count(self, **amounts):
+        with self._lock:
+            for key, amount in amounts.items():
+                self.stats[key] += amount
+
+    def _handler(self):
+        origin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                self.send_response(204)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                origin.on_webhook(json.loads(body))
+
+            def do_HEAD(self):
+                self._serve(head=True)
+
+            def do_GET(self):
+                self._serve()
+
+            def _serve(self, head=False):
+                match = re.match(r'/media/[\w-]+/(\w+)\.\w+', self.path)
+                data = origin.files.get(match.group(1)) if match else None
+                if data is None:
+                    self.send_error(404)
+                    return
+                origin._count(requests=1)
+                if origin.latency:
+                    time.sleep(origin.latency)
+                if random.random() < origin.forbid_rate:
+                    origin._count(forbidden=1)
+                    self.send_response(403)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                start, end = 0, len(data) - 1
+                ranged = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+                if ranged:
+                    start = int(ranged.group(1))
+                    end = min(int(ranged.group(2)), end) if ranged.group(2) else end
+                    self.send_response(206)
+                    self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Length', str(end - start + 1))
+                self.send_header('Content-Type', 'video/mp4')
+                self.send_header('Accept-Ranges', 'bytes')
+                self.end_headers()
+                if head:
+                    return
+                try:
+                    for offset in range(start, end + 1, STREAM_CHUNK_SIZE):
+                        chunk = data[offset:min(offset + STREAM_CHUNK_SIZE, end + 1)]
+                        self.wfile.write(chunk)
+                        origin._count(bytes=len(chunk))
+                        if origin.rate:
+                            time.sleep(len(chunk) / origin.rate)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+        return Handler
+
+
+def _synthetic_dash(workdir: str, seconds: float) -> dict:
+    """Real (mergeable) video-only and audio-only MP4s, generated with ffmpeg"""
+    outputs = {'video': os.path.join(workdir, 'video.mp4'), 'audio': os.path.join(workdir, 'audio.m4a')}
+    common = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y']
+    subprocess.run(common + ['-f', 'lavfi', '-i', f'testsrc=size=1920x1080:rate=30:duration={seconds}',
+                             '-c:v', 'mpeg4', '-q:v', '5', '-an', outputs['video']], check=True)
+    subprocess.run(common + ['-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+                             '-c:a', 'aac', '-b:a', '128k', '-vn', outputs['audio']], check=True)
+    files = {}
+    for name, path in outputs.items():
+        with open(path, 'rb') as f:
+            files[name] = f.read()
+    return files
+
+# --- Load generator -------------------------------------------------------------
+
+
+def _percentiles(values: list) -> dict:
+    if not values:
+        return {"p50": None, "p99": None, "max": None}
+    ordered = sorted(values)
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+    return {"p50": round(rank(0.50), 4), "p99": round(rank(0.99), 4), "max": round(ordered[-1], 4)}
+
+
+class Bench:
+    def __init__(self, args, base_url: str, origin: Origin):
+        self.args = args
+        self.base_url = base_url
+        self.origin = origin
+        self.loop = asyncio.get_event_loop()
+        self.webhooks = {}  # job_id -> future resolved by the webhook receiver
+        headers = {}
+        if os.getenv('DOWNLOAD_AUTH_TOKEN'):
+            headers['X-Download-Auth'] = os.environ['DOWNLOAD_AUTH_TOKEN']
+        self.client = httpx.AsyncClient(base_url=base_url, headers=headers, timeout=args.job_timeout,
+                                        limits=httpx.Limits(max_connections=args.concurrency * 2))
+
+    def _webhook_future(self, job_id: str) -> asyncio.Future:
+        return self.webhooks.setdefault(job_id, self.loop.create_future())
+
+    def webhook_received(self, payload: dict):
+        """Called on an origin thread"""
+        def resolve():
+            future = self._webhook_future(payload.get("job_id"))
+            if not future.done():
+                future.set_result(payload)
+        self.loop.call_soon_threadsafe(resolve)
+
+    async def _via_webhook(self, url: str) -> dict:
+        response = await self.client.post('/download', json={
+            "url": url, "resolution": self.args.resolution, "webhook_url": f"{self.origin.url}/webhook"})
+        response.raise_for_status()
+        job_id = response.json()["job_id"]
+        payload = await self._webhook_future(job_id)
+        self.webhooks.pop(job_id, None)
+        if payload["status"] != "completed":
+            raise RuntimeError(payload.get("error") or payload["status"])
+        return payload
+
+    async def _via_sse(self, url: str) -> dict:
+        response = await self.client.post('/download/async', json={"url": url, "resolution": self.args.resolution})
+        response.raise_for_status()
+        job_id = response.json()["job_id"]
+        async with self.client.stream('GET', f'/jobs/{job_id}/progress') as stream:
+            async for line in stream.aiter_lines():
+                if not line.startswith('data:'):
+                    continue
+                event = json.loads(line[5:])
+                if event.get("status") == "completed":
+                    return event["result"]
+                if event.get("error") or event.get("status") in ("failed", "cancelled"):
+                    raise RuntimeError(event.get("error") or event["status"])
+        raise RuntimeError("Progress stream ended before the job finished")
+
+    async def run_job(self, index: int) -> dict:
+        mode = self.args.modes[index % len(self.args.modes)]
+        url = f"https://bench.invalid/watch/v{index % self.args.distinct}-{self.args.run_id}"
+        record = {"mode": mode, "ok": False}
+        started = time.monotonic()
+        try:
+            result = await (self._via_webhook(url) if mode == 'webhook' else self._via_sse(url))
+            record["job_seconds"] = time.monotonic() - started
+            fetched = 0
+            async with self.client.stream('GET', result["download_url"]) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_raw():
+                    fetched += len(chunk)
+            record.update(ok=True, bytes=fetched, seconds=time.monotonic() - started)
+        except Exception as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+        return record
+
+    async def loop_lag(self, reset: bool = False) -> list:
+        response = await self.client.get('/bench/loop-lag', params={"reset": reset})
+        return response.json()["samples"]
+
+    async def run(self) -> dict:
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def limited(index):
+            async with semaphore:
+                return await self.run_job(index)
+
+        await self.loop_lag(reset=True)
+        origin_before = dict(self.origin.stats)
+        started = time.monotonic()
+        records = await asyncio.gather(*(limited(i) for i in range(self.args.jobs)))
+        wall = time.monotonic() - started
+        lag = await self.loop_lag(reset=True)
+        await self.client.aclose()
+
+        report = {"wall_seconds": round(wall, 3), **self._summarize(records, wall)}
+        report["by_mode"] = {mode: self._summarize([r for r in records if r["mode"] == mode], wall)
+                             for mode in self.args.modes}
+        report["event_loop_lag_ms"] = {k: v and round(v * 1000, 2) for k, v in _percentiles(lag).items()}
+        report["origin"] = {key: self.origin.stats[key] - origin_before[key] for key in origin_before}
+        errors = [r["error"] for r in records if not r["ok"]]
+        report["errors"] = sorted(set(errors))[:20]
+        return report
+
+    @staticmethod
+    def _summarize(records: list, wall: float) -> dict:
+        ok = [r for r in records if r["ok"]]
+        fetched = sum(r["bytes"] for r in ok)
+        return {
+            "jobs": len(records),
+            "completed": len(ok),
+            "failed": len(records) - len(ok),
+            "jobs_per_second": round(len(ok) / wall, 3) if wall else None,
+            "latency_seconds": _percentiles([r["seconds"] for r in ok]),
+            "job_latency_seconds": _percentiles([r["job_seconds"] for r in ok]),
+            "bytes_per_second": round(fetched / wall) if wall else None,
+        }
+
+# --- Orchestration --------------------------------------------------------------
+
+
+def _start_server(workdir: str, env: dict, startup_timeout: float) -> tuple:
+    import socket
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    log = open(os.path.join(workdir, 'server.log'), 'w')
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'serve', '--port', str(port)],
+                               cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with {process.returncode}; see {log.name}")
+        try:
+            if httpx.get(f"{base_url}/health", timeout=1).status_code == 200:
+                return process, base_url, log
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"Server didn't come up in {startup_timeout}s; see {log.name}")
+
+
+def _stop_server(process: subprocess.Popen):
+    process.send_signal(signal.SIGTERM)  # Graceful: the service stops its download pool
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def run_benchmark(args) -> dict:
+    if args.dash and shutil.which('ffmpeg') is None:
+        raise SystemExit("--dash needs ffmpeg (to generate the streams and for the service to merge them)")
+    workdir = tempfile.mkdtemp(prefix='ytdl-bench-')
+    files = {'progressive': os.urandom(int(args.size_mb * 1024 * 1024))}
+    if args.dash:
+        files.update(_synthetic_dash(workdir, args.dash_seconds))
+
+    bench = None
+    origin = Origin(files, args.origin_latency_ms / 1000, args.origin_rate_kbps * 1024 / 8, args.forbid_rate,
+                    on_webhook=lambda payload: bench and bench.webhook_received(payload))
+    origin.start()
+    env = dict(os.environ, BENCH_ORIGIN=origin.url, BENCH_EXTRACT_SECONDS=str(args.extract_ms / 1000),
+               BENCH_SIZES=json.dumps({name: len(data) for name, data in files.items()}))
+    process, base_url, log = _start_server(workdir, env, args.startup_timeout)
+    try:
+        async def main():
+            nonlocal bench
+            bench = Bench(args, base_url, origin)
+            return await bench.run()
+        report = asyncio.run(main())
+    finally:
+        _stop_server(process)
+        log.close()
+        origin.stop()
+        if args.keep:
+            print(f"[Bench] Work directory kept: {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    config = {key: value for key, value in vars(args).items() if key not in ('command', 'output', 'keep')}
+    return {"config": config, "sizes": {name: len(data) for name, data in files.items()}, **report}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('command', nargs='?', default='run', choices=['run', 'serve'])
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)  # serve
+    parser.add_argument('--jobs', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--modes', default='webhook,sse',
+                        help="comma-separated, assigned round-robin: webhook (POST /download) and/or "
+                             "sse (POST /download/async + progress stream)")
+    parser.add_argument('--distinct', type=int, help="distinct videos (default: one per job, so no cache hits)")
+    parser.add_argument('--resolution', default='1080p')
+    parser.add_argument('--size-mb', type=float, default=2.0, help="progressive file size")
+    parser.add_argument('--dash', action='store_true', help="also offer separate video/audio streams (ffmpeg)")
+    parser.add_argument('--dash-seconds', type=float, default=10.0, help="length of the synthetic DASH streams")
+    parser.add_argument('--origin-latency-ms', type=float, default=0.0, help="delay before each response")
+    parser.add_argument('--origin-rate-kbps', type=float, default=0.0, help="per-connection throttle (0 = none)")
+    parser.add_argument('--forbid-rate', type=float, default=0.0, help="fraction of media requests answered 403")
+    parser.add_argument('--extract-ms', type=float, default=0.0, help="simulated metadata extraction time")
+    parser.add_argument('--job-timeout', type=float, default=300.0)
+    parser.add_argument('--startup-timeout', type=float, default=60.0)
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    parser.add_argument('--keep', action='store_true', help="keep the work directory (downloads, server.log)")
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.port)
+        return
+    args.modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+    if not args.modes or set(args.modes) - {'webhook', 'sse'}:
+        parser.error("--modes takes webhook and/or sse")
+    args.distinct = args.distinct or args.jobs
+    args.run_id = uuid.uuid4().hex[:8]  # Fresh video ids per run: a kept cache doesn't skew results
+
+    report = run_benchmark(args)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,45 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
-from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, Request, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.datastructures import Headers
 from pydantic import BaseModel, HttpUrl
 from typing import Optional
 import yt_dlp
+from yt_dlp.extractor import gen_extractor_classes
+from yt_dlp.extractor.youtube import YoutubeIE
+from yt_dlp.utils import prepend_extension
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, \
+    generate_latest, multiprocess
 import os
 import uuid
 import asyncio
 import httpx
 import json
 import hmac
-from datetime import datetime
+import functools
+import threading
+import socket
+import sqlite3
+import contextlib
+import fcntl
+import random
+import heapq
+import importlib.util
+import multiprocessing
+import signal
+import re
+import copy
+from collections import OrderedDict, deque
+import mimetypes
+import shutil
+from urllib.parse import quote, urlsplit
+from stat import S_ISREG
+from email.utils import formatdate, parsedate_to_datetime
+from datetime import datetime, timedelta
 from enum import Enum
 import time
+import pool_child
 
 app = FastAPI()
 
@@ -43,34 +70,42 @@ print(f"[Startup] DOWNLOAD_AUTH_TOKEN configured: {bool(DOWNLOAD_AUTH_TOKEN)}"
       + ("" if DOWNLOAD_AUTH_TOKEN else "  (AUTH DISABLED — do NOT expose publicly without a token)"))
 
 
-@app.middleware("http")
-async def require_shared_secret(request: Request, call_next):
-    # CORS preflight must pass through untouched.
-    if request.method == "OPTIONS":
-        return await call_next(request)
-    if DOWNLOAD_AUTH_TOKEN and request.url.path not in AUTH_EXEMPT_PATHS:
-        provided = request.headers.get('x-download-auth', '')
-        # Constant-time compare to avoid timing leaks.
-        if not hmac.compare_digest(provided, DOWNLOAD_AUTH_TOKEN):
-            return JSONResponse(status_code=401, content={"error": "unauthorized"})
-    return await call_next(request)
+class RequireSharedSecret:
+    """Plain ASGI middleware: responses (file bodies, SSE, zero-copy sends) pass through untouched"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        # CORS preflight must pass through untouched.
+        if scope["type"] == "http" and scope["method"] != "OPTIONS" and DOWNLOAD_AUTH_TOKEN:
+            request = Request(scope)
+            if request.url.path not in AUTH_EXEMPT_PATHS:
+                provided = request.headers.get('x-download-auth', '')
+                # Constant-time compare to avoid timing leaks.
+                if not hmac.compare_digest(provided, DOWNLOAD_AUTH_TOKEN):
+                    response = JSONResponse(status_code=401, content={"error": "unauthorized"})
+                    await response(scope, receive, send)
+                    return
+        await self.app(scope, receive, send)
+
+
+app.add_middleware(RequireSharedSecret)
 
 
 @app.get("/health")
 async def health():
-    return {"status": "ok"}
+    disk = await asyncio.get_event_loop().run_in_executor(None, disk_budget.usage)
+    return {"status": "ok", "disk": disk}
 
 
 # Get proxy URL from environment variable if set
 PROXY_URL = os.getenv('PROXY_URL')
 print(f"[Startup] PROXY_URL configured: {bool(PROXY_URL)}")
 
-# Concurrency control
-MAX_CONCURRENT_DOWNLOADS = 5
-download_semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+# Concurrency control: see AdmissionScheduler / admission below.
 
-# Job storage (in-memory - consider Redis for production)
-jobs = {}
+# Job storage: see JobStore / job_store below.
 
 # How long to retain a job record (and its downloaded file) after the job
 # reaches a terminal state. Long enough for the client to download the file
@@ -82,9 +117,844 @@ JOB_RETENTION_SECONDS = 1800  # 30 minutes
 # client stops polling. Generous enough for large 1080p videos on a slow link.
 JOB_MAX_SECONDS = 900  # 15 minutes
 
+DOWNLOADS_DIR = os.path.join(os.getcwd(), 'downloads')
+
+# --- Metrics ------------------------------------------------------------------
+# Prometheus metrics at GET /metrics (behind the shared secret like every other
+# endpoint). Recording one is an in-memory increment, cheap enough for
+# progress_hook.
+#
+# With several processes on a host (uvicorn --workers N, standalone workers),
+# set PROMETHEUS_MULTIPROC_DIR to an empty directory that is wiped before the
+# server starts. Every process then writes its samples there, and /metrics -
+# whichever process answers - reports them all combined.
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+_SECONDS_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 900)
+
+
+class Metrics:
+    def __init__(self):
+        self.queue_depth = Gauge('ytdl_queue_depth', 'Jobs waiting in the shared queue',
+                                 multiprocess_mode='mostrecent')
+        self.slots = Gauge('ytdl_download_slots', 'Adaptive download concurrency limit',
+                           multiprocess_mode='livesum')
+        self.slots_busy = Gauge('ytdl_download_slots_busy', 'Download slots in use',
+                                multiprocess_mode='livesum')
+        self.slot_waiters = Gauge('ytdl_download_slot_waiters', 'Jobs waiting for a download slot',
+                                  multiprocess_mode='livesum')
+        self.slot_wait_seconds = Histogram('ytdl_download_slot_wait_seconds', 'Time spent waiting for a download slot',
+                                           ['priority'], buckets=_SECONDS_BUCKETS + (1800, 3600))
+        self.extract_seconds = Histogram('ytdl_extract_seconds', 'Metadata extraction time (cache misses)',
+                                         buckets=_SECONDS_BUCKETS)
+        self.transfer_seconds = Histogram('ytdl_transfer_seconds', 'Media transfer time of a successful attempt',
+                                          buckets=_SECONDS_BUCKETS)
+        self.merge_seconds = Histogram('ytdl_merge_seconds', 'ffmpeg video+audio merge time',
+                                       buckets=_SECONDS_BUCKETS)
+        self.webhook_seconds = Histogram('ytdl_webhook_delivery_seconds', 'Webhook delivery attempt time',
+                                         buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+        self.downloaded_bytes = Counter('ytdl_downloaded_bytes', 'Media bytes downloaded')
+        self.forbidden = Counter('ytdl_forbidden_attempts', 'Download attempts answered with 403, by attempt number',
+                                 ['attempt'])
+        self.jobs = Counter('ytdl_jobs_finished', 'Finished jobs by outcome and error class',
+                            ['outcome', 'error_class'])
+        self.sse_connections = Gauge('ytdl_sse_connections', 'Open progress (SSE) connections',
+                                     multiprocess_mode='livesum')
+
+
+metrics = Metrics()
+
+
+def _mark_metrics_process_dead():
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics, combined over all processes in multiprocess mode"""
+    loop = asyncio.get_event_loop()
+    metrics.queue_depth.set(await loop.run_in_executor(None, job_queue.depth))
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    data = await loop.run_in_executor(None, generate_latest, registry)
+    return Response(data, media_type=CONTENT_TYPE_LATEST)
+
+# --- Proxy pool ---------------------------------------------------------------
+# Downloads used to go through the single PROXY_URL and answer a 403 by sleeping
+# 2**attempt seconds and reconnecting, hoping for a new exit IP. Now any number
+# of endpoints can be configured (PROXY_URLS, comma-separated; PROXY_URL still
+# works as a single one). A URL containing `{session}` is a session-sticky
+# template: it becomes PROXY_SESSIONS endpoints, each with its own random
+# session id and therefore its own exit IP.
+#
+# Every endpoint tracks its success rate and throughput (moving averages) and
+# its recent 403s. Each attempt goes straight to the best healthy endpoint not
+# yet tried for that download - success rate x throughput, shared by the
+# attempts already running through it - with no sleep in between. An endpoint
+# with PROXY_403_LIMIT 403s (or proxy errors) within PROXY_403_WINDOW_SECONDS is
+# quarantined for PROXY_QUARANTINE_SECONDS, doubling each time it happens again
+# up to PROXY_QUARANTINE_MAX_SECONDS. A sticky session is instead swapped for a
+# fresh session id (a new IP) on its first 403. If every endpoint is in
+# quarantine the one released soonest is used anyway, rather than waiting.
+PROXY_URLS = [u.strip() for u in os.getenv('PROXY_URLS', '').split(',') if u.strip()] or (
+    [PROXY_URL] if PROXY_URL else [])
+PROXY_SESSIONS = int(os.getenv('PROXY_SESSIONS', '4'))
+PROXY_403_LIMIT = 2
+PROXY_403_WINDOW_SECONDS = 300.0
+PROXY_QUARANTINE_SECONDS = 60.0
+PROXY_QUARANTINE_MAX_SECONDS = 900.0
+PROXY_EWMA_ALPHA = 0.3
+
+
+class ProxyEndpoint:
+    def __init__(self, template: str, name: str):
+        self.template = template
+        self.name = name  # For logs: proxy URLs carry credentials
+        self.sticky = '{session}' in template
+        self.in_flight = 0
+        self.quarantined_until = 0.0
+        self.quarantines = 0  # Consecutive, for the doubling
+        self._new_session()
+
+    def _new_session(self):
+        """Reset the stats; for a sticky template also pick a new session id (exit IP)"""
+        self.url = self.template.replace('{session}', uuid.uuid4().hex[:12]) if self.sticky else self.template
+        self.success_rate = 1.0
+        self.throughput = 0.0  # Bytes/s, 0 until measured
+        self.failures = deque()  # Monotonic times of recent 403s / proxy errors
+
+
+class ProxyPool:
+    """Proxy endpoints with health scoring and quarantine; thread-safe"""
+
+    def __init__(self, templates: list, sessions: int):
+        self._lock = threading.Lock()
+        self._endpoints = []
+        for template in templates:
+            host = urlsplit(template).hostname or 'proxy'
+            for _ in range(max(1, sessions) if '{session}' in template else 1):
+                self._endpoints.append(ProxyEndpoint(template, f"{host}#{len(self._endpoints) + 1}"))
+
+    def __len__(self) -> int:
+        return len(self._endpoints)
+
+    def acquire(self, exclude=(), http_only: bool = False) -> Optional[ProxyEndpoint]:
+        """Best endpoint for the next attempt, or None to connect directly"""
+        with self._lock:
+            candidates = [e for e in self._endpoints
+                          if not http_only or e.url.startswith(('http://', 'https://'))]
+            if not candidates:
+                return None
+            untried = [e for e in candidates if e not in exclude] or candidates
+            now = time.monotonic()
+            healthy = [e for e in untried if e.quarantined_until <= now]
+            if healthy:
+                # Unmeasured endpoints count as fast as the fastest one, so they get tried
+                fastest = max(e.throughput for e in candidates) or 1.0
+                best = max(healthy, key=lambda e: e.success_rate * (e.throughput or fastest) / (1 + e.in_flight))
+            else:
+                best = min(untried, key=lambda e: e.quarantined_until)
+            best.in_flight += 1
+            return best
+
+    def release(self, endpoint: Optional[ProxyEndpoint], success: Optional[bool],
+                transferred: int = 0, seconds: float = 0.0):
+        """Record an attempt's outcome; success=None when it says nothing about the proxy"""
+        if endpoint is None:
+            return
+        with self._lock:
+            endpoint.in_flight -= 1
+            if success is None:
+                return
+            endpoint.success_rate += PROXY_EWMA_ALPHA * (success - endpoint.success_rate)
+            if success:
+                endpoint.quarantines = 0
+                if transferred and seconds > 0:
+                    rate = transferred / seconds
+                    endpoint.throughput = (rate if not endpoint.throughput
+                                           else endpoint.throughput + PROXY_EWMA_ALPHA * (rate - endpoint.throughput))
+                return
+            now = time.monotonic()
+            endpoint.failures.append(now)
+            while endpoint.failures[0] < now - PROXY_403_WINDOW_SECONDS:
+                endpoint.failures.popleft()
+            if endpoint.sticky:
+                endpoint._new_session()
+                print(f"[Proxy] {endpoint.name} blocked: switched to a new session")
+            elif len(endpoint.failures) >= PROXY_403_LIMIT:
+                quarantine = min(PROXY_QUARANTINE_SECONDS * 2 ** endpoint.quarantines, PROXY_QUARANTINE_MAX_SECONDS)
+                endpoint.quarantines += 1
+                endpoint.quarantined_until = now + quarantine
+                endpoint.failures.clear()
+                endpoint.success_rate = 0.5  # Back on probation afterwards
+                print(f"[Proxy] {endpoint.name} quarantined for {quarantine:.0f}s")
+
+    @contextlib.contextmanager
+    def using(self, http_only: bool = False):
+        """An endpoint for a one-off lookup, whose outcome counts toward its health"""
+        endpoint = self.acquire(http_only=http_only)
+        success = None
+        try:
+            yield endpoint
+            success = True
+        except (yt_dlp.utils.DownloadError, DownloadProcessTimeout) as e:
+            if _proxy_fault(e):
+                success = False
+            raise
+        finally:
+            self.release(endpoint, success)
+
+
+def _proxy_fault(error: Exception) -> bool:
+    """True if a yt-dlp error points at the proxy / exit IP rather than the video"""
+    if isinstance(error, DownloadProcessTimeout):
+        return True  # A stalled extraction: most likely a throttled or dead exit IP
+    message = str(error).lower()
+    return any(marker in message for marker in ('403', 'forbidden', 'proxy', 'tunnel connection failed'))
+
+
+proxy_pool = ProxyPool(PROXY_URLS, PROXY_SESSIONS)
+print(f"[Startup] Proxy pool: {len(proxy_pool)} endpoint(s)")
+
+# --- Download cache -----------------------------------------------------------
+# Finished downloads stay in downloads/ and are indexed by (extractor video id,
+# format selector). A repeat request for the same video at the same resolution
+# completes immediately with the existing file instead of going back to YouTube
+# through the proxy — trending videos get requested over and over.
+#
+# Files are evicted least-recently-SERVED first (a cache hit or a /files fetch
+# both count as "served") once the total size exceeds CACHE_MAX_BYTES, rather
+# than on a fixed timer. The index is a small JSON file next to the downloads so
+# the cache survives restarts. CACHE_MAX_BYTES=0 disables caching entirely and
+# falls back to deleting every file JOB_RETENTION_SECONDS after it was produced.
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', str(20 * 1024 ** 3)))  # 20 GiB
+CACHE_INDEX_PATH = os.path.join(DOWNLOADS_DIR, '.cache-index.json')
+CACHE_TOUCH_SECONDS = 60  # /files refreshes a file's last_served at most this often
+print(f"[Startup] Download cache budget: {CACHE_MAX_BYTES / 1024 ** 3:.1f} GiB")
+
+
+@functools.lru_cache(maxsize=4096)
+def _video_identity(url: str) -> Optional[str]:
+    """Resolve a URL to 'Extractor:video_id' without touching the network"""
+    # Try the YouTube video extractor first: a watch URL that also carries
+    # &list=... would otherwise be claimed by the playlist (tab) extractor,
+    # while we always download just the single video (noplaylist).
+    video_id = YoutubeIE.get_temp_id(url)
+    if video_id:
+        return f"{YoutubeIE.ie_key()}:{video_id}"
+    for ie in gen_extractor_classes():
+        if ie.suitable(url):
+            video_id = ie.get_temp_id(url)
+            return f"{ie.ie_key()}:{video_id}" if video_id else None
+    return None
+
+
+def _cache_key(url: str, format_selector: str, limits: Optional[dict] = None) -> Optional[str]:
+    identity = _video_identity(url)
+    if identity is None:
+        return None  # No stable id (e.g. generic URL) - never cache
+    key = f"{identity}|{format_selector}"
+    if limits:
+        key += "|" + ",".join(f"{name}<={value}" for name, value in limits.items() if value)
+    return key
+
+
+class DownloadCache:
+    """Persistent index of finished downloads with least-recently-served eviction
+
+    Several processes (uvicorn workers, standalone queue workers) may share
+    downloads/, so every operation takes an flock on the index and re-reads it
+    if another process changed it since we last looked.
+    """
+
+    def __init__(self, index_path: str, max_bytes: int):
+        self.index_path = index_path
+        self.max_bytes = max_bytes
+        self._entries: dict = {}  # cache key -> entry dict
+        self._lock = threading.Lock()
+        self._index_stamp = None  # (mtime_ns, size) of the index we last read
+        self._touched: dict = {}  # filename -> monotonic time this process last touched it
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @contextlib.contextmanager
+    def _locked(self):
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        with self._lock, open(self.index_path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._refresh_locked()
+            yield
+
+    def _refresh_locked(self):
+        try:
+            st = os.stat(self.index_path)
+        except FileNotFoundError:
+            self._entries, self._index_stamp = {}, None
+            return
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp == self._index_stamp:
+            return
+        try:
+            with open(self.index_path) as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"[Cache] Ignoring unreadable index {self.index_path}: {e}")
+            self._entries = {}
+        self._index_stamp = stamp
+
+    def load(self):
+        """Read the index from disk, dropping entries whose file has vanished"""
+        with self._locked():
+            self._entries = {
+                key: entry for key, entry in self._entries.items()
+                if os.path.isfile(os.path.join(DOWNLOADS_DIR, entry["filename"]))
+            }
+            self._evict_locked()
+            self._save_locked()
+            count, total = len(self._entries), self._total_bytes_locked()
+        print(f"[Cache] Loaded {count} cached file(s), {total / 1024 ** 2:.0f} MB")
+
+    def _save_locked(self):
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self._entries, f)
+        os.replace(tmp_path, self.index_path)
+        st = os.stat(self.index_path)
+        self._index_stamp = (st.st_mtime_ns, st.st_size)
+
+    def _total_bytes_locked(self) -> int:
+        return sum(entry["size"] for entry in self._entries.values())
+
+    def total_bytes(self) -> int:
+        with self._locked():
+            return self._total_bytes_locked()
+
+    def filenames(self) -> set:
+        with self._locked():
+            return {entry["filename"] for entry in self._entries.values()}
+
+    def contains_file(self, filename: str) -> bool:
+        return filename in self.filenames()
+
+    def lookup(self, key: Optional[str]) -> Optional[dict]:
+        """Return the cached result for key (and mark it served), or None"""
+        if key is None or not self.enabled:
+            return None
+        with self._locked():
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if not os.path.isfile(os.path.join(DOWNLOADS_DIR, entry["filename"])):
+                del self._entries[key]
+                self._save_locked()
+                return None
+            entry["last_served"] = time.time()
+            self._save_locked()
+            return dict(entry["result"])
+
+    def store(self, key: Optional[str], result: dict) -> bool:
+        """Index a finished download. Returns False if it was not cached."""
+        if key is None or not self.enabled:
+            return False
+        filename = result["filename"]
+        try:
+            size = os.path.getsize(os.path.join(DOWNLOADS_DIR, filename))
+        except OSError:
+            return False
+        now = time.time()
+        with self._locked():
+            self._entries[key] = {
+                "filename": filename,
+                "size": size,
+                "result": result,
+                "created": now,
+                "last_served": now,
+            }
+            self._evict_locked(keep=key)
+            self._save_locked()
+            return key in self._entries
+
+    def touch(self, filename: str):
+        """Record that a cached file was served via /files (at most every CACHE_TOUCH_SECONDS)"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._touched.get(filename, -CACHE_TOUCH_SECONDS) < CACHE_TOUCH_SECONDS:
+                return  # Range requests of one player or resume: LRU order doesn't need each one
+            self._touched[filename] = now
+            if len(self._touched) > 4096:
+                self._touched = {name: at for name, at in self._touched.items() if now - at < CACHE_TOUCH_SECONDS}
+        with self._locked():
+            for entry in self._entries.values():
+                if entry["filename"] == filename:
+                    entry["last_served"] = time.time()
+                    self._save_locked()
+                    return
+
+    def make_room(self, nbytes: int) -> int:
+        """Evict least-recently-served files to free nbytes for a download.
+
+        Evicts nothing (and returns 0) unless the cache holds enough to cover
+        it all; otherwise returns the bytes freed.
+        """
+        with self._locked():
+            if self._total_bytes_locked() < nbytes:
+                return 0
+            freed = 0
+            by_age = sorted(self._entries.items(), key=lambda kv: kv[1]["last_served"])
+            for key, entry in by_age:
+                if freed >= nbytes:
+                    break
+                del self._entries[key]
+                freed += entry["size"]
+                _delete_download_file(entry["filename"])
+                print(f"[Cache] Evicted {entry['filename']} ({entry['size'] / 1024 ** 2:.0f} MB) to make room")
+            self._save_locked()
+            return freed
+
+    def _evict_locked(self, keep: Optional[str] = None):
+        total = self._total_bytes_locked()
+        if total <= self.max_bytes:
+            return
+        by_age = sorted(self._entries.items(), key=lambda kv: kv[1]["last_served"])
+        for key, entry in by_age:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            del self._entries[key]
+            total -= entry["size"]
+            _delete_download_file(entry["filename"])
+            print(f"[Cache] Evicted {entry['filename']} ({entry['size'] / 1024 ** 2:.0f} MB)")
+        if keep in self._entries and total > self.max_bytes:
+            # A single file larger than the whole budget: serve it, don't keep it.
+            del self._entries[keep]
+
+
+download_cache = DownloadCache(CACHE_INDEX_PATH, CACHE_MAX_BYTES)
+
+
+# --- Disk budget --------------------------------------------------------------
+# A full disk used to surface as a failed write minutes into a transfer, taking
+# every other download in flight down with it. Now, once a job has picked its
+# formats and before a byte moves, it predicts its output size (filesize, else
+# filesize_approx, else bitrate x duration; twice that when a merge needs both
+# inputs and the output on disk at once) and reserves it against the budget:
+# DISK_BUDGET_BYTES for downloads/, and never more than the filesystem can hold
+# short of DISK_FREE_HEADROOM_BYTES. When the reservation doesn't fit, cached
+# files are evicted to make room if that is enough; otherwise the job hands its
+# download slot back and stays queued until running jobs release theirs.
+#
+# Reservations are kept in a flock'd JSON file in downloads/, so every process
+# writing there (uvicorn workers, standalone workers on the host) shares them.
+# Usage is measured from the files in downloads/, leaving out the partial files
+# of jobs holding a reservation: those are covered by it.
+DISK_BUDGET_BYTES = int(os.getenv('DISK_BUDGET_BYTES', '0'))  # 0 = whatever the filesystem has free
+DISK_FREE_HEADROOM_BYTES = int(os.getenv('DISK_FREE_HEADROOM_BYTES', str(1024 ** 3)))  # 1 GiB
+DISK_UNKNOWN_SIZE_BYTES = 1024 ** 3  # Reserved when no format reports a size
+DISK_SIZE_MARGIN = 1.1  # filesize_approx is an estimate, and the mp4 container adds a little
+DISK_RESERVATION_MAX_SECONDS = JOB_MAX_SECONDS + 60  # Left behind by a process that died
+DISK_WAIT_POLL_SECONDS = 5  # Other processes' releases aren't signalled
+DISK_RESERVATIONS_PATH = os.path.join(DOWNLOADS_DIR, '.disk-reservations.json')
+
+
+class DiskSpaceError(Exception):
+    """The download can never fit the disk budget"""
+
+
+class DiskSpaceWait(Exception):
+    """The download's reservation doesn't fit right now"""
+
+    def __init__(self, nbytes: int):
+        super().__init__(f"Waiting for {nbytes / 1024 ** 2:.0f} MB of disk space")
+        self.nbytes = nbytes
+
+
+class DiskBudget:
+    """Disk space reserved by the downloads in progress"""
+
+    def __init__(self, path: str, budget_bytes: int, headroom_bytes: int):
+        self.path = path
+        self.budget_bytes = budget_bytes
+        self.headroom_bytes = headroom_bytes
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Yield the reservations (job id -> entry), saving any change"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._lock, open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(self.path) as f:
+                    reservations = json.load(f)
+            except FileNotFoundError:
+                reservations = {}
+            except (OSError, ValueError) as e:
+                print(f"[Disk] Ignoring unreadable reservations {self.path}: {e}")
+                reservations = {}
+            before = dict(reservations)
+            stale_before = time.time() - DISK_RESERVATION_MAX_SECONDS
+            for job_id in [j for j, r in reservations.items() if r["reserved_at"] < stale_before]:
+                print(f"[Disk] Dropping stale reservation of job {job_id}")
+                del reservations[job_id]
+            yield reservations
+            if reservations != before:
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'w') as f:
+                    json.dump(reservations, f)
+                os.replace(tmp_path, self.path)
+
+    def _usage_locked(self, reservations: dict) -> dict:
+        reserving = tuple(f"{r['stem']}_" for r in reservations.values())
+        used = covered = 0
+        with os.scandir(os.path.dirname(self.path)) as entries:
+            for entry in entries:
+                try:
+                    if not entry.is_file():
+                        continue
+                    size = entry.stat().st_blocks * 512  # On disk: preallocated or sparse alike
+                except OSError:
+                    continue  # Deleted meanwhile
+                if entry.name.startswith(reserving):
+                    covered += size
+                else:
+                    used += size
+        capacity = used + covered + shutil.disk_usage(os.path.dirname(self.path)).free - self.headroom_bytes
+        if self.budget_bytes > 0:
+            capacity = min(capacity, self.budget_bytes)
+        return {
+            "capacity": max(capacity, 0),
+            "used": used,
+            "reserved": sum(r["bytes"] for r in reservations.values()),
+        }
+
+    def reserve(self, job_id: str, stem: str, nbytes: int):
+        """Reserve nbytes for job_id, or raise DiskSpaceWait / DiskSpaceError"""
+        with self._locked() as reservations:
+            held = reservations.pop(job_id, None)
+            if held is not None and held["bytes"] >= nbytes:
+                reservations[job_id] = held  # A retry of the same download
+                return
+            usage = self._usage_locked(reservations)
+            if nbytes > usage["capacity"]:
+                raise DiskSpaceError(f"Download needs {nbytes / 1024 ** 2:.0f} MB of disk space, "
+                                     f"more than the {usage['capacity'] / 1024 ** 2:.0f} MB available to downloads")
+            shortfall = usage["used"] + usage["reserved"] + nbytes - usage["capacity"]
+            if shortfall > 0:
+                shortfall -= download_cache.make_room(shortfall)
+            if shortfall > 0:
+                if held is not None:
+                    reservations[job_id] = held
+                raise DiskSpaceWait(nbytes)
+            reservations[job_id] = {"stem": stem, "bytes": nbytes, "worker": WORKER_ID, "reserved_at": time.time()}
+
+    def release(self, job_id: str) -> bool:
+        with self._locked() as reservations:
+            return reservations.pop(job_id, None) is not None
+
+    def usage(self) -> dict:
+        with self._locked() as reservations:
+            usage = self._usage_locked(reservations)
+            return {
+                "budget_bytes": usage["capacity"],
+                "used_bytes": usage["used"],
+                "reserved_bytes": usage["reserved"],
+                "available_bytes": max(usage["capacity"] - usage["used"] - usage["reserved"], 0),
+                "reservations": len(reservations),
+            }
+
+
+disk_budget = DiskBudget(DISK_RESERVATIONS_PATH, DISK_BUDGET_BYTES, DISK_FREE_HEADROOM_BYTES)
+
+# Set when this process releases a reservation, so waiting jobs retry at once.
+disk_space_freed = asyncio.Event()
+
+
+def _predicted_download_bytes(chosen: Optional[dict], info: dict) -> int:
+    """Disk space a download of the chosen format(s) needs at its peak"""
+    parts = (chosen.get('requested_formats') or [chosen]) if chosen else []
+    total = 0
+    for part in parts:
+        size = part.get('filesize') or part.get('filesize_approx')
+        if not size and part.get('tbr') and info.get('duration'):
+            size = part['tbr'] * 1000 / 8 * info['duration']
+        if not size:
+            return DISK_UNKNOWN_SIZE_BYTES
+        total += size
+    if not parts:
+        return DISK_UNKNOWN_SIZE_BYTES
+    if len(parts) > 1:
+        total *= 2  # The merged output is written while both inputs are still there
+    return int(total * DISK_SIZE_MARGIN)
+
+
+# --- Info cache ---------------------------------------------------------------
+# Extraction (watch page fetch, player JS run through node, format resolution)
+# costs seconds before a single media byte moves, and the 403 retry loop used
+# to redo it on every attempt. The extracted info dict is cached in-process per
+# video id, for as long as its signed format URLs stay valid: YouTube stamps an
+# `expire` unix time into every googlevideo URL, so an entry lives until the
+# earliest of those minus INFO_CACHE_EXPIRY_MARGIN, capped at INFO_CACHE_TTL.
+# Retries and repeat requests then only re-fetch media.
+#
+# Some URLs are also bound to the IP that extracted them (`ip=` parameter).
+# Behind a rotating proxy every attempt leaves from a new IP, so those entries
+# are only reused over the same egress: a direct connection, a session-sticky
+# proxy endpoint, or a proxy marked sticky with PROXY_STICKY=1.
+INFO_CACHE_TTL = int(os.getenv('INFO_CACHE_TTL', '3600'))  # 0 disables
+INFO_CACHE_DEFAULT_TTL = 600  # For formats without an `expire` stamp
+INFO_CACHE_EXPIRY_MARGIN = 300  # Leave time to actually download the media
+INFO_CACHE_MAX_ENTRIES = 128  # Info dicts of long videos run to a few MB each
+EXTRACT_TIMEOUT_SECONDS = 120
+PROXY_STICKY = os.getenv('PROXY_STICKY') == '1'
+
+_URL_EXPIRE_RE = re.compile(r'[?&/]expire[=/](\d+)')
+_URL_IP_BOUND_RE = re.compile(r'[?&/]ip[=/]')
+
+
+def _format_urls(info: dict):
+    for fmt in info.get('formats') or [info]:
+        if fmt.get('url'):
+            yield fmt['url']
+
+
+def _info_expires_at(info: dict, now: float) -> float:
+    stamps = [int(m.group(1)) for u in _format_urls(info) if (m := _URL_EXPIRE_RE.search(u))]
+    if not stamps:
+        return now + min(INFO_CACHE_DEFAULT_TTL, INFO_CACHE_TTL)
+    return min(now + INFO_CACHE_TTL, min(stamps) - INFO_CACHE_EXPIRY_MARGIN)
+
+
+def _info_is_ip_bound(info: dict) -> bool:
+    return any(_URL_IP_BOUND_RE.search(u) for u in _format_urls(info))
+
+
+class InfoCache:
+    """In-process LRU of extracted info dicts, expiring with their signed URLs"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, egress or None, info)
+
+    def get(self, key: str, egress: Optional[str]) -> Optional[dict]:
+        """A private copy of the cached info (processing mutates it), or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, bound_egress, info = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            if bound_egress is not None and bound_egress != egress:
+                return None
+            self._entries.move_to_end(key)
+        return copy.deepcopy(info)
+
+    def put(self, key: str, info: dict, egress: Optional[str]):
+        now = time.time()
+        expires_at = _info_expires_at(info, now)
+        if INFO_CACHE_TTL <= 0 or expires_at <= now:
+            return
+        # IP-bound URLs only work from the egress that extracted them; a
+        # rotating proxy has no stable egress, so there's nothing to reuse.
+        bound_egress = None
+        if _info_is_ip_bound(info):
+            if egress is None:
+                return
+            bound_egress = egress
+        with self._lock:
+            self._entries[key] = (expires_at, bound_egress, info)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+info_cache = InfoCache(INFO_CACHE_MAX_ENTRIES)
+
+
+def _egress(endpoint: Optional[ProxyEndpoint]) -> Optional[str]:
+    """Identify the outgoing IP a request leaves from, if it is stable"""
+    if endpoint is None:
+        return 'direct'
+    return endpoint.url if endpoint.sticky or PROXY_STICKY else None
+
+
+def _extract_info_cached(url: str, opts: dict, info_key: str, egress: Optional[str],
+                         pool_key: Optional[str] = None) -> tuple:
+    """(info, extract_seconds) for url; extract_seconds is None on a cache hit"""
+    info = info_cache.get(info_key, egress)
+    if info is not None:
+        print(f"[Extract] {info_key} from info cache")
+        return info, None
+    started = time.monotonic()
+    info = download_pool.run(pool_key or f"extract-{uuid.uuid4().hex}",
+                             {'kind': 'extract', 'url': url, 'opts': opts}, timeout=EXTRACT_TIMEOUT_SECONDS)
+    extract_seconds = time.monotonic() - started
+    metrics.extract_seconds.observe(extract_seconds)
+    print(f"[Extract] {info_key} in {extract_seconds:.2f}s")
+    info_cache.put(info_key, copy.deepcopy(info), egress)
+    return info, extract_seconds
+
+
+# --- Download process pool ----------------------------------------------------
+# yt-dlp runs in separate processes, not in threads of this one. A thread stuck
+# in a hung read can't be stopped; it used to keep its socket, its bandwidth and
+# its slot in the default executor after JOB_MAX_SECONDS gave up on it. A process
+# can simply be killed: the thread waiting for its answer then gets EOF and
+# returns.
+#
+# Processes are spawned ahead of time (DOWNLOAD_POOL_WARM kept idle and ready,
+# with yt_dlp already imported) and run one task at a time: "extract" returns an
+# info dict for the parent's info cache, "download" runs process_ie_result on one
+# and streams progress_hook / postprocessor_hook events back over the pipe.
+# What runs in them, including the segmented downloader, lives in pool_child.py:
+# a spawned process imports its entry point's module, and this one would give
+# every process its own app, job store connections and proxy pool.
+DOWNLOAD_POOL_WARM = int(os.getenv('DOWNLOAD_POOL_WARM', '2'))
+DOWNLOAD_POOL_MAX_IDLE = 8  # Beyond this, finished processes exit instead of idling
+
+
+class DownloadProcessError(Exception):
+    """A pool task failed with an exception other than yt-dlp's DownloadError"""
+
+
+class DownloadProcessTerminated(Exception):
+    """The pool process running a task was killed (timeout or cancellation)"""
+
+
+class DownloadProcessTimeout(Exception):
+    """A pool task ran past its timeout; its process was killed"""
+
+
+class DownloadProcessPool:
+    """Pre-warmed yt-dlp processes that can be killed per task key (usually a job id)"""
+
+    def __init__(self, warm: int, max_idle: int):
+        self.warm = warm
+        self.max_idle = max(max_idle, warm)
+        self._ctx = multiprocessing.get_context('spawn')
+        self._lock = threading.Lock()
+        self._idle = []       # [(process, connection)]
+        self._busy = {}       # key -> (process, connection)
+        self._doomed = set()  # Keys terminated between two tasks
+        self._spawned = 0
+        self._closed = False
+
+    def _spawn(self) -> tuple:
+        parent_conn, child_conn = self._ctx.Pipe()
+        with self._lock:
+            self._spawned += 1
+            name = f"download-pool-{self._spawned}"
+        process = self._ctx.Process(target=pool_child.child_main, args=(child_conn,), name=name, daemon=True)
+        process.start()
+        child_conn.close()
+        return process, parent_conn
+
+    @staticmethod
+    def _kill(process):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (AttributeError, OSError):
+            process.kill()  # Not a group leader (yet), or no process groups here
+
+    def _replenish(self):
+        while True:
+            with self._lock:
+                if self._closed or len(self._idle) >= self.warm:
+                    return
+            worker = self._spawn()
+            with self._lock:
+                if self._closed:
+                    self._kill(worker[0])
+                    return
+                self._idle.append(worker)
+
+    def start(self):
+        threading.Thread(target=self._replenish, name="download-pool-warm", daemon=True).start()
+
+    def stop(self):
+        with self._lock:
+            self._closed = True
+            workers = self._idle + list(self._busy.values())
+            self._idle = []
+        for process, conn in workers:
+            self._kill(process)
+            conn.close()
+
+    def terminate(self, key: str):
+        """Kill whatever runs for key now, and refuse further tasks for it"""
+        with self._lock:
+            self._doomed.add(key)
+            worker = self._busy.get(key)
+        if worker is not None:
+            self._kill(worker[0])
+
+    def forget(self, key: str):
+        with self._lock:
+            self._doomed.discard(key)
+
+    def run(self, key: str, task: dict, on_event=None, timeout: Optional[float] = None):
+        """Run a task in a pool process, passing progress events to on_event(kind, data)"""
+        with self._lock:
+            if key in self._doomed:
+                raise DownloadProcessTerminated(f"Task {key} was terminated")
+            worker = self._idle.pop() if self._idle else None
+        if worker is None or not worker[0].is_alive():
+            worker = self._spawn()  # Cold start: none ready
+        with self._lock:
+            self._busy[key] = worker
+        if not self._closed:
+            threading.Thread(target=self._replenish, name="download-pool-warm", daemon=True).start()
+
+        process, conn = worker
+        reusable = False
+        deadline = time.monotonic() + timeout if timeout else None
+        try:
+            conn.send(task)
+            while True:
+                if deadline is not None and not conn.poll(max(0.0, deadline - time.monotonic())):
+                    raise DownloadProcessTimeout(f"Pool task timed out after {timeout}s")
+                kind, *payload = conn.recv()
+                if kind == 'result':
+                    reusable = True
+                    return payload[0]
+                if kind == 'error':
+                    reusable = True
+                    name, message = payload
+                    if name == 'DownloadError':
+                        raise yt_dlp.utils.DownloadError(message)
+                    raise DownloadProcessError(f"{name}: {message}")
+                if on_event is not None:
+                    on_event(kind, payload[0])
+        except (EOFError, OSError):
+            raise DownloadProcessTerminated(f"Pool process for {key} was terminated")
+        finally:
+            with self._lock:
+                self._busy.pop(key, None)
+                keep = reusable and not self._closed and len(self._idle) < self.max_idle
+                if keep:
+                    self._idle.append(worker)
+            if not keep:
+                self._kill(process)
+                conn.close()
+
+
+download_pool = DownloadProcessPool(DOWNLOAD_POOL_WARM, DOWNLOAD_POOL_MAX_IDLE)
+
 
 def _delete_download_file(filename: str):
-    file_path = os.path.join(os.getcwd(), 'downloads', filename)
+    file_path = os.path.join(DOWNLOADS_DIR, filename)
     try:
         os.remove(file_path)
     except FileNotFoundError:
@@ -93,157 +963,1148 @@ def _delete_download_file(filename: str):
         print(f"[Cleanup] Failed to delete {file_path}: {e}")
 
 
-async def _delete_file_later(filename: str, delay: float = JOB_RETENTION_SECONDS):
-    await asyncio.sleep(delay)
-    _delete_download_file(filename)
+def _release_download_file(filename: str):
+    """Delete a finished file once nobody needs it - unless the cache owns it"""
+    if not download_cache.contains_file(filename):
+        _delete_download_file(filename)
+
+
+def _delete_partial_files(prefix: str):
+    """Delete what an aborted download left behind (.part, .ytdl, merge inputs)"""
+    try:
+        entries = os.listdir(DOWNLOADS_DIR)
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry.startswith(prefix):
+            _delete_download_file(entry)
 
 
 @app.on_event("startup")
 def _purge_downloads_on_startup():
-    downloads_dir = os.path.join(os.getcwd(), 'downloads')
-    if not os.path.isdir(downloads_dir):
+    if not os.path.isdir(DOWNLOADS_DIR):
         return
+    # Cached files are kept across restarts, and so are the partial files of
+    # jobs that haven't finished (they resume where they stopped). Everything
+    # else (abandoned partial files, uncached results whose retention timers
+    # died with the old process) goes. Only files untouched for
+    # JOB_RETENTION_SECONDS are removed: other worker processes sharing
+    # downloads/ may be writing or serving the rest right now.
+    download_cache.load()
+    keep = download_cache.filenames()
+    resumable = tuple(f"{job.output_stem}_" for job in job_store.list_by_status(JobStatus.QUEUED, JobStatus.DOWNLOADING)
+                      if job.output_stem)
+    cutoff = time.time() - JOB_RETENTION_SECONDS
     removed = 0
-    for entry in os.listdir(downloads_dir):
-        path = os.path.join(downloads_dir, entry)
+    for entry in os.listdir(DOWNLOADS_DIR):
+        if entry in keep or entry.startswith('.') or entry.startswith(resumable):
+            continue
+        path = os.path.join(DOWNLOADS_DIR, entry)
         try:
-            if os.path.isfile(path):
+            if os.path.isfile(path) and os.path.getmtime(path) < cutoff:
                 os.remove(path)
                 removed += 1
         except OSError as e:
             print(f"[Startup] Failed to delete {path}: {e}")
-    print(f"[Startup] Purged {removed} stale file(s) from {downloads_dir}")
+    print(f"[Startup] Purged {removed} stale file(s) from {DOWNLOADS_DIR}")
 
 
-async def _cleanup_job_later(job_id: str, delay: float = JOB_RETENTION_SECONDS):
-    await asyncio.sleep(delay)
-    job = jobs.pop(job_id, None)
-    if job and job.result:
-        filename = job.result.get("filename")
-        if filename:
-            _delete_download_file(filename)
+engine_tasks: list = []  # Background loops started with the app
+
+
+@app.on_event("startup")
+async def _start_job_engine():
+    download_pool.start()
+    job_store.start()
+    _reconcile_expiry()
+    engine_tasks.append(asyncio.create_task(run_admission_controller()))
+    engine_tasks.append(asyncio.create_task(run_expiry_service()))
+    if EMBEDDED_WORKER:
+        engine_tasks.append(asyncio.create_task(run_queue_consumer()))
+        engine_tasks.append(asyncio.create_task(run_webhook_dispatcher()))
+
+
+@app.on_event("shutdown")
+async def _stop_job_engine():
+    # Running jobs must be interrupted (and left on the queue) before the pool
+    # goes away, or they would fail with their pool process killed under them.
+    for task in engine_tasks:
+        task.cancel()
+    await asyncio.gather(*engine_tasks, return_exceptions=True)
+    engine_tasks.clear()
+    download_pool.stop()
+    job_store.stop()
+    await _close_webhook_client()
+    _mark_metrics_process_dead()
 
 class JobStatus(str, Enum):
     QUEUED = "queued"
     DOWNLOADING = "downloading"
     COMPLETED = "completed"
     FAILED = "failed"
+    CANCELLED = "cancelled"
+
+FINISHED_STATUSES = (JobStatus.COMPLETED, JobStatus.FAILED, JobStatus.CANCELLED)
+
+class JobPriority(str, Enum):
+    HIGH = "high"
+    NORMAL = "normal"
+    LOW = "low"
 
 class DownloadRequest(BaseModel):
     url: str
     resolution: str = "1080p"
     webhook_url: HttpUrl
+    max_filesize_mb: Optional[float] = None  # Caps for the selected format(s), see _format_limits
+    max_fps: Optional[float] = None
+    max_bitrate_kbps: Optional[float] = None
+    owner: Optional[str] = None  # Caller-chosen label, for GET /jobs?owner=... and fair queuing
+    priority: JobPriority = JobPriority.NORMAL
 
 class Job(BaseModel):
     job_id: str
     status: JobStatus
     url: str
     resolution: str
+    max_filesize_mb: Optional[float] = None
+    max_fps: Optional[float] = None
+    max_bitrate_kbps: Optional[float] = None
     webhook_url: Optional[str] = None
+    owner: Optional[str] = None
     created_at: datetime
     completed_at: Optional[datetime] = None
     result: Optional[dict] = None
     error: Optional[str] = None
+    error_class: Optional[str] = None  # Exception type name of the failure
     # Progress tracking
     progress_percent: float = 0.0
     downloaded_bytes: int = 0
     total_bytes: int = 0
     speed: Optional[str] = None
     eta: Optional[str] = None
+    extract_seconds: Optional[float] = None  # Metadata extraction time (0 = info cache hit)
+    stream_file: Optional[str] = None  # Growing output under downloads/, for /jobs/{id}/stream
+    stream_limit: Optional[int] = None  # Bytes of stream_file safe to read (segmented downloads fill it out of order)
+    stream_generation: int = 0  # Bumped when the output streamed so far is discarded (format change)
+    output_stem: Optional[str] = None  # Output filename prefix, kept across re-runs so partial files resume
+    resume_format: Optional[dict] = None  # Format the partial files belong to (see _format_signature)
+    disk_bytes: Optional[int] = None  # Disk space the chosen format needs (see DiskBudget)
+    priority: JobPriority = JobPriority.NORMAL
+    cancel_on_disconnect: bool = False
+    queue_position: Optional[int] = None  # While waiting for a download slot
+    estimated_start: Optional[datetime] = None
+    trace: list = []  # Stage spans for GET /jobs/{id}/trace (see _trace_span)
 
-@app.get("/", response_class=HTMLResponse)
-async def home():
-    return """
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>YouTube Downloader</title>
-        <style>
-            * {
-                margin: 0;
-                padding: 0;
-                box-sizing: border-box;
-            }
-            body {
-                font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, Cantarell, sans-serif;
-                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                min-height: 100vh;
-                display: flex;
-                justify-content: center;
-                align-items: center;
-                padding: 20px;
-            }
-            .container {
-                background: white;
-                padding: 40px;
-                border-radius: 16px;
-                box-shadow: 0 20px 60px rgba(0, 0, 0, 0.3);
-                max-width: 500px;
-                width: 100%;
-            }
-            h1 {
-                color: #333;
-                margin-bottom: 10px;
-                font-size: 28px;
-            }
-            .subtitle {
-                color: #666;
-                margin-bottom: 30px;
-                font-size: 14px;
-            }
-            .form-group {
-                margin-bottom: 20px;
-            }
-            label {
-                display: block;
-                margin-bottom: 8px;
-                color: #333;
-                font-weight: 500;
-                font-size: 14px;
-            }
-            input[type="url"], select {
-                width: 100%;
-                padding: 12px;
-                border: 2px solid #e0e0e0;
-                border-radius: 8px;
-                font-size: 14px;
-                transition: border-color 0.3s;
-            }
-            input[type="url"]:focus, select:focus {
-                outline: none;
-                border-color: #667eea;
-            }
-            button {
-                width: 100%;
-                padding: 14px;
-                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                color: white;
-                border: none;
-                border-radius: 8px;
-                font-size: 16px;
-                font-weight: 600;
-                cursor: pointer;
-                transition: transform 0.2s, box-shadow 0.2s;
-            }
-            button:hover {
-                transform: translateY(-2px);
-                box-shadow: 0 10px 20px rgba(102, 126, 234, 0.4);
-            }
-            button:active {
-                transform: translateY(0);
-            }
-            button:disabled {
-                background: #ccc;
-                cursor: not-allowed;
-                transform: none;
-            }
-            .message {
-                margin-top: 20px;
-                padding: 12px;
-                border-radius: 8px;
-                font-size: 14px;
+
+# --- Job store ----------------------------------------------------------------
+# Job records live in a JobStore instead of a per-process dict, so a restart
+# (railway.json restarts ON_FAILURE) doesn't lose queued/running jobs and their
+# webhooks, and several processes see the same jobs. Backends:
+#   sqlite (default) - SQLite in WAL mode, shared by every process on the host
+#                      (uvicorn --workers N, `download-youtube.py worker`)
+#   redis            - shared across hosts (REDIS_URL)
+#   memory           - the old single-process behaviour
+#
+# Jobs this process is running are "adopted": they stay live in memory,
+# progress_hook mutates the Job object directly and the store only persists
+# it. Status transitions are written through immediately; progress updates are
+# batched and flushed every JOB_PROGRESS_FLUSH_SECONDS so the hot path never
+# waits on disk or the network.
+JOB_STORE = os.getenv('JOB_STORE', 'sqlite')
+JOB_DB_PATH = os.getenv('JOB_DB_PATH', os.path.join(os.getcwd(), 'state', 'jobs.sqlite3'))
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+JOB_PROGRESS_FLUSH_SECONDS = 1.0
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+class JobStore:
+    """Interface for job persistence. Implementations must be thread-safe."""
+
+    # Called with the job_id after every save/save_progress, from any thread.
+    listener = None
+
+    def _notify(self, job_id: str):
+        if self.listener is not None:
+            self.listener(job_id)
+
+    def add(self, job: Job):
+        raise NotImplementedError
+
+    def get(self, job_id: str) -> Optional[Job]:
+        raise NotImplementedError
+
+    def adopt(self, job_id: str) -> Optional[Job]:
+        """Load a job this process is about to run and keep it live in memory"""
+        return self.get(job_id)
+
+    def release(self, job_id: str):
+        """Flush and drop a live job once this process is done with it"""
+
+    def is_live(self, job_id: str) -> bool:
+        """True if this process holds the authoritative, in-memory copy"""
+        return True
+
+    def save(self, job: Job):
+        """Persist a status transition right away"""
+        raise NotImplementedError
+
+    def save_progress(self, job: Job):
+        """Persist a progress update; may be batched"""
+        raise NotImplementedError
+
+    def delete(self, job_id: str) -> Optional[Job]:
+        raise NotImplementedError
+
+    def request_cancel(self, job_id: str):
+        """Flag a job for cancellation, for whichever process is running it"""
+        raise NotImplementedError
+
+    def cancel_requested(self, job_id: str) -> bool:
+        raise NotImplementedError
+
+    def list_by_status(self, *statuses: JobStatus) -> list:
+        raise NotImplementedError
+
+    def list_by_owner(self, owner: str) -> list:
+        raise NotImplementedError
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def __contains__(self, job_id: str) -> bool:
+        return self.get(job_id) is not None
+
+
+class MemoryJobStore(JobStore):
+    """Single-process store: jobs are lost on restart"""
+
+    def __init__(self):
+        self._jobs: dict = {}
+        self._cancel_requests: set = set()
+
+    def add(self, job: Job):
+        self._jobs[job.job_id] = job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def save(self, job: Job):
+        self._notify(job.job_id)
+
+    def save_progress(self, job: Job):
+        self._notify(job.job_id)
+
+    def delete(self, job_id: str) -> Optional[Job]:
+        self._cancel_requests.discard(job_id)
+        return self._jobs.pop(job_id, None)
+
+    def request_cancel(self, job_id: str):
+        self._cancel_requests.add(job_id)
+
+    def cancel_requested(self, job_id: str) -> bool:
+        return job_id in self._cancel_requests
+
+    def list_by_status(self, *statuses: JobStatus) -> list:
+        return [job for job in self._jobs.values() if job.status in statuses]
+
+    def list_by_owner(self, owner: str) -> list:
+        return [job for job in self._jobs.values() if job.owner == owner]
+
+
+class PersistentJobStore(JobStore):
+    """Live-job bookkeeping and batched progress flushing for durable backends"""
+
+    def __init__(self):
+        self._live: dict = {}  # job_id -> Job adopted by this process
+        self._dirty: set = set()  # live job_ids with unflushed progress
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    # Backend primitives
+    def _read(self, job_id: str) -> Optional[Job]:
+        raise NotImplementedError
+
+    def _write(self, jobs_to_write: list, create: bool = False):
+        raise NotImplementedError
+
+    def _remove(self, job_id: str):
+        raise NotImplementedError
+
+    def _ids_by_status(self, statuses: list) -> list:
+        raise NotImplementedError
+
+    def _ids_by_owner(self, owner: str) -> list:
+        raise NotImplementedError
+
+    def add(self, job: Job):
+        self._write([job], create=True)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        job = self._live.get(job_id)
+        return job if job is not None else self._read(job_id)
+
+    def adopt(self, job_id: str) -> Optional[Job]:
+        job = self.get(job_id)
+        if job is not None:
+            with self._lock:
+                self._live[job_id] = job
+        return job
+
+    def release(self, job_id: str):
+        with self._lock:
+            job = self._live.pop(job_id, None)
+            dirty = job_id in self._dirty
+            self._dirty.discard(job_id)
+        if job is not None and dirty:
+            self._write([job])
+
+    def is_live(self, job_id: str) -> bool:
+        return job_id in self._live
+
+    def save(self, job: Job):
+        with self._lock:
+            self._dirty.discard(job.job_id)
+        self._write([job])
+        self._notify(job.job_id)
+
+    def save_progress(self, job: Job):
+        with self._lock:
+            self._dirty.add(job.job_id)
+        self._notify(job.job_id)
+
+    def flush(self):
+        with self._lock:
+            pending = [self._live[job_id] for job_id in self._dirty if job_id in self._live]
+            self._dirty.clear()
+        if pending:
+            self._write(pending)
+
+    def delete(self, job_id: str) -> Optional[Job]:
+        job = self.get(job_id)
+        with self._lock:
+            self._live.pop(job_id, None)
+            self._dirty.discard(job_id)
+        self._remove(job_id)
+        return job
+
+    def list_by_status(self, *statuses: JobStatus) -> list:
+        found = (self.get(job_id) for job_id in self._ids_by_status([s.value for s in statuses]))
+        return [job for job in found if job is not None]
+
+    def list_by_owner(self, owner: str) -> list:
+        found = (self.get(job_id) for job_id in self._ids_by_owner(owner))
+        return [job for job in found if job is not None]
+
+    def _flush_loop(self):
+        while not self._stopped.wait(JOB_PROGRESS_FLUSH_SECONDS):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[JobStore] Progress flush failed: {e}")
+
+    def start(self):
+        threading.Thread(target=self._flush_loop, name="job-store-flush", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        self.flush()
+
+
+class SQLiteJobStore(PersistentJobStore):
+    """Durable store shared by every process on the host (SQLite, WAL mode)"""
+
+    def __init__(self, path: str):
+        super().__init__()
+        self._db = _sqlite_connect(path)
+        self._db_lock = threading.Lock()
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+            CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (json_extract(data, '$.owner'));
+        """)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        if 'cancel_requested' not in columns:  # Outside `data`, so saves of the live job can't clear it
+            self._db.execute("ALTER TABLE jobs ADD COLUMN cancel_requested INTEGER NOT NULL DEFAULT 0")
+
+    def _read(self, job_id: str) -> Optional[Job]:
+        with self._db_lock:
+            row = self._db.execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return Job.model_validate_json(row[0]) if row else None
+
+    def _write(self, jobs_to_write: list, create: bool = False):
+        now = time.time()
+        rows = [(job.job_id, job.status.value, now, job.model_dump_json()) for job in jobs_to_write]
+        sql = ("INSERT OR REPLACE INTO jobs (job_id, status, updated_at, data) VALUES (?1, ?2, ?3, ?4)" if create
+               else "UPDATE jobs SET status = ?2, updated_at = ?3, data = ?4 WHERE job_id = ?1")
+        with self._db_lock:
+            self._db.executemany(sql, rows)
+
+    def _remove(self, job_id: str):
+        with self._db_lock:
+            self._db.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+
+    def request_cancel(self, job_id: str):
+        with self._db_lock:
+            self._db.execute("UPDATE jobs SET cancel_requested = 1 WHERE job_id = ?", (job_id,))
+
+    def cancel_requested(self, job_id: str) -> bool:
+        with self._db_lock:
+            row = self._db.execute("SELECT cancel_requested FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def _ids_by_status(self, statuses: list) -> list:
+        marks = ','.join('?' * len(statuses))
+        with self._db_lock:
+            rows = self._db.execute(f"SELECT job_id FROM jobs WHERE status IN ({marks})", statuses).fetchall()
+        return [row[0] for row in rows]
+
+    def _ids_by_owner(self, owner: str) -> list:
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT job_id FROM jobs WHERE json_extract(data, '$.owner') = ? ORDER BY rowid", (owner,)).fetchall()
+        return [row[0] for row in rows]
+
+
+class RedisJobStore(PersistentJobStore):
+    """Durable store shared across hosts: one JSON string per job plus a set per status"""
+
+    def __init__(self, client):
+        super().__init__()
+        self._redis = client
+
+    def _read(self, job_id: str) -> Optional[Job]:
+        data = self._redis.get(f"dl:job:{job_id}")
+        return Job.model_validate_json(data) if data else None
+
+    def _write(self, jobs_to_write: list, create: bool = False):
+        for job in jobs_to_write:
+            if not create and not self._redis.exists(f"dl:job:{job.job_id}"):
+                continue  # Deleted meanwhile - don't resurrect it
+            self._redis.set(f"dl:job:{job.job_id}", job.model_dump_json())
+            if create and job.owner:
+                self._redis.sadd(f"dl:owner:{job.owner}", job.job_id)
+            for status in JobStatus:
+                if status != job.status:
+                    self._redis.srem(f"dl:jobs:{status.value}", job.job_id)
+            self._redis.sadd(f"dl:jobs:{job.status.value}", job.job_id)
+
+    def _remove(self, job_id: str):
+        job = self._read(job_id)
+        if job is not None and job.owner:
+            self._redis.srem(f"dl:owner:{job.owner}", job_id)
+        self._redis.delete(f"dl:job:{job_id}")
+        self._redis.srem("dl:jobs:cancel-requested", job_id)
+        for status in JobStatus:
+            self._redis.srem(f"dl:jobs:{status.value}", job_id)
+
+    def request_cancel(self, job_id: str):
+        self._redis.sadd("dl:jobs:cancel-requested", job_id)
+
+    def cancel_requested(self, job_id: str) -> bool:
+        return bool(self._redis.sismember("dl:jobs:cancel-requested", job_id))
+
+    def _ids_by_status(self, statuses: list) -> list:
+        return [job_id for status in statuses for job_id in self._redis.smembers(f"dl:jobs:{status}")]
+
+    def _ids_by_owner(self, owner: str) -> list:
+        return list(self._redis.smembers(f"dl:owner:{owner}"))
+
+
+# --- Job queue ----------------------------------------------------------------
+# Downloads don't run in the process that accepted the HTTP request. The API
+# enqueues job ids; worker loops (embedded in the API process by default, or
+# standalone via `python download-youtube.py worker`, on this or other hosts)
+# claim them with a lease of JOB_LEASE_SECONDS and heartbeat it while the job
+# runs. A worker that dies stops heartbeating; once its lease expires any other
+# worker puts the job back on the queue and it runs again. Capacity therefore
+# scales with the number of worker processes, not one process x
+# MAX_CONCURRENT_DOWNLOADS. EMBEDDED_WORKER=0 turns the API into a pure
+# enqueue/status tier.
+#
+# Claims are fair rather than FIFO: jobs are ordered by priority class, then by
+# how many jobs their owner already had outstanding when they were enqueued,
+# then by age. An owner who enqueues 200 jobs gets their 1st, 2nd, ... job
+# interleaved with everyone else's 1st, 2nd, ... instead of going first with all
+# 200.
+#
+# Backends: sqlite (default with the sqlite job store, same database file) or
+# redis (REDIS_URL; redis://... for a real server, fake:// for the in-memory
+# single-process FakeRedis backend, which is what JOB_STORE=memory uses).
+JOB_QUEUE = os.getenv('JOB_QUEUE', 'sqlite' if JOB_STORE == 'sqlite' else 'redis')
+JOB_LEASE_SECONDS = 30.0
+JOB_QUEUE_POLL_SECONDS = 0.5
+EMBEDDED_WORKER = os.getenv('EMBEDDED_WORKER', '1') == '1'
+
+
+class JobQueue:
+    """Interface for the shared work queue. Implementations must be thread-safe."""
+
+    def enqueue(self, job_id: str, priority: int = 1, owner: Optional[str] = None):
+        """Queue a job; lower priority values are claimed first"""
+        raise NotImplementedError
+
+    def claim(self, worker_id: str) -> Optional[str]:
+        """Lease the first unclaimed job in fair order to worker_id, or return None"""
+        raise NotImplementedError
+
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        """Extend worker_id's lease; False if the lease was lost"""
+        raise NotImplementedError
+
+    def ack(self, job_id: str):
+        """Remove a job from the queue for good (finished or abandoned)"""
+        raise NotImplementedError
+
+    def withdraw(self, job_id: str) -> bool:
+        """Remove a job only if no worker has claimed it; True if it was removed"""
+        raise NotImplementedError
+
+    def requeue_expired(self) -> int:
+        """Return jobs with expired leases to the queue; returns how many"""
+        raise NotImplementedError
+
+    def depth(self) -> int:
+        """Number of jobs waiting to be claimed"""
+        raise NotImplementedError
+
+    def position(self, job_id: str) -> Optional[int]:
+        """1-based place among unclaimed jobs, or None if not waiting here"""
+        raise NotImplementedError
+
+
+class SQLiteJobQueue(JobQueue):
+    def __init__(self, path: str):
+        self._db = _sqlite_connect(path)
+        self._lock = threading.Lock()
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS job_queue (
+                job_id TEXT PRIMARY KEY,
+                enqueued_at REAL NOT NULL,
+                lease_owner TEXT,
+                lease_expires_at REAL
+            );
+        """)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(job_queue)")}
+        for column, definition in (('priority', 'INTEGER NOT NULL DEFAULT 1'), ('owner', 'TEXT'),
+                                   ('owner_rank', 'INTEGER NOT NULL DEFAULT 0')):
+            if column not in columns:  # Tables created before fair ordering
+                self._db.execute(f"ALTER TABLE job_queue ADD COLUMN {column} {definition}")
+        self._db.executescript("""
+            DROP INDEX IF EXISTS job_queue_ready;
+            CREATE INDEX IF NOT EXISTS job_queue_fair ON job_queue (lease_owner, priority, owner_rank, enqueued_at);
+        """)
+
+    def enqueue(self, job_id: str, priority: int = 1, owner: Optional[str] = None):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO job_queue (job_id, enqueued_at, priority, owner, owner_rank) "
+                "VALUES (?, ?, ?, ?, (SELECT COUNT(*) FROM job_queue WHERE owner IS ?))",
+                (job_id, time.time(), priority, owner, owner))
+
+    def claim(self, worker_id: str) -> Optional[str]:
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock up front, so the select +
+            # update is atomic across processes.
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT job_id FROM job_queue WHERE lease_owner IS NULL "
+                    "ORDER BY priority, owner_rank, enqueued_at LIMIT 1").fetchone()
+                if row:
+                    self._db.execute("UPDATE job_queue SET lease_owner = ?, lease_expires_at = ? WHERE job_id = ?",
+                                     (worker_id, time.time() + JOB_LEASE_SECONDS, row[0]))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return row[0] if row else None
+
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        with self._lock:
+            cur = self._db.execute(
+                "UPDATE job_queue SET lease_expires_at = ? WHERE job_id = ? AND lease_owner = ?",
+                (time.time() + JOB_LEASE_SECONDS, job_id, worker_id))
+        return cur.rowcount == 1
+
+    def ack(self, job_id: str):
+        with self._lock:
+            self._db.execute("DELETE FROM job_queue WHERE job_id = ?", (job_id,))
+
+    def withdraw(self, job_id: str) -> bool:
+        with self._lock:
+            cur = self._db.execute("DELETE FROM job_queue WHERE job_id = ? AND lease_owner IS NULL", (job_id,))
+        return cur.rowcount == 1
+
+    def requeue_expired(self) -> int:
+        with self._lock:
+            cur = self._db.execute(
+                "UPDATE job_queue SET lease_owner = NULL, lease_expires_at = NULL "
+                "WHERE lease_owner IS NOT NULL AND lease_expires_at < ?", (time.time(),))
+        return cur.rowcount
+
+    def depth(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM job_queue WHERE lease_owner IS NULL").fetchone()[0]
+
+    def position(self, job_id: str) -> Optional[int]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT priority, owner_rank, enqueued_at FROM job_queue WHERE job_id = ? AND lease_owner IS NULL",
+                (job_id,)).fetchone()
+            if row is None:
+                return None
+            ahead = self._db.execute(
+                "SELECT COUNT(*) FROM job_queue WHERE lease_owner IS NULL "
+                "AND (priority, owner_rank, enqueued_at) < (?, ?, ?)", row).fetchone()[0]
+        return ahead + 1
+
+
+class RedisJobQueue(JobQueue):
+    """Sorted-set queue: dl:queue:ready -> (ZPOPMIN) -> dl:queue:active, leases in a zset"""
+
+    READY = 'dl:queue:ready'        # zset job_id -> fair-order score
+    ACTIVE = 'dl:queue:active'
+    LEASES = 'dl:queue:leases'      # zset job_id -> lease expiry
+    OWNERS = 'dl:queue:owners'      # hash job_id -> worker_id
+    META = 'dl:queue:meta'          # hash job_id -> {"score", "owner"}, until ack
+    OWNER_DEPTH = 'dl:queue:owner-depth'  # hash owner -> outstanding jobs
+
+    def __init__(self, client):
+        self._redis = client
+
+    @staticmethod
+    def _score(priority: int, owner_rank: int, enqueued_at: float) -> float:
+        # Packs (priority, owner_rank, enqueued_at) into one float that sorts the
+        # same way; whole seconds are plenty to break ties by age.
+        return priority * 1e15 + min(owner_rank, 99999) * 1e10 + int(enqueued_at)
+
+    def enqueue(self, job_id: str, priority: int = 1, owner: Optional[str] = None):
+        owner_rank = self._redis.hincrby(self.OWNER_DEPTH, owner or '', 1) - 1
+        score = self._score(priority, owner_rank, time.time())
+        self._redis.hset(self.META, job_id, json.dumps({"score": score, "owner": owner or ''}))
+        self._redis.zadd(self.READY, {job_id: score})
+
+    def claim(self, worker_id: str) -> Optional[str]:
+        def claim_head(pipe) -> Optional[str]:
+            # WATCHing READY makes the move all-or-nothing: the job is never on
+            # neither structure, and a claimer that loses the race retries.
+            head = pipe.zrange(self.READY, 0, 0)
+            if not head:
+                return None
+            job_id = head[0]
+            pipe.multi()
+            pipe.zrem(self.READY, job_id)
+            pipe.rpush(self.ACTIVE, job_id)
+            pipe.hset(self.OWNERS, job_id, worker_id)
+            pipe.zadd(self.LEASES, {job_id: time.time() + JOB_LEASE_SECONDS})
+            return job_id
+
+        return self._redis.transaction(claim_head, self.READY, value_from_callable=True)
+
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        if self._redis.hget(self.OWNERS, job_id) != worker_id:
+            return False
+        self._redis.zadd(self.LEASES, {job_id: time.time() + JOB_LEASE_SECONDS}, xx=True)
+        return True
+
+    def ack(self, job_id: str):
+        self._redis.zrem(self.READY, job_id)
+        self._redis.lrem(self.ACTIVE, 0, job_id)
+        self._redis.zrem(self.LEASES, job_id)
+        self._redis.hdel(self.OWNERS, job_id)
+        self._forget_meta(job_id)
+
+    def withdraw(self, job_id: str) -> bool:
+        if not self._redis.zrem(self.READY, job_id):
+            return False
+        self._forget_meta(job_id)
+        return True
+
+    def _forget_meta(self, job_id: str):
+        meta = self._redis.hget(self.META, job_id)
+        if meta is not None and self._redis.hdel(self.META, job_id):
+            self._redis.hincrby(self.OWNER_DEPTH, json.loads(meta)['owner'], -1)
+
+    def requeue_expired(self) -> int:
+        now = time.time()
+        requeued = 0
+        for job_id in self._redis.zrangebyscore(self.LEASES, '-inf', now):
+            if self._redis.lrem(self.ACTIVE, 0, job_id):
+                self._redis.zrem(self.LEASES, job_id)
+                self._redis.hdel(self.OWNERS, job_id)
+                # Back in its original place, ahead of everything enqueued since
+                meta = self._redis.hget(self.META, job_id)
+                self._redis.zadd(self.READY, {job_id: json.loads(meta)['score'] if meta else 0})
+                requeued += 1
+        return requeued
+
+    def depth(self) -> int:
+        return self._redis.zcard(self.READY)
+
+    def position(self, job_id: str) -> Optional[int]:
+        rank = self._redis.zrank(self.READY, job_id)
+        return None if rank is None else rank + 1
+
+
+class FakeRedis:
+    """In-memory, single-process backend speaking the subset of redis-py used above.
+
+    What JOB_STORE=memory (or REDIS_URL=fake://) runs the Redis queue, outbox
+    and expiry schedule on: nothing is shared with other processes and nothing
+    survives a restart.
+    """
+
+    def __init__(self):
+        self._data: dict = {}
+        self._lock = threading.RLock()
+
+    def _get(self, key, factory):
+        return self._data.setdefault(key, factory())
+
+    def transaction(self, func, *watches, value_from_callable=False):
+        # Every command runs under the one lock, so holding it for the whole
+        # callable is as good as WATCH/MULTI/EXEC.
+        with self._lock:
+            value = func(self)
+        return value if value_from_callable else []
+
+    def multi(self):
+        pass
+
+    def get(self, key):
+        with self._lock:
+            return self._data.get(key)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+
+    def exists(self, key):
+        with self._lock:
+            return int(key in self._data)
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(self._data.pop(key, None) is not None for key in keys)
+
+    def sadd(self, key, *members):
+        with self._lock:
+            self._get(key, set).update(members)
+
+    def srem(self, key, *members):
+        with self._lock:
+            self._get(key, set).difference_update(members)
+
+    def smembers(self, key):
+        with self._lock:
+            return set(self._get(key, set))
+
+    def sismember(self, key, member):
+        with self._lock:
+            return int(member in self._get(key, set))
+
+    def rpush(self, key, *values):
+        with self._lock:
+            self._get(key, list).extend(values)
+
+    def lpush(self, key, *values):
+        with self._lock:
+            for value in values:
+                self._get(key, list).insert(0, value)
+
+    def lrem(self, key, count, value):
+        with self._lock:
+            items = self._get(key, list)
+            before = len(items)
+            items[:] = [item for item in items if item != value]
+            return before - len(items)
+
+    def lrange(self, key, start, end):
+        with self._lock:
+            items = self._get(key, list)
+            return list(items[start:None if end == -1 else end + 1])
+
+    def llen(self, key):
+        with self._lock:
+            return len(self._get(key, list))
+
+    def hset(self, key, field, value):
+        with self._lock:
+            self._get(key, dict)[field] = value
+
+    def hget(self, key, field):
+        with self._lock:
+            return self._get(key, dict).get(field)
+
+    def hdel(self, key, *fields):
+        with self._lock:
+            table = self._get(key, dict)
+            return sum(table.pop(field, None) is not None for field in fields)
+
+    def hincrby(self, key, field, amount=1):
+        with self._lock:
+            table = self._get(key, dict)
+            table[field] = int(table.get(field, 0)) + amount
+            return table[field]
+
+    def zadd(self, key, mapping, nx=False, xx=False, gt=False):
+        with self._lock:
+            scores = self._get(key, dict)
+            for member, score in mapping.items():
+                if (nx and member in scores) or (xx and member not in scores):
+                    continue
+                if gt and member in scores and score <= scores[member]:
+                    continue
+                scores[member] = score
+
+    def zscore(self, key, member):
+        with self._lock:
+            return self._get(key, dict).get(member)
+
+    def zrem(self, key, *members):
+        with self._lock:
+            scores = self._get(key, dict)
+            return sum(scores.pop(member, None) is not None for member in members)
+
+    def _zsorted(self, key):
+        return sorted(self._get(key, dict).items(), key=lambda kv: (kv[1], kv[0]))
+
+    def zpopmin(self, key, count=1):
+        with self._lock:
+            popped = self._zsorted(key)[:count]
+            for member, _ in popped:
+                del self._data[key][member]
+            return popped
+
+    def zcard(self, key):
+        with self._lock:
+            return len(self._get(key, dict))
+
+    def zrank(self, key, member):
+        with self._lock:
+            members = [m for m, _ in self._zsorted(key)]
+            return members.index(member) if member in members else None
+
+    def zrange(self, key, start, end, withscores=False):
+        with self._lock:
+            items = self._zsorted(key)[start:None if end == -1 else end + 1]
+            return items if withscores else [m for m, _ in items]
+
+    def zrangebyscore(self, key, low, high):
+        low, high = float(low), float(high)
+        with self._lock:
+            scores = self._get(key, dict)
+            return [m for m, s in sorted(scores.items(), key=lambda kv: kv[1]) if low <= s <= high]
+
+
+def _sqlite_connect(path: str) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+
+@functools.lru_cache(maxsize=None)
+def _redis_client():
+    if REDIS_URL.startswith('fake://'):
+        return FakeRedis()
+    import redis  # Optional dependency: only needed for JOB_STORE/JOB_QUEUE=redis
+    return redis.Redis.from_url(REDIS_URL, decode_responses=True)
+
+
+if JOB_STORE == 'memory':
+    REDIS_URL = 'fake://'
+    job_store: JobStore = MemoryJobStore()
+elif JOB_STORE == 'redis':
+    job_store = RedisJobStore(_redis_client())
+else:
+    job_store = SQLiteJobStore(JOB_DB_PATH)
+job_queue: JobQueue = SQLiteJobQueue(JOB_DB_PATH) if JOB_QUEUE == 'sqlite' else RedisJobQueue(_redis_client())
+print(f"[Startup] Job store: {type(job_store).__name__}, queue: {type(job_queue).__name__}, "
+      f"embedded worker: {EMBEDDED_WORKER} (worker id {WORKER_ID})")
+
+# --- Progress fan-out ---------------------------------------------------------
+# SSE watchers sleep until their job actually changes instead of each polling
+# the job every 500ms. Every save/save_progress on the job store publishes the
+# job id to progress_broker; progress_hook runs in a download thread, so the
+# notification is handed to the event loop with call_soon_threadsafe. Bursts
+# are coalesced twice: at most one notification per job is pending on the loop
+# at a time, and each watcher sends at most one event per
+# SSE_MIN_INTERVAL_SECONDS (always the latest state). Nothing is scheduled for
+# jobs nobody is watching.
+#
+# Jobs running in another process (a standalone queue worker, another uvicorn
+# worker) can't notify us directly, so while a job has watchers here one shared
+# poller per job (not per connection) checks the store every
+# SSE_REMOTE_POLL_SECONDS and publishes when the record changed.
+SSE_MIN_INTERVAL_SECONDS = 0.25
+SSE_KEEPALIVE_SECONDS = 15.0
+SSE_REMOTE_POLL_SECONDS = JOB_PROGRESS_FLUSH_SECONDS
+
+
+class ProgressChannel:
+    """Change counter for one job that watchers can await"""
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.version = 0
+        self.watchers = 0
+        self.poller: Optional[asyncio.Task] = None
+        self.multi_watchers: set = set()  # MultiJobWatch objects following this job
+        self._changed = asyncio.Event()
+
+    def bump(self):
+        self.version += 1
+        self._changed.set()
+        self._changed = asyncio.Event()
+        for multi in self.multi_watchers:
+            multi.mark(self.job_id)
+
+    async def wait_newer(self, seen: int, timeout: float) -> bool:
+        """Wait until version moves past `seen`; False on timeout"""
+        changed = self._changed
+        if self.version != seen:
+            return True
+        try:
+            await asyncio.wait_for(changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+class MultiJobWatch:
+    """One watcher following many jobs (multiplexed SSE)"""
+
+    def __init__(self, broker: 'ProgressBroker'):
+        self._broker = broker
+        self._channels: dict = {}  # job_id -> ProgressChannel
+        self._changed: set = set()
+        self._event = asyncio.Event()
+
+    @property
+    def job_ids(self) -> set:
+        return set(self._channels)
+
+    def mark(self, job_id: str):
+        self._changed.add(job_id)
+        self._event.set()
+
+    def add(self, job_id: str):
+        if job_id not in self._channels:
+            channel = self._broker._acquire(job_id)
+            channel.multi_watchers.add(self)
+            self._channels[job_id] = channel
+            self.mark(job_id)  # Report its current state once
+
+    def remove(self, job_id: str):
+        channel = self._channels.pop(job_id, None)
+        if channel is not None:
+            channel.multi_watchers.discard(self)
+            self._broker._release(channel)
+        self._changed.discard(job_id)
+
+    async def wait(self, timeout: float) -> set:
+        """Return the ids that changed since the last call (empty on timeout)"""
+        if not self._changed:
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self._event.clear()
+        changed, self._changed = self._changed, set()
+        return changed
+
+    def close(self):
+        for job_id in list(self._channels):
+            self.remove(job_id)
+
+
+class ProgressBroker:
+    def __init__(self):
+        self._channels: dict = {}  # job_id -> ProgressChannel
+        self._pending: set = set()  # job_ids with a delivery queued on the loop
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def publish(self, job_id: str):
+        """Signal that a job changed. Safe to call from any thread."""
+        loop = self._loop
+        if loop is None:
+            return
+        with self._lock:
+            if job_id not in self._channels or job_id in self._pending:
+                return
+            self._pending.add(job_id)
+        try:
+            loop.call_soon_threadsafe(self._deliver, job_id)
+        except RuntimeError:
+            pass  # Loop closed (shutdown)
+
+    def _deliver(self, job_id: str):
+        with self._lock:
+            self._pending.discard(job_id)
+            channel = self._channels.get(job_id)
+        if channel is not None:
+            channel.bump()
+
+    def _acquire(self, job_id: str) -> ProgressChannel:
+        self._loop = asyncio.get_running_loop()
+        with self._lock:
+            channel = self._channels.get(job_id)
+            if channel is None:
+                channel = self._channels[job_id] = ProgressChannel(job_id)
+        channel.watchers += 1
+        if channel.poller is None:
+            channel.poller = asyncio.create_task(self._poll_remote(channel))
+        return channel
+
+    def watcher_count(self, job_id: str) -> int:
+        """SSE connections in this process currently following job_id"""
+        channel = self._channels.get(job_id)
+        return channel.watchers if channel is not None else 0
+
+    def _release(self, channel: ProgressChannel):
+        channel.watchers -= 1
+        if channel.watchers == 0:
+            channel.poller.cancel()
+            with self._lock:
+                self._channels.pop(channel.job_id, None)
+
+    @contextlib.asynccontextmanager
+    async def watch(self, job_id: str):
+        channel = self._acquire(job_id)
+        try:
+            yield channel
+        finally:
+            self._release(channel)
+
+    @contextlib.asynccontextmanager
+    async def watch_many(self):
+        multi = MultiJobWatch(self)
+        try:
+            yield multi
+        finally:
+            multi.close()
+
+    async def _poll_remote(self, channel: ProgressChannel):
+        last_seen = None
+        while True:
+            await asyncio.sleep(SSE_REMOTE_POLL_SECONDS)
+            if job_store.is_live(channel.job_id):
+                continue  # Running here: progress_hook notifies us directly
+            job = await asyncio.get_event_loop().run_in_executor(None, job_store.get, channel.job_id)
+            snapshot = job.model_dump_json() if job else None
+            if snapshot != last_seen:
+                last_seen = snapshot
+                channel.bump()
+
+
+progress_broker = ProgressBroker()
+job_store.listener = progress_broker.publish
+
+
+@app.get("/", response_class=HTMLResponse)
+async def home():
+    return """
+    <!DOCTYPE html>
+    <html lang="en">
+    <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <title>YouTube Downloader</title>
+        <style>
+            * {
+                margin: 0;
+                padding: 0;
+                box-sizing: border-box;
+            }
+            body {
+                font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, Cantarell, sans-serif;
+                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+                min-height: 100vh;
+                display: flex;
+                justify-content: center;
+                align-items: center;
+                padding: 20px;
+            }
+            .container {
+                background: white;
+                padding: 40px;
+                border-radius: 16px;
+                box-shadow: 0 20px 60px rgba(0, 0, 0, 0.3);
+                max-width: 500px;
+                width: 100%;
+            }
+            h1 {
+                color: #333;
+                margin-bottom: 10px;
+                font-size: 28px;
+            }
+            .subtitle {
+                color: #666;
+                margin-bottom: 30px;
+                font-size: 14px;
+            }
+            .form-group {
+                margin-bottom: 20px;
+            }
+            label {
+                display: block;
+                margin-bottom: 8px;
+                color: #333;
+                font-weight: 500;
+                font-size: 14px;
+            }
+            input[type="url"], select {
+                width: 100%;
+                padding: 12px;
+                border: 2px solid #e0e0e0;
+                border-radius: 8px;
+                font-size: 14px;
+                transition: border-color 0.3s;
+            }
+            input[type="url"]:focus, select:focus {
+                outline: none;
+                border-color: #667eea;
+            }
+            button {
+                width: 100%;
+                padding: 14px;
+                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+                color: white;
+                border: none;
+                border-radius: 8px;
+                font-size: 16px;
+                font-weight: 600;
+                cursor: pointer;
+                transition: transform 0.2s, box-shadow 0.2s;
+            }
+            button:hover {
+                transform: translateY(-2px);
+                box-shadow: 0 10px 20px rgba(102, 126, 234, 0.4);
+            }
+            button:active {
+                transform: translateY(0);
+            }
+            button:disabled {
+                background: #ccc;
+                cursor: not-allowed;
+                transform: none;
+            }
+            .message {
+                margin-top: 20px;
+                padding: 12px;
+                border-radius: 8px;
+                font-size: 14px;
                 display: none;
             }
             .message.success {
@@ -304,243 +2165,1502 @@ async def home():
             <h1>YouTube Downloader</h1>
             <p class="subtitle">Download YouTube videos in your preferred resolution</p>
 
-            <form id="downloadForm">
-                <div class="form-group">
-                    <label for="url">YouTube URL</label>
-                    <input
-                        type="url"
-                        id="url"
-                        name="url"
-                        placeholder="https://www.youtube.com/watch?v=..."
-                        required
-                    >
-                </div>
+            <form id="downloadForm">
+                <div class="form-group">
+                    <label for="url">YouTube URL</label>
+                    <input
+                        type="url"
+                        id="url"
+                        name="url"
+                        placeholder="https://www.youtube.com/watch?v=..."
+                        required
+                    >
+                </div>
+
+                <div class="form-group">
+                    <label for="resolution">Resolution</label>
+                    <select id="resolution" name="resolution">
+                        <option value="2160p">4K (2160p)</option>
+                        <option value="1440p">2K (1440p)</option>
+                        <option value="1080p" selected>Full HD (1080p)</option>
+                        <option value="720p">HD (720p)</option>
+                        <option value="480p">SD (480p)</option>
+                        <option value="360p">360p</option>
+                        <option value="240p">240p</option>
+                    </select>
+                </div>
+
+                <button type="submit" id="downloadBtn">Download Video</button>
+            </form>
+
+            <div class="loading" id="loading">
+                <div class="spinner"></div>
+                <p style="margin-top: 10px; color: #666;">Downloading...</p>
+            </div>
+
+            <div class="message" id="message"></div>
+        </div>
+
+        <script>
+            const form = document.getElementById('downloadForm');
+            const message = document.getElementById('message');
+            const loading = document.getElementById('loading');
+            const downloadBtn = document.getElementById('downloadBtn');
+
+            form.addEventListener('submit', async (e) => {
+                e.preventDefault();
+
+                const url = document.getElementById('url').value;
+                const resolution = document.getElementById('resolution').value;
+
+                // Hide previous messages
+                message.style.display = 'none';
+                message.className = 'message';
+
+                // Show loading
+                loading.style.display = 'block';
+                downloadBtn.disabled = true;
+
+                try {
+                    const response = await fetch(`/download?url=${encodeURIComponent(url)}&resolution=${resolution}`);
+                    const data = await response.json();
+
+                    loading.style.display = 'none';
+                    downloadBtn.disabled = false;
+
+                    if (response.ok) {
+                        message.className = 'message success';
+                        message.innerHTML = `
+                            ${data.message}<br>
+                            <a href="${data.download_url}" download="${data.filename}"
+                               style="color: #155724; font-weight: bold; text-decoration: underline; margin-top: 10px; display: inline-block;">
+                                Click here to download ${data.filename}
+                            </a>
+                        `;
+                        message.style.display = 'block';
+                        form.reset();
+                        document.getElementById('resolution').value = '1080p';
+                    } else {
+                        message.className = 'message error';
+                        message.textContent = data.detail || 'An error occurred';
+                        message.style.display = 'block';
+                    }
+                } catch (error) {
+                    loading.style.display = 'none';
+                    downloadBtn.disabled = false;
+                    message.className = 'message error';
+                    message.textContent = 'Network error: ' + error.message;
+                    message.style.display = 'block';
+                }
+            });
+        </script>
+    </body>
+    </html>
+    """
+
+# --- Webhook outbox -----------------------------------------------------------
+# Webhooks are not sent inline by the download coroutine. send_webhook() only
+# appends the delivery to a persisted outbox (same backend as the job store), so
+# the download slot is free the moment the file is ready and no delivery is lost
+# to a restart. A dispatcher task in every worker process drains the outbox in
+# batches over ONE long-lived, connection-pooled httpx client (HTTP/2 when the
+# h2 package is installed, keep-alive otherwise) instead of a fresh TCP/TLS
+# handshake per webhook.
+#
+# Failed deliveries are retried with full-jitter exponential backoff
+# (WEBHOOK_BACKOFF_BASE_SECONDS doubling up to WEBHOOK_BACKOFF_MAX_SECONDS); after
+# WEBHOOK_MAX_ATTEMPTS they move to a dead-letter list (GET /webhooks/dead-letters)
+# from which they can be re-driven. Claimed deliveries carry a lease like queued
+# jobs, so a dispatcher that dies mid-batch doesn't lose them, and receivers can
+# de-duplicate on the X-Webhook-Delivery header.
+WEBHOOK_BATCH_SIZE = 50
+WEBHOOK_MAX_ATTEMPTS = 8
+WEBHOOK_BACKOFF_BASE_SECONDS = 1.0
+WEBHOOK_BACKOFF_MAX_SECONDS = 300.0
+WEBHOOK_TIMEOUT_SECONDS = 30.0
+WEBHOOK_LEASE_SECONDS = WEBHOOK_TIMEOUT_SECONDS * 2
+WEBHOOK_POLL_SECONDS = 1.0
+
+
+def _webhook_backoff(attempts: int) -> float:
+    return random.uniform(0, min(WEBHOOK_BACKOFF_MAX_SECONDS, WEBHOOK_BACKOFF_BASE_SECONDS * 2 ** attempts))
+
+
+class WebhookOutbox:
+    """Interface for the persisted webhook outbox. Implementations must be thread-safe."""
+
+    def add(self, url: str, payload: dict) -> str:
+        raise NotImplementedError
+
+    def claim_due(self, worker_id: str, limit: int) -> list:
+        """Lease up to `limit` due deliveries: [{"id", "url", "payload", "attempts"}]"""
+        raise NotImplementedError
+
+    def delivered(self, delivery_id: str):
+        raise NotImplementedError
+
+    def failed(self, delivery_id: str, error: str):
+        """Schedule a retry, or dead-letter the delivery after WEBHOOK_MAX_ATTEMPTS"""
+        raise NotImplementedError
+
+    def dead_letters(self) -> list:
+        raise NotImplementedError
+
+    def redrive(self, delivery_id: str) -> bool:
+        """Move a dead letter back to the outbox with a fresh attempt budget"""
+        raise NotImplementedError
+
+
+class SQLiteWebhookOutbox(WebhookOutbox):
+    def __init__(self, path: str):
+        self._db = _sqlite_connect(path)
+        self._lock = threading.Lock()
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS webhook_outbox (
+                delivery_id TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                lease_owner TEXT,
+                last_error TEXT,
+                dead INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS webhook_outbox_due ON webhook_outbox (dead, next_attempt_at);
+        """)
+
+    def add(self, url: str, payload: dict) -> str:
+        delivery_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO webhook_outbox (delivery_id, url, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                (delivery_id, url, json.dumps(payload), now, now))
+        return delivery_id
+
+    def claim_due(self, worker_id: str, limit: int) -> list:
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                # A leased delivery is pushed WEBHOOK_LEASE_SECONDS into the
+                # future; if its dispatcher dies it simply becomes due again.
+                rows = self._db.execute(
+                    "SELECT delivery_id, url, payload, attempts FROM webhook_outbox "
+                    "WHERE dead = 0 AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+                    (now, limit)).fetchall()
+                self._db.executemany(
+                    "UPDATE webhook_outbox SET lease_owner = ?, next_attempt_at = ? WHERE delivery_id = ?",
+                    [(worker_id, now + WEBHOOK_LEASE_SECONDS, row[0]) for row in rows])
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return [{"id": r[0], "url": r[1], "payload": json.loads(r[2]), "attempts": r[3]} for r in rows]
+
+    def delivered(self, delivery_id: str):
+        with self._lock:
+            self._db.execute("DELETE FROM webhook_outbox WHERE delivery_id = ?", (delivery_id,))
+
+    def failed(self, delivery_id: str, error: str):
+        with self._lock:
+            row = self._db.execute("SELECT attempts FROM webhook_outbox WHERE delivery_id = ?",
+                                   (delivery_id,)).fetchone()
+            if row is None:
+                return
+            attempts = row[0] + 1
+            self._db.execute(
+                "UPDATE webhook_outbox SET attempts = ?, last_error = ?, lease_owner = NULL, "
+                "next_attempt_at = ?, dead = ? WHERE delivery_id = ?",
+                (attempts, error, time.time() + _webhook_backoff(attempts),
+                 int(attempts >= WEBHOOK_MAX_ATTEMPTS), delivery_id))
+
+    def dead_letters(self) -> list:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT delivery_id, url, payload, attempts, last_error, created_at FROM webhook_outbox "
+                "WHERE dead = 1 ORDER BY created_at").fetchall()
+        return [{"id": r[0], "url": r[1], "payload": json.loads(r[2]), "attempts": r[3], "last_error": r[4],
+                 "created_at": datetime.fromtimestamp(r[5]).isoformat()} for r in rows]
+
+    def redrive(self, delivery_id: str) -> bool:
+        with self._lock:
+            cur = self._db.execute(
+                "UPDATE webhook_outbox SET dead = 0, attempts = 0, next_attempt_at = ? "
+                "WHERE delivery_id = ? AND dead = 1", (time.time(), delivery_id))
+        return cur.rowcount == 1
+
+
+class RedisWebhookOutbox(WebhookOutbox):
+    """Deliveries in a hash; due times in a zset; claims won by whoever ZREMs first"""
+
+    DATA = 'dl:webhooks:data'       # hash delivery_id -> JSON record
+    DUE = 'dl:webhooks:due'         # zset delivery_id -> next attempt time
+    INFLIGHT = 'dl:webhooks:leases'  # zset delivery_id -> lease expiry
+    DEAD = 'dl:webhooks:dead'       # zset delivery_id -> time it died
+
+    def __init__(self, client):
+        self._redis = client
+
+    def _record(self, delivery_id: str) -> Optional[dict]:
+        data = self._redis.hget(self.DATA, delivery_id)
+        return json.loads(data) if data else None
+
+    def add(self, url: str, payload: dict) -> str:
+        delivery_id = uuid.uuid4().hex
+        record = {"url": url, "payload": payload, "attempts": 0, "last_error": None, "created_at": time.time()}
+        self._redis.hset(self.DATA, delivery_id, json.dumps(record))
+        self._redis.zadd(self.DUE, {delivery_id: time.time()})
+        return delivery_id
+
+    def claim_due(self, worker_id: str, limit: int) -> list:
+        now = time.time()
+        for delivery_id in self._redis.zrangebyscore(self.INFLIGHT, '-inf', now):
+            if self._redis.zrem(self.INFLIGHT, delivery_id):
+                self._redis.zadd(self.DUE, {delivery_id: now})
+        claimed = []
+        for delivery_id in self._redis.zrangebyscore(self.DUE, '-inf', now)[:limit]:
+            if not self._redis.zrem(self.DUE, delivery_id):
+                continue  # Another dispatcher won it
+            self._redis.zadd(self.INFLIGHT, {delivery_id: now + WEBHOOK_LEASE_SECONDS})
+            record = self._record(delivery_id)
+            if record is not None:
+                claimed.append({"id": delivery_id, "url": record["url"], "payload": record["payload"],
+                                "attempts": record["attempts"]})
+        return claimed
+
+    def delivered(self, delivery_id: str):
+        self._redis.zrem(self.INFLIGHT, delivery_id)
+        self._redis.hdel(self.DATA, delivery_id)
+
+    def failed(self, delivery_id: str, error: str):
+        record = self._record(delivery_id)
+        if record is None:
+            return
+        record["attempts"] += 1
+        record["last_error"] = error
+        self._redis.hset(self.DATA, delivery_id, json.dumps(record))
+        self._redis.zrem(self.INFLIGHT, delivery_id)
+        if record["attempts"] >= WEBHOOK_MAX_ATTEMPTS:
+            self._redis.zadd(self.DEAD, {delivery_id: time.time()})
+        else:
+            self._redis.zadd(self.DUE, {delivery_id: time.time() + _webhook_backoff(record["attempts"])})
+
+    def dead_letters(self) -> list:
+        letters = []
+        for delivery_id in self._redis.zrangebyscore(self.DEAD, '-inf', '+inf'):
+            record = self._record(delivery_id)
+            if record is not None:
+                letters.append({"id": delivery_id, "url": record["url"], "payload": record["payload"],
+                                "attempts": record["attempts"], "last_error": record["last_error"],
+                                "created_at": datetime.fromtimestamp(record["created_at"]).isoformat()})
+        return letters
+
+    def redrive(self, delivery_id: str) -> bool:
+        record = self._record(delivery_id)
+        if record is None or not self._redis.zrem(self.DEAD, delivery_id):
+            return False
+        record["attempts"] = 0
+        self._redis.hset(self.DATA, delivery_id, json.dumps(record))
+        self._redis.zadd(self.DUE, {delivery_id: time.time()})
+        return True
+
+
+webhook_outbox: WebhookOutbox = (SQLiteWebhookOutbox(JOB_DB_PATH) if JOB_QUEUE == 'sqlite'
+                                 else RedisWebhookOutbox(_redis_client()))
+webhook_wakeup = asyncio.Event()
+_webhook_client: Optional[httpx.AsyncClient] = None
+
 
-                <div class="form-group">
-                    <label for="resolution">Resolution</label>
-                    <select id="resolution" name="resolution">
-                        <option value="2160p">4K (2160p)</option>
-                        <option value="1440p">2K (1440p)</option>
-                        <option value="1080p" selected>Full HD (1080p)</option>
-                        <option value="720p">HD (720p)</option>
-                        <option value="480p">SD (480p)</option>
-                        <option value="360p">360p</option>
-                        <option value="240p">240p</option>
-                    </select>
-                </div>
+def _get_webhook_client() -> httpx.AsyncClient:
+    global _webhook_client
+    if _webhook_client is None:
+        _webhook_client = httpx.AsyncClient(
+            http2=importlib.util.find_spec('h2') is not None,
+            timeout=WEBHOOK_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=WEBHOOK_BATCH_SIZE, max_keepalive_connections=20,
+                                keepalive_expiry=60.0),
+        )
+    return _webhook_client
 
-                <button type="submit" id="downloadBtn">Download Video</button>
-            </form>
 
-            <div class="loading" id="loading">
-                <div class="spinner"></div>
-                <p style="margin-top: 10px; color: #666;">Downloading...</p>
-            </div>
+async def send_webhook(webhook_url: str, payload: dict) -> str:
+    """Queue a webhook for delivery by the outbox dispatcher; returns its delivery id"""
+    loop = asyncio.get_event_loop()
+    delivery_id = await loop.run_in_executor(None, webhook_outbox.add, webhook_url, payload)
+    webhook_wakeup.set()
+    return delivery_id
 
-            <div class="message" id="message"></div>
-        </div>
 
-        <script>
-            const form = document.getElementById('downloadForm');
-            const message = document.getElementById('message');
-            const loading = document.getElementById('loading');
-            const downloadBtn = document.getElementById('downloadBtn');
+async def _deliver_webhook(delivery: dict):
+    """POST one delivery, then mark it delivered or schedule its retry.
 
-            form.addEventListener('submit', async (e) => {
-                e.preventDefault();
+    Never raises (short of cancellation): whatever goes wrong - a bad URL, a
+    protocol error, a locked database - counts as a failed attempt, so one
+    delivery can't take the dispatcher down with it.
+    """
+    loop = asyncio.get_event_loop()
+    started = time.monotonic()
+    started_at = time.time()
+    error = None
+    try:
+        response = await _get_webhook_client().post(
+            delivery["url"],
+            json=delivery["payload"],
+            headers={"X-Webhook-Delivery": delivery["id"]},
+        )
+        if response.status_code >= 400:
+            error = f"HTTP {response.status_code}"
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        metrics.webhook_seconds.observe(time.monotonic() - started)
 
-                const url = document.getElementById('url').value;
-                const resolution = document.getElementById('resolution').value;
+    try:
+        await loop.run_in_executor(None, _trace_webhook, delivery, started_at, error)
+    except Exception as e:
+        print(f"[Webhook] Failed to trace delivery {delivery['id']}: {e}")
+    try:
+        if error is None:
+            await loop.run_in_executor(None, webhook_outbox.delivered, delivery["id"])
+        else:
+            await loop.run_in_executor(None, webhook_outbox.failed, delivery["id"], error)
+            if delivery["attempts"] + 1 >= WEBHOOK_MAX_ATTEMPTS:
+                print(f"[Webhook] Dead-lettered delivery {delivery['id']} to {delivery['url']}: {error}")
+    except Exception as e:
+        # The lease runs out and the delivery is attempted again
+        print(f"[Webhook] Failed to record delivery {delivery['id']} ({error or 'delivered'}): {e}")
 
-                // Hide previous messages
-                message.style.display = 'none';
-                message.className = 'message';
 
-                // Show loading
-                loading.style.display = 'block';
-                downloadBtn.disabled = true;
+async def run_webhook_dispatcher():
+    """Drain the webhook outbox until cancelled"""
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            batch = await loop.run_in_executor(None, webhook_outbox.claim_due, WORKER_ID, WEBHOOK_BATCH_SIZE)
+        except Exception as e:
+            print(f"[Webhook] Outbox claim failed: {e}")
+            batch = []
+        if not batch:
+            webhook_wakeup.clear()
+            try:
+                await asyncio.wait_for(webhook_wakeup.wait(), timeout=WEBHOOK_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        await asyncio.gather(*(_deliver_webhook(delivery) for delivery in batch))
+
+
+async def _close_webhook_client():
+    global _webhook_client
+    if _webhook_client is not None:
+        await _webhook_client.aclose()
+        _webhook_client = None
+
+
+@app.get("/webhooks/dead-letters")
+async def list_dead_letters():
+    """Webhook deliveries that exhausted their retries"""
+    loop = asyncio.get_event_loop()
+    return {"dead_letters": await loop.run_in_executor(None, webhook_outbox.dead_letters)}
+
+
+@app.post("/webhooks/dead-letters/{delivery_id}/retry")
+async def retry_dead_letter(delivery_id: str):
+    """Put a dead-lettered webhook back in the outbox"""
+    loop = asyncio.get_event_loop()
+    if not await loop.run_in_executor(None, webhook_outbox.redrive, delivery_id):
+        raise HTTPException(status_code=404, detail="Dead letter not found")
+    webhook_wakeup.set()
+    return {"delivery_id": delivery_id, "status": "requeued"}
+
+# --- Retention expiry ---------------------------------------------------------
+# Finished jobs (and with them their file, unless the download cache owns it)
+# are deleted JOB_RETENTION_SECONDS after they finish. Instead of one sleeping
+# task per job, every expiry is a row in a persisted schedule (same backend as
+# the job queue) ordered by due time - an index in SQLite, a sorted set in Redis
+# - and ONE service task per process sleeps until the earliest entry is due,
+# then expires whatever is due in batches. The schedule survives restarts, so
+# nothing is orphaned; due entries are claimed with a lease like webhooks, so
+# processes sharing the backend never expire the same job twice.
+#
+# POST /jobs/{id}/retention pushes a job's expiry back (up to
+# JOB_RETENTION_MAX_SECONDS from now), e.g. while a client is still fetching a
+# large file.
+JOB_RETENTION_MAX_SECONDS = float(os.getenv('JOB_RETENTION_MAX_SECONDS', str(24 * 3600)))
+EXPIRY_BATCH_SIZE = 100
+EXPIRY_LEASE_SECONDS = 60.0
+EXPIRY_POLL_SECONDS = 30.0  # Upper bound on sleeping: other processes may schedule earlier entries
+
+
+class ExpirySchedule:
+    """Interface for the persisted expiry schedule. Implementations must be thread-safe."""
+
+    def schedule(self, job_id: str, expires_at: float):
+        raise NotImplementedError
+
+    def extend(self, job_id: str, expires_at: float) -> Optional[float]:
+        """Move an expiry later (never earlier); the new due time, or None if not scheduled"""
+        raise NotImplementedError
+
+    def expires_at(self, job_id: str) -> Optional[float]:
+        raise NotImplementedError
+
+    def claim_due(self, worker_id: str, limit: int) -> list:
+        """Lease up to `limit` due job ids"""
+        raise NotImplementedError
+
+    def done(self, job_id: str, worker_id: str):
+        raise NotImplementedError
+
+    def next_due(self) -> Optional[float]:
+        raise NotImplementedError
+
+
+class SQLiteExpirySchedule(ExpirySchedule):
+    def __init__(self, path: str):
+        self._db = _sqlite_connect(path)
+        self._lock = threading.Lock()
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS job_expiry (
+                job_id TEXT PRIMARY KEY,
+                expires_at REAL NOT NULL,
+                lease_owner TEXT
+            );
+            CREATE INDEX IF NOT EXISTS job_expiry_due ON job_expiry (expires_at);
+        """)
+
+    def schedule(self, job_id: str, expires_at: float):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO job_expiry (job_id, expires_at) VALUES (?, ?)",
+                             (job_id, expires_at))
+
+    def extend(self, job_id: str, expires_at: float) -> Optional[float]:
+        with self._lock:
+            # A leased entry is being expired right now: too late to extend it
+            self._db.execute(
+                "UPDATE job_expiry SET expires_at = MAX(expires_at, ?) WHERE job_id = ? AND lease_owner IS NULL",
+                (expires_at, job_id))
+            row = self._db.execute("SELECT expires_at FROM job_expiry WHERE job_id = ? AND lease_owner IS NULL",
+                                   (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def expires_at(self, job_id: str) -> Optional[float]:
+        with self._lock:
+            row = self._db.execute("SELECT expires_at FROM job_expiry WHERE job_id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def claim_due(self, worker_id: str, limit: int) -> list:
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                # Claiming pushes the entry EXPIRY_LEASE_SECONDS ahead; if this
+                # process dies before it's done, the entry simply comes due again.
+                rows = self._db.execute(
+                    "SELECT job_id FROM job_expiry WHERE expires_at <= ? ORDER BY expires_at LIMIT ?",
+                    (now, limit)).fetchall()
+                self._db.executemany(
+                    "UPDATE job_expiry SET lease_owner = ?, expires_at = ? WHERE job_id = ?",
+                    [(worker_id, now + EXPIRY_LEASE_SECONDS, row[0]) for row in rows])
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return [row[0] for row in rows]
+
+    def done(self, job_id: str, worker_id: str):
+        with self._lock:
+            self._db.execute("DELETE FROM job_expiry WHERE job_id = ? AND lease_owner = ?", (job_id, worker_id))
+
+    def next_due(self) -> Optional[float]:
+        with self._lock:
+            return self._db.execute("SELECT MIN(expires_at) FROM job_expiry").fetchone()[0]
+
+
+class RedisExpirySchedule(ExpirySchedule):
+    """Due times in a zset; claims won by whoever ZREMs first"""
+
+    DUE = 'dl:expiry:due'        # zset job_id -> expiry time
+    INFLIGHT = 'dl:expiry:leases'  # zset job_id -> lease expiry
+
+    def __init__(self, client):
+        self._redis = client
+
+    def schedule(self, job_id: str, expires_at: float):
+        self._redis.zadd(self.DUE, {job_id: expires_at})
+
+    def extend(self, job_id: str, expires_at: float) -> Optional[float]:
+        self._redis.zadd(self.DUE, {job_id: expires_at}, xx=True, gt=True)
+        return self._redis.zscore(self.DUE, job_id)
+
+    def expires_at(self, job_id: str) -> Optional[float]:
+        return self._redis.zscore(self.DUE, job_id) or self._redis.zscore(self.INFLIGHT, job_id)
+
+    def claim_due(self, worker_id: str, limit: int) -> list:
+        now = time.time()
+        for job_id in self._redis.zrangebyscore(self.INFLIGHT, '-inf', now):
+            if self._redis.zrem(self.INFLIGHT, job_id):
+                self._redis.zadd(self.DUE, {job_id: now})
+        claimed = []
+        for job_id in self._redis.zrangebyscore(self.DUE, '-inf', now)[:limit]:
+            if self._redis.zrem(self.DUE, job_id):  # Otherwise another process won it
+                self._redis.zadd(self.INFLIGHT, {job_id: now + EXPIRY_LEASE_SECONDS})
+                claimed.append(job_id)
+        return claimed
+
+    def done(self, job_id: str, worker_id: str):
+        self._redis.zrem(self.INFLIGHT, job_id)
+
+    def next_due(self) -> Optional[float]:
+        due = [score for _, score in self._redis.zrange(self.DUE, 0, 0, withscores=True)]
+        due += [score for _, score in self._redis.zrange(self.INFLIGHT, 0, 0, withscores=True)]
+        return min(due) if due else None
+
+
+expiry_schedule: ExpirySchedule = (SQLiteExpirySchedule(JOB_DB_PATH) if JOB_QUEUE == 'sqlite'
+                                   else RedisExpirySchedule(_redis_client()))
+expiry_wakeup = asyncio.Event()
+
+
+def _schedule_expiry(job_id: str, delay: float = JOB_RETENTION_SECONDS):
+    expiry_schedule.schedule(job_id, time.time() + delay)
+    expiry_wakeup.set()
+
+
+def _reconcile_expiry():
+    """Schedule finished jobs that have no expiry yet (e.g. finished before an upgrade)"""
+    now = datetime.now()
+    for job in job_store.list_by_status(*FINISHED_STATUSES):
+        if expiry_schedule.expires_at(job.job_id) is None:
+            age = (now - job.completed_at).total_seconds() if job.completed_at else JOB_RETENTION_SECONDS
+            _schedule_expiry(job.job_id, max(0.0, JOB_RETENTION_SECONDS - age))
+
+
+def _expire_job(job_id: str):
+    job = job_store.delete(job_id)
+    if job and job.result:
+        filename = job.result.get("filename")
+        if filename:
+            _release_download_file(filename)
+
+
+async def run_expiry_service():
+    """Expire finished jobs as their retention runs out, until cancelled"""
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            due = await loop.run_in_executor(None, expiry_schedule.claim_due, WORKER_ID, EXPIRY_BATCH_SIZE)
+            for job_id in due:
+                await loop.run_in_executor(None, _expire_job, job_id)
+                await loop.run_in_executor(None, expiry_schedule.done, job_id, WORKER_ID)
+            if len(due) == EXPIRY_BATCH_SIZE:
+                continue  # More may be due already
+            next_due = await loop.run_in_executor(None, expiry_schedule.next_due)
+        except Exception as e:
+            print(f"[Expiry] Failed: {e}")
+            next_due = None
+        delay = EXPIRY_POLL_SECONDS if next_due is None else min(max(0.0, next_due - time.time()), EXPIRY_POLL_SECONDS)
+        expiry_wakeup.clear()
+        try:
+            await asyncio.wait_for(expiry_wakeup.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+# --- Admission scheduler ------------------------------------------------------
+# Replaces the fixed 5-slot download_semaphore. Downloads (and pipe streams) in
+# this process wait for a slot in order of priority class, then per-owner fair
+# share (an owner's n-th outstanding job queues behind everyone else's first
+# n-1), then arrival.
+#
+# The number of slots adapts (AIMD) every ADMISSION_ADJUST_SECONDS:
+#   - 403 rate above ADMISSION_MAX_403_RATE or CPU load (1-minute load average
+#     per core) above ADMISSION_MAX_LOAD: multiplicative decrease
+#   - otherwise, while jobs are waiting for a slot: add one slot, and keep it
+#     only if aggregate download throughput actually grew in the next interval.
+#     If it didn't, the link (or proxy) is saturated: drop the slot again and
+#     don't probe for ADMISSION_COOLDOWN_TICKS intervals.
+# Waiting jobs get queue_position / estimated_start, from the average time a
+# download holds a slot.
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv('MAX_CONCURRENT_DOWNLOADS', '5'))  # Starting point
+MAX_CONCURRENT_DOWNLOADS_CAP = int(os.getenv('MAX_CONCURRENT_DOWNLOADS_CAP', '16'))
+ADMISSION_ADJUST_SECONDS = 10.0
+ADMISSION_MAX_403_RATE = 0.2
+ADMISSION_MAX_LOAD = 0.9
+ADMISSION_DECREASE = 0.7
+ADMISSION_MIN_GAIN = 1.05  # An extra slot must add 5% throughput to stay
+ADMISSION_COOLDOWN_TICKS = 6
+ADMISSION_DEFAULT_HOLD_SECONDS = 60.0  # Slot hold time assumed until measured
+
+
+PRIORITY_ORDER = {JobPriority.HIGH: 0, JobPriority.NORMAL: 1, JobPriority.LOW: 2}
+
+
+class _SlotWaiter:
+    def __init__(self, job: Optional[Job]):
+        self.job = job
+        self.granted = asyncio.get_event_loop().create_future()
+
+
+class AdmissionScheduler:
+    """Adaptive concurrency limit with priority classes and per-owner fair queuing"""
+
+    def __init__(self, initial: int, maximum: int):
+        self.limit = max(1, min(initial, maximum))
+        self.maximum = maximum
+        self.running = 0
+        self._waiters = []  # heap of (priority, owner_rank, seq, _SlotWaiter)
+        self._seq = 0
+        self._owner_load: dict = {}  # owner -> jobs waiting or running here
+        self._avg_hold = ADMISSION_DEFAULT_HOLD_SECONDS
+        # Fed from download threads
+        self._stats_lock = threading.Lock()
+        self._bytes = 0
+        self._attempts = 0
+        self._forbidden = 0
+        self.throughput = 0.0  # Bytes/s over the last interval
+        self._probe_baseline: Optional[float] = None
+        self._cooldown = 0
+        self._report()
+
+    # Called from download threads
+    def record_bytes(self, count: int):
+        with self._stats_lock:
+            self._bytes += count
+
+    def record_attempt(self, forbidden: bool):
+        with self._stats_lock:
+            self._attempts += 1
+            self._forbidden += forbidden
+
+    @property
+    def waiting(self) -> int:
+        return sum(not w.granted.done() for *_, w in self._waiters)
+
+    def estimate_start(self, position: int) -> datetime:
+        """When the job at 1-based `position` in line should get a slot"""
+        return datetime.now() + timedelta(seconds=position * self._avg_hold / self.limit)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: JobPriority = JobPriority.NORMAL, owner: Optional[str] = None,
+                   job: Optional[Job] = None):
+        owner = owner or ''
+        owner_rank = self._owner_load.get(owner, 0)
+        self._owner_load[owner] = owner_rank + 1
+        try:
+            waiter = _SlotWaiter(job)
+            self._seq += 1
+            heapq.heappush(self._waiters, (PRIORITY_ORDER[priority], owner_rank, self._seq, waiter))
+            queued = time.monotonic()
+            self._dispatch()
+            if not waiter.granted.done():
+                self._publish_positions()
+                try:
+                    await waiter.granted
+                except asyncio.CancelledError:
+                    if waiter.granted.done() and not waiter.granted.cancelled():
+                        self._release()  # Granted just as we were cancelled
+                    else:
+                        waiter.granted.cancel()  # _dispatch skips it
+                        self._report()
+                    raise
+            started = time.monotonic()
+            metrics.slot_wait_seconds.labels(priority=priority.value).observe(started - queued)
+            _trace_span(job, "slot_wait", time.time() - (started - queued), priority=priority.value)
+            try:
+                yield
+            finally:
+                held = time.monotonic() - started
+                self._avg_hold += 0.2 * (held - self._avg_hold)
+                self._release()
+        finally:
+            self._owner_load[owner] -= 1
+            if not self._owner_load[owner]:
+                del self._owner_load[owner]
+
+    def _release(self):
+        self.running -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        granted = False
+        while self._waiters and self.running < self.limit:
+            *_, waiter = heapq.heappop(self._waiters)
+            if waiter.granted.done():
+                continue  # Cancelled while waiting
+            self.running += 1
+            waiter.granted.set_result(True)
+            if waiter.job is not None:
+                waiter.job.queue_position = None
+                waiter.job.estimated_start = None
+            granted = True
+        if granted:
+            self._publish_positions()
+        self._report()
+
+    def _report(self):
+        metrics.slots.set(self.limit)
+        metrics.slots_busy.set(self.running)
+        metrics.slot_waiters.set(self.waiting)
+
+    def _publish_positions(self):
+        position = 0
+        for *_, waiter in sorted(self._waiters, key=lambda entry: entry[:3]):
+            if waiter.granted.done():
+                continue
+            position += 1
+            if waiter.job is not None:
+                waiter.job.queue_position = position
+                waiter.job.estimated_start = self.estimate_start(position)
+                job_store.save_progress(waiter.job)
+
+    def adjust(self, interval: float):
+        """One AIMD step from the stats gathered over the last interval"""
+        with self._stats_lock:
+            transferred, attempts, forbidden = self._bytes, self._attempts, self._forbidden
+            self._bytes = self._attempts = self._forbidden = 0
+        throughput = transferred / interval
+        forbidden_rate = forbidden / attempts if attempts >= 3 else 0.0
+        load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        saturated = self.waiting > 0 and self.running >= self.limit
+        previous = self.limit
+
+        if forbidden_rate > ADMISSION_MAX_403_RATE or load > ADMISSION_MAX_LOAD:
+            self.limit = max(1, int(self.limit * ADMISSION_DECREASE))
+            self._probe_baseline = None
+        elif self._probe_baseline is not None:
+            if throughput < self._probe_baseline * ADMISSION_MIN_GAIN:
+                self.limit = max(1, self.limit - 1)
+                self._cooldown = ADMISSION_COOLDOWN_TICKS
+            self._probe_baseline = None
+        elif saturated and not self._cooldown and self.limit < self.maximum:
+            self._probe_baseline = throughput
+            self.limit += 1
+        self._cooldown = max(0, self._cooldown - 1)
+        self.throughput = throughput
+
+        if self.limit != previous:
+            print(f"[Admission] Concurrency {previous} -> {self.limit} "
+                  f"({throughput / 1024 ** 2:.1f} MB/s, 403 rate {forbidden_rate:.0%}, load {load:.2f}/core)")
+            self._dispatch()
+            self._publish_positions()
+
+
+admission = AdmissionScheduler(MAX_CONCURRENT_DOWNLOADS, MAX_CONCURRENT_DOWNLOADS_CAP)
+
+
+async def run_admission_controller():
+    while True:
+        await asyncio.sleep(ADMISSION_ADJUST_SECONDS)
+        try:
+            admission.adjust(ADMISSION_ADJUST_SECONDS)
+        except Exception as e:
+            print(f"[Admission] Adjust failed: {e}")
+
+
+# --- Job trace ----------------------------------------------------------------
+# Each job records a span per stage - queue wait, cache lookup, slot wait, and per
+# proxy attempt the extraction, the transfer and the merge (with the proxy and the
+# format chosen), then each webhook delivery - so GET /jobs/{id}/trace shows where
+# the time went. Spans are appended to the live Job at stage boundaries only (never
+# from progress events) and persisted with the job's next save. The timeline can
+# also be exported as OTLP/JSON (?format=otel) for an OpenTelemetry backend.
+TRACE_MAX_SPANS = 100  # Per job; bounds the record when a job retries over and over
+
+
+def _trace_span(job: Optional[Job], name: str, started: float, ended: Optional[float] = None, **attributes):
+    """Append a span to job.trace; `started`/`ended` are time.time() readings"""
+    if job is None or len(job.trace) >= TRACE_MAX_SPANS:
+        return
+    job.trace.append({
+        "name": name,
+        "start": started,
+        "end": time.time() if ended is None else ended,
+        "attributes": {key: value for key, value in attributes.items() if value is not None},
+    })
+
+
+def _trace_timeline(job: Job) -> dict:
+    spans = sorted(job.trace, key=lambda span: span["start"])
+    return {
+        "job_id": job.job_id,
+        "status": job.status,
+        "created_at": job.created_at.isoformat(),
+        "completed_at": job.completed_at.isoformat() if job.completed_at else None,
+        "spans": [{
+            "name": span["name"],
+            "start": datetime.fromtimestamp(span["start"]).isoformat(),
+            "end": datetime.fromtimestamp(span["end"]).isoformat(),
+            "duration_seconds": round(span["end"] - span["start"], 3),
+            "attributes": span["attributes"],
+        } for span in spans],
+    }
+
+
+def _otel_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}  # int64 is a string in OTLP/JSON
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otel_attributes(attributes: dict) -> list:
+    return [{"key": key, "value": _otel_value(value)} for key, value in attributes.items() if value is not None]
+
+
+def _otel_trace(job: Job) -> dict:
+    """The job as one OTLP/JSON trace: a root "job" span with the stage spans under it"""
+    trace_id = uuid.uuid5(uuid.NAMESPACE_URL, job.job_id).hex
+    root_id = f"{1:016x}"
+
+    def span(span_id, name, started, ended, attributes, parent=None):
+        otel = {
+            "traceId": trace_id,
+            "spanId": span_id,
+            "name": name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(int(started * 1e9)),
+            "endTimeUnixNano": str(int(ended * 1e9)),
+            "attributes": _otel_attributes(attributes),
+            "status": {"code": 2 if attributes.get("error") else 1},  # ERROR / OK
+        }
+        if parent:
+            otel["parentSpanId"] = parent
+        return otel
+
+    ended = job.completed_at.timestamp() if job.completed_at else time.time()
+    spans = [span(root_id, "job", job.created_at.timestamp(), ended, {
+        "job.id": job.job_id, "job.status": job.status.value, "video.url": job.url,
+        "video.resolution": job.resolution, "error": job.error,
+    })]
+    spans += [span(f"{index:016x}", item["name"], item["start"], item["end"], item["attributes"], root_id)
+              for index, item in enumerate(job.trace, start=2)]
+    return {"resourceSpans": [{
+        "resource": {"attributes": _otel_attributes({"service.name": "download-youtube",
+                                                      "service.instance.id": WORKER_ID})},
+        "scopeSpans": [{"scope": {"name": "download-youtube"}, "spans": spans}],
+    }]}
+
+
+def _trace_webhook(delivery: dict, started: float, error: Optional[str]):
+    job = job_store.get(delivery["payload"].get("job_id"))
+    if job is None:
+        return  # Expired meanwhile
+    _trace_span(job, "webhook", started, attempt=delivery["attempts"] + 1,
+                event=delivery["payload"].get("status"), error=error)
+    job_store.save(job)
+
+
+# Background download worker
+def _format_selector(resolution: str) -> str:
+    """yt-dlp format string for a '1080p'-style resolution (AVC + m4a preferred)"""
+    height = resolution.replace('p', '')
+    return f'bestvideo[height<={height}][vcodec^=avc]+bestaudio[ext=m4a]/bestvideo[height<={height}]+bestaudio/best[height<={height}]/best'
+
+
+def _format_limits(resolution: str, max_filesize_mb: Optional[float] = None, max_fps: Optional[float] = None,
+                   max_bitrate_kbps: Optional[float] = None) -> Optional[dict]:
+    """Caps for capped format selection (see _smallest_fitting_formats), or None"""
+    if not (max_filesize_mb or max_fps or max_bitrate_kbps):
+        return None
+    height = resolution.replace('p', '')
+    return {
+        'height': int(height) if height.isdigit() else None,
+        'filesize': int(max_filesize_mb * 1024 ** 2) if max_filesize_mb else None,
+        'fps': max_fps or None,
+        'tbr': max_bitrate_kbps or None,
+    }
+
+
+def _job_format_limits(job: Job) -> Optional[dict]:
+    return _format_limits(job.resolution, job.max_filesize_mb, job.max_fps, job.max_bitrate_kbps)
+
+
+def _ydl_opts(format_selector: str, proxy: Optional[ProxyEndpoint] = None) -> dict:
+    """yt-dlp options shared by downloads and metadata lookups"""
+    opts = {
+        'format': format_selector,
+        # Download ONLY the single video, never the surrounding playlist.
+        # YouTube "watch" URLs often carry &list=... (a real playlist, or an
+        # RD... radio/autoplay list). Without this, yt-dlp downloads every
+        # item in the list back-to-back — the client sees the progress bar
+        # loop 0->100% then restart on the next track, effectively forever.
+        'noplaylist': True,
+        'quiet': True,
+        'no_warnings': True,
+        # Cap individual socket reads so a hung connection to YouTube raises
+        # [Errno 60]-style timeouts instead of blocking the worker thread
+        # forever (which left jobs wedged in "downloading" with no webhook).
+        'socket_timeout': 30,
+        'js_runtimes': {'node': {}},
+        'remote_components': {'ejs:github': {}},
+    }
+    if proxy is not None:
+        opts['proxy'] = proxy.url
+    return opts
+
+
+async def _complete_job(job: Job, result: dict):
+    if job.status == JobStatus.CANCELLED:
+        return  # Cancelled while its download went on for coalesced followers
+    metrics.jobs.labels(outcome='completed', error_class='').inc()
+    job.status = JobStatus.COMPLETED
+    job.completed_at = datetime.now()
+    job.progress_percent = 100
+    job.result = result
+    await asyncio.get_event_loop().run_in_executor(None, job_store.save, job)
+
+    # Send webhook if configured
+    if job.webhook_url:
+        await send_webhook(job.webhook_url, {
+            "job_id": job.job_id,
+            "status": "completed",
+            "title": result["title"],
+            "resolution": result["resolution"],
+            "download_url": result["download_url"],
+            "filename": result["filename"],
+            "filesize": result.get("filesize"),  # Absent from results cached before it was recorded
+        })
+
+
+async def _fail_job(job: Job, error: str, error_class: Optional[str] = None):
+    if job.status == JobStatus.CANCELLED:
+        return
+    metrics.jobs.labels(outcome='failed', error_class=error_class or 'Exception').inc()
+    job.status = JobStatus.FAILED
+    job.completed_at = datetime.now()
+    job.error = error
+    job.error_class = error_class
+    await asyncio.get_event_loop().run_in_executor(None, job_store.save, job)
+
+    # Send failure webhook if configured
+    if job.webhook_url:
+        await send_webhook(job.webhook_url, {
+            "job_id": job.job_id,
+            "status": "failed",
+            "error": error
+        })
+
+
+async def _cancel_job(job: Job, reason: str = "Cancelled by client"):
+    if job.status in FINISHED_STATUSES:
+        return
+    metrics.jobs.labels(outcome='cancelled', error_class='').inc()
+    job.status = JobStatus.CANCELLED
+    job.completed_at = datetime.now()
+    job.error = reason
+    job.queue_position = None
+    job.estimated_start = None
+    await asyncio.get_event_loop().run_in_executor(None, job_store.save, job)
+
+    # Send cancellation webhook if configured
+    if job.webhook_url:
+        await send_webhook(job.webhook_url, {
+            "job_id": job.job_id,
+            "status": "cancelled",
+            "error": reason
+        })
+
+
+# --- In-flight coalescing -----------------------------------------------------
+# The Billboard server often fires several POST /download calls for the same
+# video within seconds. Only the first job (the "leader") for a cache key runs
+# yt-dlp; later jobs attach to it as followers, mirror its status/progress into
+# their own Job records and complete (each with its own webhook) when the shared
+# download finishes. Followers never take an admission slot.
+class InflightDownload:
+    def __init__(self, leader: Job):
+        self.leader = leader
+        self.followers: list = []
+        self.done = asyncio.get_event_loop().create_future()
+
+    def attach(self, job: Job):
+        _mirror_progress(self.leader, job)
+        job.status = self.leader.status
+        job_store.save(job)
+        self.followers.append(job)
+
+
+inflight_downloads: dict = {}  # cache key -> InflightDownload
+
+
+def _mirror_progress(source: Job, target: Job):
+    target.progress_percent = source.progress_percent
+    target.downloaded_bytes = source.downloaded_bytes
+    target.total_bytes = source.total_bytes
+    target.speed = source.speed
+    target.eta = source.eta
+    target.stream_file = source.stream_file
+    target.stream_limit = source.stream_limit
+    target.stream_generation = source.stream_generation
+    job_store.save_progress(target)
+
+
+async def _follow_inflight(job: Job, flight: InflightDownload):
+    print(f"[Download] Job {job.job_id} attached to in-flight job {flight.leader.job_id}")
+    started = time.time()
+    try:
+        result = await asyncio.shield(flight.done)
+    except asyncio.CancelledError:
+        flight.followers.remove(job)  # Cancelled: the leader carries on without it
+        if not flight.followers and flight.leader.status == JobStatus.CANCELLED:
+            _cancel_running(flight.leader.job_id)  # Nobody wants the download any more
+        raise
+    except Exception as e:
+        _trace_span(job, "follow_inflight", started, leader=flight.leader.job_id, error=str(e))
+        await _fail_job(job, str(e), flight.leader.error_class or type(e).__name__)
+    else:
+        _trace_span(job, "follow_inflight", started, leader=flight.leader.job_id)
+        await _complete_job(job, result)
+    finally:
+        _schedule_expiry(job.job_id)
+
+
+async def _reserve_disk_space(job: Job, flight: InflightDownload):
+    """Reserve job.disk_bytes, holding the job (and its followers) queued until it fits.
+
+    The size comes from an earlier attempt (or run) of the job, so waiting
+    costs no extraction; the next attempt re-checks it against its own.
+    """
+    loop = asyncio.get_event_loop()
+    started = None
+    while True:
+        disk_space_freed.clear()
+        try:
+            await loop.run_in_executor(None, disk_budget.reserve, job.job_id, job.output_stem, job.disk_bytes)
+            break
+        except DiskSpaceWait:
+            pass
+        if started is None:
+            started = time.time()
+            print(f"[Disk] Job {job.job_id} waiting for {job.disk_bytes / 1024 ** 2:.0f} MB of disk space")
+            for waiting in [job, *flight.followers]:
+                if waiting.status == JobStatus.CANCELLED:
+                    continue
+                waiting.status = JobStatus.QUEUED
+                waiting.eta = "Waiting for disk space"
+                await loop.run_in_executor(None, job_store.save, waiting)
+        try:
+            await asyncio.wait_for(disk_space_freed.wait(), DISK_WAIT_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+    if started is not None:
+        _trace_span(job, "disk_wait", started, bytes=job.disk_bytes)
+
+
+class JobDeadlineExceeded(Exception):
+    """The download ran past JOB_MAX_SECONDS"""
+
+
+async def download_worker(job_id: str):
+    """Process download in background with concurrency limiting"""
+    loop = asyncio.get_event_loop()
+    job = await loop.run_in_executor(None, job_store.get, job_id)
+    _trace_span(job, "queued", job.created_at.timestamp(), worker=WORKER_ID)
+
+    # Cache check happens before taking a download slot: a hit costs nothing.
+    format_selector = _format_selector(job.resolution)
+    lookup_started = time.time()
+    cache_key = await loop.run_in_executor(None, _cache_key, job.url, format_selector, _job_format_limits(job))
+    cached = await loop.run_in_executor(None, download_cache.lookup, cache_key)
+    _trace_span(job, "cache_lookup", lookup_started, hit=cached is not None)
+    if cached is not None:
+        print(f"[Cache] Hit for job {job_id}: {cached['filename']}")
+        await _complete_job(job, cached)
+        _schedule_expiry(job_id)
+        return
+
+    flight = inflight_downloads.get(cache_key) if cache_key else None
+    if flight is not None:
+        flight.attach(job)
+        await _follow_inflight(job, flight)
+        return
+
+    flight = InflightDownload(job)
+    if cache_key:
+        inflight_downloads[cache_key] = flight
+
+    try:
+        while True:
+            if job.disk_bytes is not None:
+                try:
+                    await _reserve_disk_space(job, flight)
+                except DiskSpaceError as e:
+                    flight.done.set_exception(e)
+                    await _fail_job(job, str(e), type(e).__name__)
+                    break
+            try:
+                async with admission.slot(job.priority, job.owner, job):
+                    for running in [job, *flight.followers]:
+                        if running.status == JobStatus.CANCELLED:
+                            continue  # Only still running for its followers
+                        running.status = JobStatus.DOWNLOADING
+                        await loop.run_in_executor(None, job_store.save, running)
+
+                    try:
+                        # Create downloads directory if it doesn't exist
+                        os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+
+                        # The stem is stored with the job, so a re-run after a restart
+                        # (or a lost lease) writes to the same files and resumes them.
+                        if job.output_stem is None:
+                            job.output_stem = str(uuid.uuid4())[:8]
+                            await loop.run_in_executor(None, job_store.save, job)
+                        unique_id = job.output_stem
+
+                        ydl_opts = _ydl_opts(format_selector)
+                        ydl_opts.update({
+                            'outtmpl': os.path.join(DOWNLOADS_DIR, f'{unique_id}_%(title)s.%(ext)s'),
+                            # Just remux the (already-H.264/AAC) streams into an mp4 container.
+                            # The format selector prefers AVC video + m4a audio, so a stream COPY
+                            # is all that's needed — NO re-encode. (Previously this forced
+                            # -c:v libx264 -crf 23, which transcoded every 1080p video: slow and
+                            # CPU-heavy, especially on the Mac mini, and needlessly lossy.)
+                            'merge_output_format': 'mp4',
+                            'postprocessor_args': {
+                                # Applied to the ffmpeg merge step: copy both streams into a
+                                # fragmented MP4 (moov up front, then self-contained fragments)
+                                # so /jobs/{id}/stream can serve the file while ffmpeg is still
+                                # writing it. +faststart needed the whole file before moving
+                                # the moov to the front. If a source stream isn't mp4-compatible,
+                                # yt-dlp/ffmpeg still remuxes into mp4 via merge_output_format.
+                                'merger': ['-c', 'copy', '-movflags', 'frag_keyframe+empty_moov+default_base_moof'],
+                            },
+                            'retries': 1,           # Reduced - we handle retries at app level with proxy rotation
+                            'fragment_retries': 2,  # Keep some for fragment issues
+                            # Resume .part files (and .ytdl fragment state) left by an earlier
+                            # attempt or run from their last byte; _sync_download makes sure
+                            # they belong to the same format first.
+                            'continuedl': True,
+                        })
+
+                        if proxy_pool:
+                            print(f"[Download] Using proxy for job {job_id}")
+                        else:
+                            print(f"[Download] WARNING: No proxy configured for job {job_id}")
+
+                        # yt-dlp runs in a download_pool process, driven from a thread so the
+                        # loop never blocks. Wrap in a wall-clock timeout so a wedged download
+                        # (hung read that never raises) can't leave the job pinned at
+                        # "downloading" indefinitely. Past the deadline the pool process is
+                        # killed (which ends the driving thread too), the job is marked FAILED
+                        # and the failure webhook fires, so the client stops polling forever.
+                        # The deadline is checked itself rather than inferred from a
+                        # TimeoutError, which the download may raise on its own.
+                        download = loop.run_in_executor(
+                            None, lambda: _sync_download(ydl_opts, job.url, job, mirrors=flight.followers))
+                        try:
+                            finished = (await asyncio.wait({download}, timeout=JOB_MAX_SECONDS))[0]
+                        finally:
+                            download.cancel()  # No-op once done; else nobody will read its outcome
+                        if not finished:
+                            raise JobDeadlineExceeded()
+                        result = download.result()
+                        await loop.run_in_executor(None, download_cache.store, cache_key, result)
+                        # Release followers first so their webhooks go out alongside ours.
+                        flight.done.set_result(result)
+                        await _complete_job(job, result)
+
+                    except JobDeadlineExceeded:
+                        download_pool.terminate(job_id)
+                        error = f"Download timed out after {JOB_MAX_SECONDS}s (connection to YouTube stalled)"
+                        print(f"[Download] Job {job_id} force-failed: exceeded {JOB_MAX_SECONDS}s wall-clock cap")
+                        _delete_partial_files(f"{unique_id}_")  # Nothing will resume them
+                        flight.done.set_exception(Exception(error))
+                        await _fail_job(job, error, 'TimeoutError')
+
+                    except asyncio.CancelledError:
+                        # Shutting down or cancelled by the client: don't leave it running
+                        download_pool.terminate(job_id)
+                        if job_id in cancelling_jobs:
+                            _delete_partial_files(f"{unique_id}_")
+                        raise
+
+                    except DiskSpaceWait:
+                        raise  # Keep the partial files: the job resumes them once there is room
+
+                    except Exception as e:
+                        if job.output_stem:
+                            _delete_partial_files(f"{job.output_stem}_")
+                        if not flight.done.done():
+                            flight.done.set_exception(e)
+                        await _fail_job(job, str(e), type(e).__name__)
+                break
+            except DiskSpaceWait:
+                pass  # Hand the slot back to jobs that fit; wait for room above
+
+    finally:
+        if disk_budget.release(job_id):
+            disk_space_freed.set()
+        if cache_key and inflight_downloads.get(cache_key) is flight:
+            del inflight_downloads[cache_key]
+        if not flight.done.done():
+            flight.done.set_exception(Exception("Download was interrupted"))
+        # There may be no followers awaiting the future: mark any exception
+        # as retrieved so asyncio doesn't log "exception never retrieved".
+        flight.done.exception()
+        _schedule_expiry(job_id)
+
+# --- Queue consumer -----------------------------------------------------------
+# Each worker process claims up to WORKER_PREFETCH_FACTOR x its current admission
+# limit of jobs at a time: enough to keep every slot busy while cache hits and
+# coalesced followers (which need no slot) pass through, without hoarding jobs
+# another worker could start sooner.
+WORKER_PREFETCH_FACTOR = 2
+
+# Set by the enqueueing endpoints so an embedded consumer picks new work up
+# immediately instead of on its next poll.
+queue_wakeup = asyncio.Event()
+
+
+async def _enqueue_job(job: Job):
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, job_queue.enqueue, job.job_id, PRIORITY_ORDER[job.priority], job.owner)
+    queue_wakeup.set()
+
+
+async def _wait_for_job(job_id: str) -> Optional[Job]:
+    """Wait (without blocking the loop) until a job finishes or disappears"""
+    async with progress_broker.watch(job_id) as channel:
+        while True:
+            seen = channel.version
+            job = await asyncio.get_event_loop().run_in_executor(None, job_store.get, job_id)
+            if job is None or job.status in FINISHED_STATUSES:
+                return job
+            await channel.wait_newer(seen, SSE_KEEPALIVE_SECONDS)
+
+
+async def _heartbeat_lease(job_id: str):
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        if not await loop.run_in_executor(None, job_queue.heartbeat, job_id, WORKER_ID):
+            print(f"[Queue] WARNING: Lost the lease on job {job_id}; another worker may run it again")
+            return
+
+
+async def _run_claimed_job(job_id: str):
+    loop = asyncio.get_event_loop()
+    job = await loop.run_in_executor(None, job_store.adopt, job_id)
+    if job is None or job.status in FINISHED_STATUSES:
+        # Deleted meanwhile, or finished by a worker that died before acking.
+        await loop.run_in_executor(None, job_queue.ack, job_id)
+        await loop.run_in_executor(None, job_store.release, job_id)
+        return
+    if job.status == JobStatus.DOWNLOADING:
+        print(f"[Queue] Re-running job {job_id}: its previous worker's lease expired")
+        job.status = JobStatus.QUEUED
+        await loop.run_in_executor(None, job_store.save, job)
+
+    running_jobs[job_id] = asyncio.current_task()
+    heartbeat = asyncio.create_task(_heartbeat_lease(job_id))
+    cancel_watch = asyncio.create_task(_watch_for_cancel(job_id))
+    try:
+        await download_worker(job_id)
+    except asyncio.CancelledError:
+        if job_id not in cancelling_jobs:
+            # Shutting down mid-job: leave it on the queue. The lease runs out and
+            # another worker (or this one after restart) picks it up again.
+            raise
+        asyncio.current_task().uncancel()
+        await _cancel_job(job)
+        await loop.run_in_executor(None, job_queue.ack, job_id)
+        _schedule_expiry(job_id)
+        print(f"[Cancel] Job {job_id} cancelled")
+    else:
+        await loop.run_in_executor(None, job_queue.ack, job_id)
+    finally:
+        heartbeat.cancel()
+        cancel_watch.cancel()
+        running_jobs.pop(job_id, None)
+        cancelling_jobs.discard(job_id)
+        # Shielded: during shutdown a second cancellation must not drop the flush
+        await asyncio.shield(loop.run_in_executor(None, job_store.release, job_id))
+
+
+async def run_queue_consumer():
+    """Claim jobs from job_queue and run them until cancelled"""
+    loop = asyncio.get_event_loop()
+    claimed = set()
+    last_sweep = 0.0
+    print(f"[Queue] Worker {WORKER_ID} consuming from {type(job_queue).__name__}")
+    try:
+        while True:
+            while len(claimed) >= admission.limit * WORKER_PREFETCH_FACTOR:
+                await asyncio.wait(claimed, return_when=asyncio.FIRST_COMPLETED)
+            try:
+                if time.monotonic() - last_sweep >= JOB_LEASE_SECONDS / 3:
+                    last_sweep = time.monotonic()
+                    requeued = await loop.run_in_executor(None, job_queue.requeue_expired)
+                    if requeued:
+                        print(f"[Queue] Re-queued {requeued} job(s) with expired leases")
+                job_id = await loop.run_in_executor(None, job_queue.claim, WORKER_ID)
+            except Exception as e:
+                print(f"[Queue] Claim failed: {e}")
+                await asyncio.sleep(JOB_QUEUE_POLL_SECONDS)
+                continue
+
+            if job_id is None:
+                queue_wakeup.clear()
+                try:
+                    await asyncio.wait_for(queue_wakeup.wait(), timeout=JOB_QUEUE_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            task = asyncio.create_task(_run_claimed_job(job_id))
+            claimed.add(task)
+            task.add_done_callback(claimed.discard)
+    finally:
+        # Shutting down: interrupt claimed jobs while the pool is still up. They
+        # stay on the queue and resume from their partial files after a restart.
+        for task in claimed:
+            task.cancel()
+        await asyncio.gather(*claimed, return_exceptions=True)
+
+
+# --- Cancellation -------------------------------------------------------------
+# DELETE /jobs/{id} flags the job in the store, then stops it wherever it is:
+# still in the shared queue -> withdrawn and marked cancelled on the spot;
+# running here -> its task is cancelled, which kills the pool process (and its
+# ffmpeg) and deletes the partial files; running in another process -> that
+# process's _watch_for_cancel sees the flag within CANCEL_POLL_SECONDS. A leader
+# whose download other jobs are following is only marked cancelled; the
+# download itself carries on for them.
+#
+# Jobs queued with cancel_on_disconnect=true are cancelled once nobody has been
+# watching them over SSE for CANCEL_ON_DISCONNECT_GRACE_SECONDS (a page reload
+# reconnects well within that).
+CANCEL_POLL_SECONDS = 1.0
+CANCEL_WAIT_SECONDS = 5.0  # How long DELETE waits for the job to actually stop
+CANCEL_ON_DISCONNECT_GRACE_SECONDS = 5.0
+
+running_jobs: dict = {}  # job_id -> task running it in this process
+cancelling_jobs: set = set()  # job_ids whose task was cancelled by a cancel request
 
-                try {
-                    const response = await fetch(`/download?url=${encodeURIComponent(url)}&resolution=${resolution}`);
-                    const data = await response.json();
 
-                    loading.style.display = 'none';
-                    downloadBtn.disabled = false;
+async def _watch_for_cancel(job_id: str):
+    loop = asyncio.get_event_loop()
+    while not await loop.run_in_executor(None, job_store.cancel_requested, job_id):
+        await asyncio.sleep(CANCEL_POLL_SECONDS)
+    _cancel_running(job_id)
 
-                    if (response.ok) {
-                        message.className = 'message success';
-                        message.innerHTML = `
-                            ${data.message}<br>
-                            <a href="${data.download_url}" download="${data.filename}"
-                               style="color: #155724; font-weight: bold; text-decoration: underline; margin-top: 10px; display: inline-block;">
-                                Click here to download ${data.filename}
-                            </a>
-                        `;
-                        message.style.display = 'block';
-                        form.reset();
-                        document.getElementById('resolution').value = '1080p';
-                    } else {
-                        message.className = 'message error';
-                        message.textContent = data.detail || 'An error occurred';
-                        message.style.display = 'block';
-                    }
-                } catch (error) {
-                    loading.style.display = 'none';
-                    downloadBtn.disabled = false;
-                    message.className = 'message error';
-                    message.textContent = 'Network error: ' + error.message;
-                    message.style.display = 'block';
-                }
-            });
-        </script>
-    </body>
-    </html>
-    """
 
-# Webhook delivery with retry logic
-async def send_webhook(webhook_url: str, payload: dict, max_retries: int = 3):
-    """Send webhook with exponential backoff retry"""
-    async with httpx.AsyncClient() as client:
-        for attempt in range(max_retries):
-            try:
-                response = await client.post(
-                    webhook_url,
-                    json=payload,
-                    timeout=30.0
-                )
-                if response.status_code < 400:
-                    return True
-            except Exception as e:
-                pass
+def _cancel_running(job_id: str) -> bool:
+    """Stop a job this process is running; False if it doesn't run here"""
+    task = running_jobs.get(job_id)
+    if task is None:
+        return False
+    if job_id in cancelling_jobs:
+        return True
+    job = job_store.get(job_id)
+    flight = next((f for f in inflight_downloads.values() if f.leader.job_id == job_id), None)
+    if job is not None and flight is not None and flight.followers:
+        asyncio.create_task(_cancel_job(job))
+    else:
+        cancelling_jobs.add(job_id)
+        task.cancel()
+    return True
 
-            if attempt < max_retries - 1:
-                await asyncio.sleep(2 ** attempt)  # 1s, 2s, 4s backoff
 
-    return False
+async def _request_cancel(job_id: str) -> Optional[Job]:
+    """Cancel a job wherever it is; returns it once stopped (or after CANCEL_WAIT_SECONDS)"""
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, job_store.request_cancel, job_id)
+    if await loop.run_in_executor(None, job_queue.withdraw, job_id):
+        # Never claimed, so nothing else will finish it
+        job = await loop.run_in_executor(None, job_store.get, job_id)
+        if job is not None:
+            await _cancel_job(job)
+            _schedule_expiry(job_id)
+            print(f"[Cancel] Job {job_id} cancelled while queued")
+        return job
+    _cancel_running(job_id)
+    try:
+        return await asyncio.wait_for(_wait_for_job(job_id), CANCEL_WAIT_SECONDS)
+    except asyncio.TimeoutError:
+        return await loop.run_in_executor(None, job_store.get, job_id)
 
-# Background download worker
-async def download_worker(job_id: str):
-    """Process download in background with concurrency limiting"""
-    job = jobs[job_id]
 
-    async with download_semaphore:
-        job.status = JobStatus.DOWNLOADING
+async def _cancel_if_unwatched(job_id: str):
+    await asyncio.sleep(CANCEL_ON_DISCONNECT_GRACE_SECONDS)
+    if progress_broker.watcher_count(job_id):
+        return  # Reconnected, or watched by someone else
+    job = await asyncio.get_event_loop().run_in_executor(None, job_store.get, job_id)
+    if job is not None and job.status not in FINISHED_STATUSES:
+        print(f"[Cancel] Job {job_id}: its last progress watcher disconnected")
+        await _request_cancel(job_id)
 
-        try:
-            # Create downloads directory if it doesn't exist
-            downloads_dir = os.path.join(os.getcwd(), 'downloads')
-            os.makedirs(downloads_dir, exist_ok=True)
-
-            unique_id = str(uuid.uuid4())[:8]
-            height = job.resolution.replace('p', '')
-
-            ydl_opts = {
-                'format': f'bestvideo[height<={height}][vcodec^=avc]+bestaudio[ext=m4a]/bestvideo[height<={height}]+bestaudio/best[height<={height}]/best',
-                'outtmpl': os.path.join(downloads_dir, f'{unique_id}_%(title)s.%(ext)s'),
-                # Download ONLY the single video, never the surrounding playlist.
-                # YouTube "watch" URLs often carry &list=... (a real playlist, or an
-                # RD... radio/autoplay list). Without this, yt-dlp downloads every
-                # item in the list back-to-back — the client sees the progress bar
-                # loop 0->100% then restart on the next track, effectively forever.
-                'noplaylist': True,
-                # Just remux the (already-H.264/AAC) streams into an mp4 container.
-                # The format selector prefers AVC video + m4a audio, so a stream COPY
-                # is all that's needed — NO re-encode. (Previously this forced
-                # -c:v libx264 -crf 23, which transcoded every 1080p video: slow and
-                # CPU-heavy, especially on the Mac mini, and needlessly lossy.)
-                'merge_output_format': 'mp4',
-                'postprocessor_args': {
-                    # Applied to the ffmpeg merge step: copy both streams, fast-start
-                    # for progressive playback. If a source stream isn't mp4-compatible,
-                    # yt-dlp/ffmpeg still remuxes into mp4 via merge_output_format.
-                    'merger': ['-c', 'copy', '-movflags', '+faststart'],
-                },
-                'quiet': True,
-                'no_warnings': True,
-                'retries': 1,           # Reduced - we handle retries at app level with proxy rotation
-                'fragment_retries': 2,  # Keep some for fragment issues
-                # Cap individual socket reads so a hung connection to YouTube raises
-                # [Errno 60]-style timeouts instead of blocking the worker thread
-                # forever (which left jobs wedged in "downloading" with no webhook).
-                'socket_timeout': 30,
-                'js_runtimes': {'node': {}},
-                'remote_components': {'ejs:github': {}},
-            }
 
-            if PROXY_URL:
-                ydl_opts['proxy'] = PROXY_URL
-                print(f"[Download] Using proxy for job {job_id}")
-            else:
-                print(f"[Download] WARNING: No proxy configured for job {job_id}")
-
-            # Run yt-dlp in thread pool to avoid blocking. Wrap in a wall-clock
-            # timeout so a wedged download (thread stuck in a hung read that never
-            # raises) can't leave the job pinned at "downloading" indefinitely.
-            # On timeout, asyncio.TimeoutError falls through to the except below:
-            # the job is marked FAILED and the failure webhook fires, so the client
-            # stops polling forever. (The orphaned worker thread may linger, but the
-            # semaphore is released when this coroutine unwinds.)
-            loop = asyncio.get_event_loop()
-            result = await asyncio.wait_for(
-                loop.run_in_executor(None, lambda: _sync_download(ydl_opts, job.url, job)),
-                timeout=JOB_MAX_SECONDS,
-            )
-
-            job.status = JobStatus.COMPLETED
-            job.completed_at = datetime.now()
-            job.result = result
-
-            # Send webhook if configured
-            if job.webhook_url:
-                await send_webhook(job.webhook_url, {
-                    "job_id": job_id,
-                    "status": "completed",
-                    "title": result["title"],
-                    "resolution": result["resolution"],
-                    "download_url": result["download_url"],
-                    "filename": result["filename"]
-                })
+async def run_worker():
+    """Standalone download worker: `python download-youtube.py worker`"""
+    _purge_downloads_on_startup()
+    download_pool.start()
+    job_store.start()
+    _reconcile_expiry()
+    dispatcher = asyncio.create_task(run_webhook_dispatcher())
+    controller = asyncio.create_task(run_admission_controller())
+    expiry = asyncio.create_task(run_expiry_service())
+    try:
+        await run_queue_consumer()
+    finally:
+        controller.cancel()
+        dispatcher.cancel()
+        expiry.cancel()
+        download_pool.stop()
+        job_store.stop()
+        await _close_webhook_client()
+        _mark_metrics_process_dead()
 
-        except asyncio.TimeoutError:
-            job.status = JobStatus.FAILED
-            job.completed_at = datetime.now()
-            job.error = f"Download timed out after {JOB_MAX_SECONDS}s (connection to YouTube stalled)"
-            print(f"[Download] Job {job_id} force-failed: exceeded {JOB_MAX_SECONDS}s wall-clock cap")
-
-            if job.webhook_url:
-                await send_webhook(job.webhook_url, {
-                    "job_id": job_id,
-                    "status": "failed",
-                    "error": job.error
-                })
+def _format_signature(chosen: dict) -> dict:
+    """What partial files are resumed against: format ids and their exact sizes"""
+    parts = chosen.get('requested_formats') or [chosen]
+    return {"format_id": chosen['format_id'], "sizes": [part.get('filesize') for part in parts]}
 
-        except Exception as e:
-            job.status = JobStatus.FAILED
-            job.completed_at = datetime.now()
-            job.error = str(e)
-
-            # Send failure webhook if configured
-            if job.webhook_url:
-                await send_webhook(job.webhook_url, {
-                    "job_id": job_id,
-                    "status": "failed",
-                    "error": str(e)
-                })
 
-        finally:
-            asyncio.create_task(_cleanup_job_later(job_id))
+def _sync_download(ydl_opts: dict, url: str, job: Job = None, max_proxy_retries: int = 5,
+                   mirrors: Optional[list] = None) -> dict:
+    """Synchronous download function with proxy rotation retry on 403 errors
 
-def _sync_download(ydl_opts: dict, url: str, job: Job = None, max_proxy_retries: int = 5) -> dict:
-    """Synchronous download function with proxy rotation retry on 403 errors"""
+    `mirrors` is a (live, possibly growing) list of follower jobs that receive
+    a copy of `job`'s progress on every update.
+    """
+
+    transferred = {}  # filename -> bytes already counted
+    stage_started = {}  # 'transfer' / 'merge' -> time.time() start of the current attempt's stage
+    attempt_bytes = {'n': 0}  # Transferred by the current attempt, for the proxy's throughput
 
     def progress_hook(d):
         """Update job progress from yt-dlp callback"""
+        # Feed the admission controller's throughput measurement. Progress events
+        # are throttled, so the tail of a file only shows up in 'finished'.
+        downloaded = d.get('downloaded_bytes') or 0
+        if downloaded:
+            new_bytes = max(0, downloaded - transferred.get(d['filename'], 0))
+            admission.record_bytes(new_bytes)
+            metrics.downloaded_bytes.inc(new_bytes)
+            attempt_bytes['n'] += new_bytes
+            transferred[d['filename']] = downloaded
+
         if job is None:
             return
 
         if d['status'] == 'downloading':
-            downloaded = d.get('downloaded_bytes', 0)
-            total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
+
+            # A single-file format downloads straight into its output (.part) and
+            # can be streamed as it grows; the separate video/audio halves of a
+            # merged format (name.f137.mp4, ...) can't - see postprocessor_hook.
+            format_id = d['info_dict'].get('format_id')
+            if f".f{format_id}." not in os.path.basename(d['filename']):
+                job.stream_file = os.path.basename(d.get('tmpfilename') or d['filename'])
+                job.stream_limit = d.get('contiguous_bytes')
+
+            total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
 
             job.downloaded_bytes = downloaded
             job.total_bytes = total
@@ -572,54 +3692,165 @@ def _sync_download(ydl_opts: dict, url: str, job: Job = None, max_proxy_retries:
             job.progress_percent = 100
             job.eta = "Processing..."
 
-    # Add progress hook to options
-    ydl_opts_with_hook = ydl_opts.copy()
-    ydl_opts_with_hook['progress_hooks'] = [progress_hook]
+        job_store.save_progress(job)
+        for follower in list(mirrors or ()):
+            _mirror_progress(job, follower)
+
+    def postprocessor_hook(d):
+        """Time the merge, and point the stream at its output as soon as ffmpeg starts writing it"""
+        if d['postprocessor'] != 'Merger':
+            return
+        if d['status'] == 'finished' and 'merge' in stage_started:
+            metrics.merge_seconds.observe(time.time() - stage_started['merge'])
+            _trace_span(job, "merge", stage_started['merge'])
+        if d['status'] != 'started':
+            return
+        stage_started['merge'] = time.time()
+        metrics.transfer_seconds.observe(stage_started['merge'] - stage_started['transfer'])
+        if job is None:
+            return
+        # FFmpegMergerPP writes <filepath>.temp.<ext>, then renames it into place
+        job.stream_file = os.path.basename(prepend_extension(d['info_dict']['filepath'], 'temp'))
+        job.stream_limit = None
+        job_store.save_progress(job)
+        for follower in list(mirrors or ()):
+            _mirror_progress(job, follower)
+
+    def on_event(kind, data):
+        """Replay the pool process's hook calls on this side"""
+        if kind == 'progress':
+            progress_hook({**data, 'info_dict': {'format_id': data['format_id']}})
+        elif kind == 'postprocessor':
+            postprocessor_hook({**data, 'info_dict': {'filepath': data['filepath']}})
 
-    last_error = None
+    info_key = _video_identity(url) or url
+    # download_worker kills this job's pool process via the key on timeout
+    pool_key = job.job_id if job is not None else f"download-{uuid.uuid4().hex}"
+    tried = []  # Proxy endpoints used by earlier attempts
+    partial_prefix = f"{job.output_stem}_" if job is not None and job.output_stem else None
+    limits = _job_format_limits(job) if job is not None else None
+    resume = {'format': job.resume_format if job is not None else None}
 
-    for attempt in range(max_proxy_retries):
-        try:
-            # Create fresh yt-dlp instance each attempt (new connection = new ProxyJet IP)
-            with yt_dlp.YoutubeDL(ydl_opts_with_hook) as ydl:
-                info = ydl.extract_info(url, download=True)
-                title = info.get('title', 'video')
-                actual_height = info.get('height', 'unknown')
+    try:
+        last_error = None
+        for attempt in range(max_proxy_retries):
+            endpoint = proxy_pool.acquire(exclude=tried)
+            tried.append(endpoint)
+            attempt_opts = dict(ydl_opts)
+            if endpoint is not None:
+                attempt_opts['proxy'] = endpoint.url
+            success = None
+            transfer_seconds = 0.0
+            attempt_bytes['n'] = 0
+            stage_started.clear()
+            reused = False
+            via = endpoint.name if endpoint is not None else "direct connection"
+            attempt_started = time.time()
+            attempt_trace = {'outcome': 'error', 'error': None, 'format_id': None}
+            try:
+                # Extract (or reuse a cached extraction), then download from it. Each
+                # task gets a fresh yt-dlp instance (new connection = new ProxyJet IP).
+                info, extract_seconds = _extract_info_cached(url, attempt_opts, info_key, _egress(endpoint), pool_key)
+                reused = extract_seconds is None
+                if job is not None:
+                    job.extract_seconds = 0.0 if reused else round(extract_seconds, 3)
+                _trace_span(job, "extract", attempt_started, attempt=attempt + 1, proxy=via, cached=reused)
 
-                downloaded_file = ydl.prepare_filename(info)
-                if not os.path.exists(downloaded_file):
-                    downloaded_file = os.path.splitext(downloaded_file)[0] + '.mp4'
+                # Pin the format yt-dlp would pick, so partial files left by an
+                # earlier attempt (or run) are only continued with that very
+                # stream. If this extraction picks another one, start over.
+                with yt_dlp.YoutubeDL(attempt_opts) as ydl:
+                    chosen = _choose_format(ydl, info, attempt_opts['format'], limits)
+                if chosen is None and limits:
+                    raise Exception(f"No format at {job.resolution} fits the requested "
+                                    f"max_filesize_mb / max_fps / max_bitrate_kbps")
+                if chosen is not None:
+                    signature = _format_signature(chosen)
+                    if resume['format'] not in (None, signature) and partial_prefix:
+                        print(f"[Resume] Format changed ({resume['format']['format_id']} -> "
+                              f"{signature['format_id']}): discarding partial files")
+                        _delete_partial_files(partial_prefix)
+                        if job is not None:
+                            # /jobs/{id}/stream followers can't take back what they sent
+                            job.stream_generation += 1
+                            job.stream_file = job.stream_limit = None
+                    if signature != resume['format']:
+                        resume['format'] = signature
+                        if job is not None:
+                            job.resume_format = signature
+                            job_store.save(job)
+                    attempt_opts['format'] = chosen['format_id']
+                    attempt_trace['format_id'] = chosen['format_id']
+                if job is not None:
+                    # Kept on the job: if it doesn't fit, download_worker waits for
+                    # room with this size instead of extracting again to find out.
+                    job.disk_bytes = _predicted_download_bytes(chosen, info)
+                    disk_budget.reserve(job.job_id, job.output_stem, job.disk_bytes)
 
-                filename = os.path.basename(downloaded_file)
+                stage_started['transfer'] = time.time()
+                outcome = download_pool.run(pool_key, {'kind': 'download', 'opts': attempt_opts, 'info': info}, on_event)
+                success = True
+                attempt_trace['outcome'] = 'ok'
+                admission.record_attempt(forbidden=False)
+                transfer_seconds = stage_started.get('merge', time.time()) - stage_started['transfer']
+                if 'merge' not in stage_started:
+                    metrics.transfer_seconds.observe(transfer_seconds)
+                filename = outcome['filename']
 
                 return {
-                    "title": title,
-                    "resolution": f"{actual_height}p",
+                    "title": outcome['title'],
+                    "resolution": f"{outcome['height']}p",
                     "download_url": f"/files/{filename}",
-                    "filename": filename
+                    "filename": filename,
+                    "format_id": attempt_trace['format_id'],
+                    "filesize": outcome['filesize'],
                 }
 
-        except yt_dlp.utils.DownloadError as e:
-            error_str = str(e).lower()
-            if '403' in error_str or 'forbidden' in error_str:
+            except (yt_dlp.utils.DownloadError, DownloadProcessTimeout) as e:
+                if not _proxy_fault(e):
+                    raise  # Not the proxy's fault: fail immediately
+                success = False
                 last_error = e
-                print(f"[Download] 403 error on attempt {attempt + 1}/{max_proxy_retries}, rotating proxy...")
-                if attempt < max_proxy_retries - 1:
-                    time.sleep(2 ** attempt)  # Exponential backoff: 1s, 2s, 4s, 8s
-                continue  # Retry with new yt-dlp instance
-            else:
-                raise  # Non-403 errors fail immediately
+                attempt_trace.update(outcome='proxy_fault', error=str(e))
+                error_str = str(e).lower()
+                if '403' in error_str or 'forbidden' in error_str:
+                    admission.record_attempt(forbidden=True)
+                    metrics.forbidden.labels(attempt=str(attempt + 1)).inc()
+                print(f"[Download] {e} on attempt {attempt + 1}/{max_proxy_retries} via {via}, switching proxy...")
+                # A fresh extraction is kept for the next attempt (the block was
+                # most likely on the proxy IP); a reused one that fails too may
+                # carry stale signatures, so the attempt after re-extracts.
+                if reused:
+                    info_cache.invalidate(info_key)
+                continue  # Retry right away through the next best endpoint
+
+            finally:
+                proxy_pool.release(endpoint, success, attempt_bytes['n'], transfer_seconds)
+                attempt_ended = time.time()
+                if 'transfer' in stage_started:
+                    _trace_span(job, "transfer", stage_started['transfer'], stage_started.get('merge', attempt_ended),
+                                attempt=attempt + 1, bytes=attempt_bytes['n'])
+                _trace_span(job, "attempt", attempt_started, attempt_ended, attempt=attempt + 1, proxy=via,
+                            **attempt_trace)
 
-    # All retries exhausted
-    raise last_error or Exception("Download failed after all proxy rotation attempts")
+        # All retries exhausted
+        raise last_error or Exception("Download failed after all proxy rotation attempts")
+    finally:
+        download_pool.forget(pool_key)
 
 class DownloadRequestNoWebhook(BaseModel):
     url: str
     resolution: str = "1080p"
+    max_filesize_mb: Optional[float] = None
+    max_fps: Optional[float] = None
+    max_bitrate_kbps: Optional[float] = None
+    owner: Optional[str] = None
+    priority: JobPriority = JobPriority.NORMAL
+    cancel_on_disconnect: bool = False  # Cancel once nobody follows /jobs/{id}/progress
 
 # New async endpoint with webhook support
 @app.post("/download")
-async def queue_download(request: DownloadRequest, background_tasks: BackgroundTasks):
+async def queue_download(request: DownloadRequest):
     """Queue a video download and receive results via webhook"""
     job_id = str(uuid.uuid4())
 
@@ -628,13 +3859,18 @@ async def queue_download(request: DownloadRequest, background_tasks: BackgroundT
         status=JobStatus.QUEUED,
         url=request.url,
         resolution=request.resolution,
+        max_filesize_mb=request.max_filesize_mb,
+        max_fps=request.max_fps,
+        max_bitrate_kbps=request.max_bitrate_kbps,
         webhook_url=str(request.webhook_url),
+        owner=request.owner,
+        priority=request.priority,
         created_at=datetime.now()
     )
-    jobs[job_id] = job
+    await asyncio.get_event_loop().run_in_executor(None, job_store.add, job)
 
-    # Start background download
-    background_tasks.add_task(download_worker, job_id)
+    # Hand the job to whichever worker claims it first
+    await _enqueue_job(job)
 
     return {
         "job_id": job_id,
@@ -644,7 +3880,7 @@ async def queue_download(request: DownloadRequest, background_tasks: BackgroundT
 
 # Async endpoint without webhook - use SSE for progress
 @app.post("/download/async")
-async def queue_download_async(request: DownloadRequestNoWebhook, background_tasks: BackgroundTasks):
+async def queue_download_async(request: DownloadRequestNoWebhook):
     """Queue a video download and track progress via SSE at /jobs/{job_id}/progress"""
     job_id = str(uuid.uuid4())
 
@@ -653,34 +3889,50 @@ async def queue_download_async(request: DownloadRequestNoWebhook, background_tas
         status=JobStatus.QUEUED,
         url=request.url,
         resolution=request.resolution,
+        max_filesize_mb=request.max_filesize_mb,
+        max_fps=request.max_fps,
+        max_bitrate_kbps=request.max_bitrate_kbps,
         webhook_url=None,
+        owner=request.owner,
+        priority=request.priority,
+        cancel_on_disconnect=request.cancel_on_disconnect,
         created_at=datetime.now()
     )
-    jobs[job_id] = job
+    await asyncio.get_event_loop().run_in_executor(None, job_store.add, job)
 
-    # Start background download
-    background_tasks.add_task(download_worker, job_id)
+    # Hand the job to whichever worker claims it first
+    await _enqueue_job(job)
 
     return {
         "job_id": job_id,
         "status": "queued",
         "progress_url": f"/jobs/{job_id}/progress",
+        "stream_url": f"/jobs/{job_id}/stream",
         "message": "Download queued. Stream progress via SSE at the progress_url."
     }
 
-# Job status endpoint
-@app.get("/jobs/{job_id}")
-async def get_job_status(job_id: str):
-    """Check the status of a download job"""
-    if job_id not in jobs:
-        raise HTTPException(status_code=404, detail="Job not found")
+def _queue_estimate(job: Job) -> tuple:
+    """(queue_position, estimated_start) for a job that hasn't started yet"""
+    if job.status != JobStatus.QUEUED:
+        return None, None
+    if job.queue_position is not None:
+        return job.queue_position, job.estimated_start  # Claimed, waiting for a slot
+    position = job_queue.position(job.job_id)
+    if position is None:
+        return None, None
+    # Still in the shared queue: behind whatever already waits for a slot here
+    position += admission.waiting
+    return position, admission.estimate_start(position)
+
 
-    job = jobs[job_id]
+def _job_status_payload(job: Job) -> dict:
+    queue_position, estimated_start = _queue_estimate(job)
     return {
         "job_id": job.job_id,
         "status": job.status,
         "url": job.url,
         "resolution": job.resolution,
+        "owner": job.owner,
         "created_at": job.created_at.isoformat(),
         "completed_at": job.completed_at.isoformat() if job.completed_at else None,
         "result": job.result,
@@ -689,51 +3941,239 @@ async def get_job_status(job_id: str):
         "downloaded_bytes": job.downloaded_bytes,
         "total_bytes": job.total_bytes,
         "speed": job.speed,
-        "eta": job.eta
+        "eta": job.eta,
+        "extract_seconds": job.extract_seconds,
+        "priority": job.priority,
+        "queue_position": queue_position,
+        "estimated_start": estimated_start.isoformat() if estimated_start else None
     }
 
+
+# Bulk status/progress for callers tracking many jobs at once. Either pass
+# ids=a,b,c (comma-separated and/or repeated) or owner=<label given at enqueue>.
+MAX_BULK_JOBS = 500
+SSE_OWNER_RESCAN_SECONDS = 2.0
+
+
+def _parse_job_ids(ids: Optional[list]) -> list:
+    job_ids = []
+    for value in ids or ():
+        for job_id in value.split(','):
+            job_id = job_id.strip()
+            if job_id and job_id not in job_ids:
+                job_ids.append(job_id)
+    if len(job_ids) > MAX_BULK_JOBS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BULK_JOBS} job ids per request")
+    return job_ids
+
+
+def _bulk_selection(ids: Optional[list], owner: Optional[str]) -> list:
+    job_ids = _parse_job_ids(ids)
+    if not job_ids and not owner:
+        raise HTTPException(status_code=400, detail="Pass ids=... or owner=...")
+    return job_ids
+
+
+def _sync_jobs_status(job_ids: list, owner: Optional[str]) -> dict:
+    found, missing = [], []
+    for job_id in job_ids:
+        job = job_store.get(job_id)
+        if job is None:
+            missing.append(job_id)
+        else:
+            found.append(_job_status_payload(job))
+    if owner:
+        listed = {payload["job_id"] for payload in found}
+        found.extend(_job_status_payload(job) for job in job_store.list_by_owner(owner)[:MAX_BULK_JOBS]
+                     if job.job_id not in listed)
+    return {"jobs": found, "missing": missing}
+
+
+@app.get("/jobs")
+async def get_jobs_status(ids: Optional[list[str]] = Query(None), owner: Optional[str] = None):
+    """Status of many jobs in one response"""
+    job_ids = _bulk_selection(ids, owner)
+    return await asyncio.get_event_loop().run_in_executor(None, _sync_jobs_status, job_ids, owner)
+
+
+@app.get("/jobs/progress")
+async def stream_jobs_progress(ids: Optional[list[str]] = Query(None), owner: Optional[str] = None):
+    """Stream progress for many jobs over one Server-Sent Events connection
+
+    Every event is a full job status payload (tagged by its job_id). With ids,
+    the stream ends once all of them finished; with owner it stays open and
+    picks up the owner's new jobs as they are queued.
+    """
+    job_ids = _bulk_selection(ids, owner)
+    loop = asyncio.get_event_loop()
+
+    async def event_generator():
+        finished = set()
+        last_sent: dict = {}
+        metrics.sse_connections.inc()
+        try:
+            async with progress_broker.watch_many() as multi:
+                for job_id in job_ids:
+                    multi.add(job_id)
+                last_rescan = 0.0
+                last_yield = time.monotonic()
+                while True:
+                    if owner and time.monotonic() - last_rescan >= SSE_OWNER_RESCAN_SECONDS:
+                        last_rescan = time.monotonic()
+                        for job in await loop.run_in_executor(None, job_store.list_by_owner, owner):
+                            if job.job_id not in finished:
+                                multi.add(job.job_id)
+
+                    changed = await multi.wait(SSE_OWNER_RESCAN_SECONDS if owner else SSE_KEEPALIVE_SECONDS)
+                    if not changed:
+                        if time.monotonic() - last_yield >= SSE_KEEPALIVE_SECONDS:
+                            last_yield = time.monotonic()
+                            yield ": keep-alive\n\n"
+                        continue
+
+                    for job_id in sorted(changed):
+                        job = await loop.run_in_executor(None, job_store.get, job_id)
+                        if job is None:
+                            payload = {"job_id": job_id, "error": "Job not found"}
+                        else:
+                            payload = jsonable_encoder(await loop.run_in_executor(None, _job_status_payload, job))
+                        if payload != last_sent.get(job_id):
+                            last_sent[job_id] = payload
+                            last_yield = time.monotonic()
+                            yield f"event: progress\ndata: {json.dumps(payload)}\n\n"
+                        if job is None or job.status in FINISHED_STATUSES:
+                            finished.add(job_id)
+                            last_sent.pop(job_id, None)
+                            multi.remove(job_id)
+
+                    if not owner and finished.issuperset(job_ids):
+                        break
+                    await asyncio.sleep(SSE_MIN_INTERVAL_SECONDS)
+        finally:
+            metrics.sse_connections.dec()
+
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+
+# Job status endpoint
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    """Check the status of a download job"""
+    loop = asyncio.get_event_loop()
+    job = await loop.run_in_executor(None, job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    return await loop.run_in_executor(None, _job_status_payload, job)
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancel a queued or running job"""
+    loop = asyncio.get_event_loop()
+    job = await loop.run_in_executor(None, job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status in FINISHED_STATUSES:
+        raise HTTPException(status_code=409, detail=f"Job already {job.status.value}")
+
+    job = await _request_cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    # 202: the worker running it hasn't stopped yet, but will
+    status_code = 200 if job.status in FINISHED_STATUSES else 202
+    payload = await loop.run_in_executor(None, _job_status_payload, job)
+    return JSONResponse(jsonable_encoder(payload), status_code=status_code)
+
+class RetentionRequest(BaseModel):
+    seconds: float = JOB_RETENTION_SECONDS  # Keep the job (and its file) at least this long from now
+
+
+@app.post("/jobs/{job_id}/retention")
+async def extend_job_retention(job_id: str, request: RetentionRequest):
+    """Keep a finished job and its file around longer"""
+    loop = asyncio.get_event_loop()
+    job = await loop.run_in_executor(None, job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status not in FINISHED_STATUSES:
+        raise HTTPException(status_code=409, detail="Job hasn't finished yet; its retention starts when it does")
+    seconds = min(max(0.0, request.seconds), JOB_RETENTION_MAX_SECONDS)
+    expires_at = await loop.run_in_executor(None, expiry_schedule.extend, job_id, time.time() + seconds)
+    if expires_at is None:
+        raise HTTPException(status_code=404, detail="Job is being expired")
+    return {"job_id": job_id, "expires_at": datetime.fromtimestamp(expires_at).isoformat()}
+
+@app.get("/jobs/{job_id}/trace")
+async def get_job_trace(job_id: str, format: str = Query("timeline", pattern="^(timeline|otel)$")):
+    """Where a job's time went: one span per stage and per retry attempt"""
+    job = await asyncio.get_event_loop().run_in_executor(None, job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return _otel_trace(job) if format == "otel" else _trace_timeline(job)
+
 # SSE Progress endpoint
 @app.get("/jobs/{job_id}/progress")
 async def stream_job_progress(job_id: str):
     """Stream download progress via Server-Sent Events"""
-    if job_id not in jobs:
+    loop = asyncio.get_event_loop()
+    job = await loop.run_in_executor(None, job_store.get, job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
+    cancel_on_disconnect = job.cancel_on_disconnect
 
     async def event_generator():
-        last_progress = -1
-        while True:
-            if job_id not in jobs:
-                yield f"data: {json.dumps({'error': 'Job not found'})}\n\n"
-                break
+        last_event = None
+        metrics.sse_connections.inc()
+        try:
+            async with progress_broker.watch(job_id) as channel:
+                while True:
+                    seen = channel.version
+                    job = await loop.run_in_executor(None, job_store.get, job_id)
+                    if job is None:
+                        yield f"data: {json.dumps({'error': 'Job not found'})}\n\n"
+                        break
 
-            job = jobs[job_id]
-            current_progress = job.progress_percent
-
-            # Send update if progress changed or status changed
-            if current_progress != last_progress or job.status in [JobStatus.COMPLETED, JobStatus.FAILED]:
-                event_data = {
-                    "job_id": job_id,
-                    "status": job.status.value,
-                    "progress_percent": round(job.progress_percent, 1),
-                    "downloaded_bytes": job.downloaded_bytes,
-                    "total_bytes": job.total_bytes,
-                    "speed": job.speed,
-                    "eta": job.eta
-                }
+                    event_data = {
+                        "job_id": job_id,
+                        "status": job.status.value,
+                        "progress_percent": round(job.progress_percent, 1),
+                        "downloaded_bytes": job.downloaded_bytes,
+                        "total_bytes": job.total_bytes,
+                        "speed": job.speed,
+                        "eta": job.eta
+                    }
 
-                if job.status == JobStatus.COMPLETED:
-                    event_data["result"] = job.result
-                    yield f"data: {json.dumps(event_data)}\n\n"
-                    break
-                elif job.status == JobStatus.FAILED:
-                    event_data["error"] = job.error
-                    yield f"data: {json.dumps(event_data)}\n\n"
-                    break
+                    if job.status == JobStatus.COMPLETED:
+                        event_data["result"] = job.result
+                        yield f"data: {json.dumps(event_data)}\n\n"
+                        break
+                    elif job.status in (JobStatus.FAILED, JobStatus.CANCELLED):
+                        event_data["error"] = job.error
+                        yield f"data: {json.dumps(event_data)}\n\n"
+                        break
 
-                yield f"data: {json.dumps(event_data)}\n\n"
-                last_progress = current_progress
+                    # Send update only if something changed
+                    if event_data != last_event:
+                        yield f"data: {json.dumps(event_data)}\n\n"
+                        last_event = event_data
+                        # Coalesce bursts: whatever arrives meanwhile goes out as
+                        # one (latest) event.
+                        await asyncio.sleep(SSE_MIN_INTERVAL_SECONDS)
 
-            await asyncio.sleep(0.5)  # Check every 500ms
+                    if not await channel.wait_newer(seen, SSE_KEEPALIVE_SECONDS):
+                        yield ": keep-alive\n\n"
+        finally:
+            metrics.sse_connections.dec()
+            if cancel_on_disconnect:
+                asyncio.create_task(_cancel_if_unwatched(job_id))
 
     return StreamingResponse(
         event_generator(),
@@ -745,118 +4185,549 @@ async def stream_job_progress(job_id: str):
         }
     )
 
-# Keep original sync endpoint for backwards compatibility
-@app.get("/download")
-async def download_video(url: str, resolution: str = "1080p"):
+# Progressive download: send the output file while it is still being written.
+# A single-file format is followed as its .part grows; a merged format from the
+# moment ffmpeg starts writing the (fragmented) merge output. The open file
+# descriptor survives yt-dlp's final rename, so we simply read until the job is
+# done and the file stops growing. Finished jobs are served like /files. A retry
+# that switches format discards the partial output already sent (stream_generation
+# changes), so the body ends short there, as it does when the job fails.
+STREAM_CHUNK_SIZE = 1024 * 1024
+STREAM_POLL_SECONDS = 0.25  # ffmpeg merges report no progress; poll for growth
+
+
+def _open_stream_source(job: Job):
+    filename = job.result['filename'] if job.status == JobStatus.COMPLETED else job.stream_file
+    if not filename:
+        return None
     try:
-        # Create downloads directory if it doesn't exist
-        downloads_dir = os.path.join(os.getcwd(), 'downloads')
-        os.makedirs(downloads_dir, exist_ok=True)
-
-        # Generate unique filename to avoid conflicts
-        unique_id = str(uuid.uuid4())[:8]
-
-        # Convert resolution format (e.g., "1080p" -> "1080")
-        height = resolution.replace('p', '')
-
-        # Configure yt-dlp options
-        ydl_opts = {
-            'format': f'bestvideo[height<={height}][vcodec^=avc]+bestaudio[ext=m4a]/bestvideo[height<={height}]+bestaudio/best[height<={height}]/best',
-            'outtmpl': os.path.join(downloads_dir, f'{unique_id}_%(title)s.%(ext)s'),
-            # Only the single video, never the surrounding &list=... playlist/radio.
-            'noplaylist': True,
-            'merge_output_format': 'mp4',
-            'postprocessors': [{
-                'key': 'FFmpegVideoConvertor',
-                'preferedformat': 'mp4',
-            }],
-            'postprocessor_args': [
-                '-c:v', 'libx264',
-                '-c:a', 'aac',
-                '-crf', '23',
-                '-preset', 'fast',
-            ],
-            'quiet': True,
-            'no_warnings': True,
-            'js_runtimes': {'node': {}},
-            'remote_components': {'ejs:github': {}},
+        return open(os.path.join(DOWNLOADS_DIR, filename), 'rb')
+    except FileNotFoundError:
+        return None  # Renamed under us (e.g. merge finished); re-read the job
+
+
+@app.get("/jobs/{job_id}/stream")
+async def stream_job_file(job_id: str, request: Request):
+    """Stream a job's video as it downloads"""
+    loop = asyncio.get_event_loop()
+    job = await loop.run_in_executor(None, job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status == JobStatus.COMPLETED:
+        return await get_file(job.result['filename'], request)
+    if job.status in (JobStatus.FAILED, JobStatus.CANCELLED):
+        raise HTTPException(status_code=409, detail=f"Job {job.status.value}: {job.error}")
+
+    generation = job.stream_generation
+
+    async def follow():
+        source = None
+        try:
+            async with progress_broker.watch(job_id) as channel:
+                while True:
+                    seen = channel.version
+                    current = await loop.run_in_executor(None, job_store.get, job_id)
+                    if (current is None or current.status in (JobStatus.FAILED, JobStatus.CANCELLED)
+                            or current.stream_generation != generation):
+                        break  # Truncated: the client sees a short body
+                    if source is None:
+                        source = _open_stream_source(current)
+                    if source is not None:
+                        size = STREAM_CHUNK_SIZE
+                        if current.stream_limit is not None and current.status != JobStatus.COMPLETED:
+                            size = min(size, current.stream_limit - source.tell())
+                        chunk = await loop.run_in_executor(None, source.read, size) if size > 0 else b''
+                        if chunk:
+                            yield chunk
+                            continue
+                        if current.status == JobStatus.COMPLETED:
+                            break
+                    await channel.wait_newer(seen, STREAM_POLL_SECONDS)
+        finally:
+            if source is not None:
+                source.close()
+
+    return StreamingResponse(
+        follow(),
+        media_type="video/mp4",
+        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"}
+    )
+
+# Metadata lookup: title, duration, available formats and what a download at
+# `resolution` would fetch, without queueing a job or taking a download slot.
+# Answers come from the info cache when possible, so previewing a video and then
+# downloading it costs one extraction in total - as long as the info may be
+# reused, which IP-bound URLs behind a rotating proxy may not. The summarized
+# answer itself carries no signed URLs, so it is memoized on its own per
+# (video, resolution, limits) for INFO_SUMMARY_TTL regardless of IP binding:
+# repeated previews of a video never extract again.
+INFO_MAX_CONCURRENT = 10  # Extractions run node; don't let previews starve downloads
+info_semaphore = asyncio.Semaphore(INFO_MAX_CONCURRENT)
+INFO_SUMMARY_TTL = int(os.getenv('INFO_SUMMARY_TTL', '600'))  # 0 disables
+INFO_SUMMARY_MAX_ENTRIES = 1024
+
+
+class InfoSummaryCache:
+    """In-process LRU of /info answers with a fixed TTL"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, summary)
+
+    def get(self, key: tuple) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: tuple, summary: dict):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, summary)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+info_summaries = InfoSummaryCache(INFO_SUMMARY_TTL, INFO_SUMMARY_MAX_ENTRIES)
+
+_INFO_FORMAT_FIELDS = ('format_id', 'ext', 'height', 'width', 'fps', 'vcodec', 'acodec',
+                       'tbr', 'filesize', 'filesize_approx', 'format_note')
+
+
+def _format_summary(fmt: dict) -> dict:
+    return {field: fmt.get(field) for field in _INFO_FORMAT_FIELDS}
+
+
+def _smallest_fitting_formats(info: dict, limits: dict) -> Optional[list]:
+    """The format(s) to fetch under limits (see _format_limits), or None if nothing fits
+
+    Every progressive format and video+audio pair is a candidate; unknown fps
+    or bitrate pass, an unknown size doesn't when there is a size cap. The
+    resolution is met first: the requested height, or the closest one below
+    it that has a candidate within the caps. At that height the smallest
+    candidate wins; AVC + m4a (stream-copied into mp4) only breaks ties.
+    """
+    duration = info.get('duration')
+    formats = [f for f in info.get('formats') or [] if f.get('format_id') and f.get('ext') != 'mhtml']
+
+    def has(f, codec):
+        return f.get(codec) not in (None, 'none')
+
+    def size(f):
+        if f.get('filesize') or f.get('filesize_approx'):
+            return f.get('filesize') or f['filesize_approx']
+        return f['tbr'] * 1000 / 8 * duration if f.get('tbr') and duration else None
+
+    def video_fits(f):
+        return ((limits['height'] is None or (f.get('height') or 0) <= limits['height'])
+                and (limits['fps'] is None or (f.get('fps') or 0) <= limits['fps']))
+
+    videos = [f for f in formats if has(f, 'vcodec') and not has(f, 'acodec') and video_fits(f)]
+    audios = [f for f in formats if has(f, 'acodec') and not has(f, 'vcodec')]
+    candidates = [[f] for f in formats if has(f, 'vcodec') and has(f, 'acodec') and video_fits(f)]
+    candidates += [[video, audio] for video in videos for audio in audios]
+
+    fitting = []
+    for parts in candidates:
+        sizes = [size(f) for f in parts]
+        bitrates = [f.get('tbr') for f in parts]
+        if limits['filesize'] and (None in sizes or sum(sizes) > limits['filesize']):
+            continue
+        if limits['tbr'] and None not in bitrates and sum(bitrates) > limits['tbr']:
+            continue
+        mp4_copy = (parts[0].get('vcodec') or '').startswith('avc') and parts[-1].get('ext') in ('m4a', 'mp4')
+        fitting.append(((-(parts[0].get('height') or 0), sum(s or 0 for s in sizes), not mp4_copy), parts))
+    if not fitting:
+        return None
+    return min(fitting, key=lambda entry: entry[0])[1]
+
+
+def _choose_format(ydl, info: dict, format_selector: str, limits: Optional[dict] = None) -> Optional[dict]:
+    """The format (or merged video+audio pair) yt-dlp would pick for info"""
+    if limits:
+        parts = _smallest_fitting_formats(info, limits)
+        if parts is None:
+            return None
+        format_selector = '+'.join(f['format_id'] for f in parts)
+    formats = info.get('formats') or []
+    selector = ydl.build_format_selector(format_selector)
+    return next(iter(selector({
+        'formats': formats,
+        'has_merged_format': any('none' not in (f.get('acodec'), f.get('vcodec')) for f in formats),
+        'incomplete_formats': (all(f.get('vcodec') == 'none' for f in formats)
+                               or all(f.get('acodec') == 'none' for f in formats)),
+    })), None)
+
+
+def _select_formats(ydl, info: dict, format_selector: str, limits: Optional[dict] = None) -> Optional[dict]:
+    chosen = _choose_format(ydl, info, format_selector, limits)
+    if chosen is None:
+        return None
+    parts = chosen.get('requested_formats') or [chosen]
+    sizes = [f.get('filesize') or f.get('filesize_approx') for f in parts]
+    return {
+        'format_id': chosen.get('format_id'),
+        'ext': chosen.get('ext'),
+        'height': chosen.get('height'),
+        'fps': chosen.get('fps'),
+        'formats': [_format_summary(f) for f in parts],
+        'filesize_approx': sum(sizes) if all(sizes) else None,
+    }
+
+
+def _sync_info(url: str, format_selector: str, limits: Optional[dict] = None) -> dict:
+    info_key = _video_identity(url) or url
+    with proxy_pool.using() as endpoint:
+        opts = _ydl_opts(format_selector, endpoint)
+        info, extract_seconds = _extract_info_cached(url, opts, info_key, _egress(endpoint))
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        formats = [f for f in info.get('formats') or [] if f.get('ext') != 'mhtml']  # Drop storyboards
+        return {
+            "id": info.get('id'),
+            "title": info.get('title'),
+            "uploader": info.get('uploader'),
+            "duration": info.get('duration'),
+            "thumbnail": info.get('thumbnail'),
+            "heights": sorted({f['height'] for f in formats if f.get('height')}),
+            "formats": [_format_summary(f) for f in formats],
+            "selected": _select_formats(ydl, info, format_selector, limits),
+            "cached": extract_seconds is None,
+            "extract_seconds": round(extract_seconds, 3) if extract_seconds is not None else 0.0,
         }
 
-        # Add proxy if configured
-        if PROXY_URL:
-            ydl_opts['proxy'] = PROXY_URL
 
-        # Add reduced retries - we handle proxy rotation at app level
-        ydl_opts['retries'] = 1
-        ydl_opts['fragment_retries'] = 2
+@app.get("/info")
+async def get_info(url: str, resolution: str = "1080p", max_filesize_mb: Optional[float] = None,
+                   max_fps: Optional[float] = None, max_bitrate_kbps: Optional[float] = None):
+    """Video metadata and the format a download at `resolution` would pick"""
+    loop = asyncio.get_event_loop()
+    limits = _format_limits(resolution, max_filesize_mb, max_fps, max_bitrate_kbps)
+    format_selector = _format_selector(resolution)
+    key = (await loop.run_in_executor(None, _video_identity, url) or url, format_selector,
+           tuple((limits or {}).items()))
+    summary = info_summaries.get(key)
+    if summary is not None:
+        return dict(summary, cached=True, extract_seconds=0.0)
+    try:
+        async with info_semaphore:
+            summary = await loop.run_in_executor(None, _sync_info, url, format_selector, limits)
+        info_summaries.put(key, summary)
+        return summary
+    except yt_dlp.utils.DownloadError as e:
+        raise HTTPException(status_code=400, detail=f"Error: Video is not available or cannot be downloaded - {e}")
 
-        # Download with proxy rotation retry on 403 errors
-        max_proxy_retries = 5
-        last_error = None
+# --- Pipe mode ----------------------------------------------------------------
+# GET /download/pipe sends a video straight from YouTube to the client: ffmpeg
+# fetches the streams the download selector picks and muxes them into
+# fragmented MP4 on stdout, which becomes the response body. Nothing touches
+# downloads/ - no file to write, retain for JOB_RETENTION_SECONDS and read back.
+# Backpressure is end to end: a slow client stalls our sends, we stop reading the
+# pipe, ffmpeg blocks on its writes and stops reading from YouTube. If the client
+# hangs up, ffmpeg is killed.
+#
+# Format URLs bound to the extracting IP only work if ffmpeg leaves from that same
+# IP, i.e. without a proxy or with PROXY_STICKY=1.
+PIPE_CHUNK_SIZE = 256 * 1024
+PIPE_PROTOCOLS = {'http', 'https', 'm3u8', 'm3u8_native'}  # What ffmpeg can read itself
 
-        for attempt in range(max_proxy_retries):
-            try:
-                # Create fresh yt-dlp instance each attempt (new connection = new ProxyJet IP)
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info = ydl.extract_info(url, download=True)
-                    title = info.get('title', 'video')
-                    actual_height = info.get('height', 'unknown')
 
-                    # Get the actual downloaded filename
-                    downloaded_file = ydl.prepare_filename(info)
-                    # Handle potential format conversion
-                    if not os.path.exists(downloaded_file):
-                        downloaded_file = os.path.splitext(downloaded_file)[0] + '.mp4'
+def _ffmpeg_input_args(ydl, fmt: dict, proxy: Optional[str]) -> list:
+    headers = dict(fmt.get('http_headers') or {})
+    cookie = ydl.cookiejar.get_cookie_header(fmt['url'])
+    if cookie:
+        headers['Cookie'] = cookie
+    args = ['-headers', ''.join(f"{name}: {value}\r\n" for name, value in headers.items())]
+    if proxy:
+        args += ['-http_proxy', proxy]
+    return args + ['-i', fmt['url']]
 
-                    filename = os.path.basename(downloaded_file)
 
-                # Generate download URL
-                download_url = f"/files/{filename}"
+def _sync_pipe_command(url: str, format_selector: str, limits: Optional[dict] = None) -> tuple:
+    """(title, ffmpeg argv) muxing the selected format(s) to fragmented MP4 on stdout"""
+    info_key = _video_identity(url) or url
+    with proxy_pool.using(http_only=True) as endpoint:
+        if endpoint is None and proxy_pool:
+            raise HTTPException(status_code=422, detail="Pipe mode only works through an HTTP proxy")
+        opts = _ydl_opts(format_selector, endpoint)
+        info, _ = _extract_info_cached(url, opts, info_key, _egress(endpoint))
+    proxy = opts.get('proxy')
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        chosen = _choose_format(ydl, info, format_selector, limits)
+        if chosen is None:
+            raise HTTPException(status_code=400, detail="No format available at the requested resolution and limits")
+        parts = chosen.get('requested_formats') or [chosen]
+        unsupported = [f"{f['format_id']} ({f.get('protocol')})" for f in parts if f.get('protocol') not in PIPE_PROTOCOLS]
+        if unsupported:
+            raise HTTPException(status_code=422,
+                                detail=f"Format {', '.join(unsupported)} can't be piped; use POST /download instead")
 
-                # Schedule file deletion so disk doesn't grow unbounded.
-                asyncio.create_task(_delete_file_later(filename))
+        cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin']
+        for fmt in parts:
+            cmd += _ffmpeg_input_args(ydl, fmt, proxy)
+        for index in range(len(parts)):
+            cmd += ['-map', str(index)]
+        cmd += ['-c', 'copy', '-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4', 'pipe:1']
+        return info.get('title') or 'video', cmd
 
-                return {
-                    "message": f"Video '{title}' downloaded successfully in {actual_height}p!",
-                    "title": title,
-                    "resolution": f"{actual_height}p",
-                    "download_url": download_url,
-                    "filename": filename
-                }
 
-            except yt_dlp.utils.DownloadError as e:
-                error_str = str(e).lower()
-                if '403' in error_str or 'forbidden' in error_str:
-                    last_error = e
-                    print(f"[Download] 403 error on attempt {attempt + 1}/{max_proxy_retries}, rotating proxy...")
-                    if attempt < max_proxy_retries - 1:
-                        time.sleep(2 ** attempt)  # Exponential backoff: 1s, 2s, 4s, 8s
-                    continue  # Retry with new yt-dlp instance
-                else:
-                    raise  # Non-403 errors fail immediately
+class PipeResponse(StreamingResponse):
+    """StreamingResponse that runs `release` once it is over, however it ends.
+
+    A generator's finally only runs if iteration started; a client that hangs
+    up while the response headers are going out cancels the response before
+    that, and would leak the slot and the ffmpeg process.
+    """
+
+    def __init__(self, content, release, **kwargs):
+        super().__init__(content, **kwargs)
+        self.release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.release()
 
-        # All retries exhausted
-        raise last_error or Exception("Download failed after all proxy rotation attempts")
 
+@app.get("/download/pipe")
+async def pipe_video(url: str, resolution: str = "1080p", max_filesize_mb: Optional[float] = None,
+                     max_fps: Optional[float] = None, max_bitrate_kbps: Optional[float] = None):
+    """Stream a video to the client without storing it"""
+    if shutil.which('ffmpeg') is None:
+        raise HTTPException(status_code=503, detail="Pipe mode needs ffmpeg on the server")
+
+    loop = asyncio.get_event_loop()
+    try:
+        async with info_semaphore:
+            title, cmd = await loop.run_in_executor(None, _sync_pipe_command, url, _format_selector(resolution),
+                                                    _format_limits(resolution, max_filesize_mb, max_fps, max_bitrate_kbps))
     except yt_dlp.utils.DownloadError as e:
-        raise HTTPException(status_code=400, detail=f"Error: Video is not available or cannot be downloaded - {str(e)}")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail="Error downloading video: " + str(e))
+        raise HTTPException(status_code=400, detail=f"Error: Video is not available or cannot be downloaded - {e}")
 
-@app.get("/files/{filename}")
-async def get_file(filename: str):
-    """Serve downloaded video files"""
-    file_path = os.path.join(os.getcwd(), 'downloads', filename)
+    # The download slot and ffmpeg outlive this function: they belong to the
+    # response, which releases them however it ends (see PipeResponse).
+    resources = contextlib.AsyncExitStack()
+    proc = stderr = None
 
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="File not found")
+    async def release():
+        # Nothing may suspend before the slot is released and ffmpeg killed: on
+        # disconnect we run inside a cancelled scope and every suspension raises again.
+        if stderr is not None:
+            stderr.cancel()
+        if proc is not None and proc.returncode is None:
+            print(f"[Pipe] Client disconnected, stopping ffmpeg for {url}")
+            proc.kill()
+        await resources.aclose()  # Completes without suspending
+        if proc is not None:
+            # Drain rather than wait: a paused, unread stdout never sees EOF
+            await proc.communicate()
+
+    try:
+        # Someone is waiting on the socket: pipes go ahead of queued downloads
+        await resources.enter_async_context(admission.slot(JobPriority.HIGH))
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        stderr = asyncio.create_task(proc.stderr.read())
+        # Hold the response until ffmpeg produces output, so an upstream failure
+        # (403, expired URL) is a proper error status rather than an empty 200.
+        first = await proc.stdout.read(PIPE_CHUNK_SIZE)
+        if not first:
+            await proc.wait()
+            error = (await stderr).decode(errors='replace').strip()
+            raise HTTPException(status_code=502,
+                                detail=f"Error streaming video: {error[-500:] or f'ffmpeg exited with {proc.returncode}'}")
+    except BaseException:
+        await release()
+        raise
+
+    print(f"[Pipe] Streaming {url} ({resolution})")
+
+    async def body():
+        yield first
+        while chunk := await proc.stdout.read(PIPE_CHUNK_SIZE):
+            admission.record_bytes(len(chunk))
+            yield chunk
+        await proc.wait()
+
+    return PipeResponse(
+        body(),
+        release,
+        media_type="video/mp4",
+        headers={
+            "Content-Disposition": f"attachment; filename*=utf-8''{quote(title + '.mp4')}",
+            "Cache-Control": "no-store",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+# Keep original sync endpoint for backwards compatibility. It runs through the
+# same queued job pipeline as POST /download (cache, coalescing, semaphore,
+# stream-copy merge) and simply waits for the job instead of returning a job_id,
+# so it never blocks the event loop and no longer transcodes to libx264.
+@app.get("/download")
+async def download_video(url: str, resolution: str = "1080p", max_filesize_mb: Optional[float] = None,
+                         max_fps: Optional[float] = None, max_bitrate_kbps: Optional[float] = None):
+    job_id = str(uuid.uuid4())
+
+    job = Job(
+        job_id=job_id,
+        status=JobStatus.QUEUED,
+        url=url,
+        resolution=resolution,
+        max_filesize_mb=max_filesize_mb,
+        max_fps=max_fps,
+        max_bitrate_kbps=max_bitrate_kbps,
+        webhook_url=None,
+        created_at=datetime.now()
+    )
+    await asyncio.get_event_loop().run_in_executor(None, job_store.add, job)
+    await _enqueue_job(job)
+
+    # If the client hangs up the job simply keeps running on its worker (and
+    # its file lands in the cache); we only stop waiting for it.
+    job = await _wait_for_job(job_id)
+
+    if job is None or job.status != JobStatus.COMPLETED:
+        if job is not None and job.error_class == 'DownloadError':
+            raise HTTPException(status_code=400, detail=f"Error: Video is not available or cannot be downloaded - {job.error}")
+        raise HTTPException(status_code=400, detail="Error downloading video: " + (job.error if job else "job expired"))
+
+    result = job.result
+    return {
+        "message": f"Video '{result['title']}' downloaded successfully in {result['resolution']}!",
+        "title": result["title"],
+        "resolution": result["resolution"],
+        "download_url": result["download_url"],
+        "filename": result["filename"],
+        "filesize": result.get("filesize"),
+    }
+
+# --- File serving -------------------------------------------------------------
+# Starlette's FileResponse already answers Range requests (single range, or
+# multipart/byteranges for several), replies 416 to unsatisfiable ones and honours
+# If-Range; full-file bodies go out via the ASGI pathsend extension when the server
+# offers it. On top of that we add:
+#   - a strong ETag from the file's identity (device, inode, size, mtime_ns), so
+#     If-Range resumes are exact, and If-None-Match / If-Modified-Since -> 304
+#     (downloads are never modified in place, only replaced under a new name)
+#   - zero-copy range bodies through the ASGI zerocopy extension (the server
+#     sendfile()s straight from the page cache) when the server advertises it,
+#     otherwise 1 MiB chunked reads instead of 64 KiB ones. uvicorn, which we
+#     deploy on, advertises neither zerocopy nor pathsend and keeps the socket
+#     to itself, so there every body is read through Python in 1 MiB chunks.
+FILE_CHUNK_SIZE = 1024 * 1024
+_SINGLE_RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)')
+
+
+def _file_etag(stat_result: os.stat_result) -> str:
+    st = stat_result
+    return f'"{st.st_dev:x}-{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match uses weak comparison: W/"x" matches "x" """
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in (tag.removeprefix('W/') for tag in tags)
+
+
+def _not_modified(request: Request, stat_result: os.stat_result, etag: str) -> bool:
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)  # Takes precedence over dates
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(stat_result.st_mtime) <= since
+    return False
+
+
+class DownloadFileResponse(FileResponse):
+    """FileResponse that sends single-range bodies zero-copy where the server supports it (not uvicorn)"""
+    chunk_size = FILE_CHUNK_SIZE
+
+    async def __call__(self, scope, receive, send):
+        headers = Headers(scope=scope)
+        match = _SINGLE_RANGE_RE.fullmatch(headers.get('range', '').replace(' ', ''))
+        if_range = headers.get('if-range')
+        if (match is None or scope.get('method') == 'HEAD'
+                or 'http.response.zerocopy' not in scope.get('extensions', {})
+                or (if_range is not None and if_range not in (self.headers['etag'], self.headers['last-modified']))):
+            # Full bodies, multipart ranges, 416s: Starlette's own handling
+            return await super().__call__(scope, receive, send)
+
+        size = self.stat_result.st_size
+        first, last = match.groups()
+        if first:
+            start, end = int(first), min(int(last) + 1, size) if last else size
+        elif last:
+            start, end = max(size - int(last), 0), size  # Suffix range: last N bytes
+        else:
+            start, end = size, size
+        if start >= end:
+            return await super().__call__(scope, receive, send)  # 416
+
+        self.headers['content-range'] = f"bytes {start}-{end - 1}/{size}"
+        self.headers['content-length'] = str(end - start)
+        with open(self.path, 'rb') as f:
+            await send({"type": "http.response.start", "status": 206, "headers": self.raw_headers})
+            await send({"type": "http.response.zerocopy", "file": f, "offset": start,
+                        "count": end - start, "more_body": False})
+
+
+@app.api_route("/files/{filename}", methods=["GET", "HEAD"])
+async def get_file(filename: str, request: Request):
+    """Serve downloaded video files"""
+    file_path = os.path.join(DOWNLOADS_DIR, filename)
 
     # Security: Ensure the file is within the downloads directory
-    if not os.path.abspath(file_path).startswith(os.path.abspath(os.path.join(os.getcwd(), 'downloads'))):
+    if not os.path.abspath(file_path).startswith(os.path.abspath(DOWNLOADS_DIR) + os.sep):
         raise HTTPException(status_code=403, detail="Access denied")
 
-    return FileResponse(
+    # Dotfiles (the cache index) are internal bookkeeping, not downloads.
+    try:
+        stat_result = None if filename.startswith('.') else os.stat(file_path)
+    except FileNotFoundError:
+        stat_result = None
+    if stat_result is None or not S_ISREG(stat_result.st_mode):
+        raise HTTPException(status_code=404, detail="File not found")
+
+    await asyncio.get_event_loop().run_in_executor(None, download_cache.touch, filename)
+
+    etag = _file_etag(stat_result)
+    headers = {"etag": etag, "cache-control": "private, no-cache"}
+    if _not_modified(request, stat_result, etag):
+        headers["last-modified"] = formatdate(stat_result.st_mtime, usegmt=True)
+        return Response(status_code=304, headers=headers)
+
+    return DownloadFileResponse(
         path=file_path,
-        media_type='video/mp4',
-        filename=filename
-    )
\ No newline at end of file
+        media_type=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+        filename=filename,
+        headers=headers,
+        stat_result=stat_result,
+    )
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] == ['worker']:
+        # Spawned pool processes first re-run the __main__ module, which would be
+        # this whole service; point them at pool_child instead.
+        sys.modules['__main__'] = pool_child
+        asyncio.run(run_worker())
+    else:
+        print("usage: python download-youtube.py worker   (the API runs under uvicorn)")
+        sys.exit(2)
@@ -0,0 +1,327 @@
+"""What runs inside a download pool process (see DownloadProcessPool in download-youtube.py)
+
+Pool processes are spawned, so they import the module their entry point lives
+in. Keeping it here, away from the service module, means a pool process loads
+yt-dlp and this file only: no app, job store connections, proxy pool or
+metrics of its own.
+"""
+from collections import deque
+from typing import Optional
+import contextlib
+import json
+import os
+import threading
+import time
+
+import yt_dlp
+from yt_dlp.downloader.common import FileDownloader
+from yt_dlp.downloader.http import HttpFD
+
+# --- Segmented downloads ------------------------------------------------------
+# YouTube throttles each connection to well below our link speed, so one yt-dlp
+# connection per stream leaves big (4K) downloads running into JOB_MAX_SECONDS.
+# SegmentedHttpFD splits a plain HTTP(S) stream (progressive or one half of a
+# DASH pair) into DOWNLOAD_SEGMENT_BYTES byte ranges, fetched over several
+# connections at once through yt-dlp's own (pooled, proxied) networking and
+# written in place into a preallocated .part file. A failed range is retried on
+# its own from the byte it reached; only an error that retrying can't fix (403,
+# expired URL) fails the stream, for the proxy rotation in _sync_download.
+#
+# The connection count starts at SEGMENT_START_CONNECTIONS and adapts every
+# SEGMENT_ADJUST_SECONDS like the admission controller: add one while aggregate
+# throughput keeps growing with it (per-connection throughput holds up), drop it
+# again once it doesn't. Finished ranges are recorded next to the .part
+# (<name>.part.segments), so a retried or re-run job resumes them like any
+# other partial download. Progress reports the combined byte count, plus the
+# contiguous prefix that /jobs/{id}/stream may read.
+DOWNLOAD_CONNECTIONS = int(os.getenv('DOWNLOAD_CONNECTIONS', '8'))  # Per stream; 1 = plain yt-dlp
+DOWNLOAD_SEGMENT_BYTES = int(os.getenv('DOWNLOAD_SEGMENT_BYTES', str(8 * 1024 ** 2)))
+SEGMENTED_MIN_BYTES = 2 * DOWNLOAD_SEGMENT_BYTES  # Smaller streams gain nothing from splitting
+SEGMENT_START_CONNECTIONS = 2
+SEGMENT_ADJUST_SECONDS = 2.0
+SEGMENT_MIN_GAIN = 0.1  # An added connection must raise aggregate throughput by 10% to stay
+SEGMENT_COOLDOWN_TICKS = 3
+SEGMENT_RETRIES = 3
+SEGMENT_READ_BYTES = 256 * 1024
+SEGMENT_PROGRESS_SECONDS = 0.25
+
+
+class SegmentedHttpFD(FileDownloader):
+    """Multi-connection range downloader for plain HTTP(S) formats"""
+
+    FD_NAME = 'segmented'
+
+    @staticmethod
+    def suitable(info: dict) -> bool:
+        return DOWNLOAD_CONNECTIONS > 1 and info.get('protocol') in ('http', 'https') and not info.get('is_live')
+
+    def real_download(self, filename, info_dict):
+        url, headers = info_dict['url'], info_dict.get('http_headers') or {}
+        if (info_dict.get('filesize') or SEGMENTED_MIN_BYTES) < SEGMENTED_MIN_BYTES:
+            return self._download_single(filename, info_dict)  # Known to be small: skip the probe
+        total = self._probe_size(url, headers)
+        if total is None or total < SEGMENTED_MIN_BYTES:
+            return self._download_single(filename, info_dict)
+
+        tmpfilename = self.temp_name(filename)
+        state_path = tmpfilename + '.segments'
+        segments = [(start, min(start + DOWNLOAD_SEGMENT_BYTES, total) - 1)
+                    for start in range(0, total, DOWNLOAD_SEGMENT_BYTES)]
+        done = self._resumable_segments(tmpfilename, state_path, total, segments)
+        written = [end - start + 1 if index in done else 0 for index, (start, end) in enumerate(segments)]
+        resumed = sum(written)
+        if resumed:
+            self.report_resuming_byte(resumed)
+
+        fd = os.open(tmpfilename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != total:
+                try:
+                    os.posix_fallocate(fd, 0, total)
+                except (AttributeError, OSError):
+                    os.ftruncate(fd, total)  # Sparse, but still written in place
+            self._save_state(state_path, total, done)
+            self._fetch_all(fd, url, headers, segments, done, written, state_path, total,
+                            lambda status: self._hook_progress(
+                                dict(status, filename=filename, tmpfilename=tmpfilename), info_dict))
+        finally:
+            os.close(fd)
+
+        self.try_rename(tmpfilename, filename)
+        with contextlib.suppress(OSError):
+            os.remove(state_path)
+        self._hook_progress({'status': 'finished', 'filename': filename, 'downloaded_bytes': total,
+                             'total_bytes': total}, info_dict)
+        return True
+
+    def _download_single(self, filename, info_dict):
+        fd = HttpFD(self.ydl, self.params)
+        for hook in self._progress_hooks:
+            fd.add_progress_hook(hook)
+        return fd.real_download(filename, info_dict)
+
+    def _probe_size(self, url: str, headers: dict) -> Optional[int]:
+        """Total size if the server answers range requests, else None"""
+        response = self.ydl.urlopen(yt_dlp.networking.Request(url, headers={**headers, 'Range': 'bytes=0-0'}))
+        try:
+            content_range = response.headers.get('Content-Range') or ''
+            if response.status != 206 or '/' not in content_range:
+                return None
+            return int(content_range.rpartition('/')[2])
+        except ValueError:
+            return None  # "bytes 0-0/*": size unknown
+        finally:
+            response.close()
+
+    def _resumable_segments(self, tmpfilename: str, state_path: str, total: int, segments: list) -> set:
+        if not self.params.get('continuedl', True):
+            return set()
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+            if state['total'] == total and state['segment_bytes'] == DOWNLOAD_SEGMENT_BYTES:
+                return set(state['done'])
+        except (OSError, ValueError, KeyError):
+            pass
+        # A .part left by a single-connection attempt holds a prefix of the stream
+        try:
+            size = os.path.getsize(tmpfilename)
+        except OSError:
+            return set()
+        return {index for index, (_, end) in enumerate(segments) if end < size} if size < total else set()
+
+    @staticmethod
+    def _save_state(state_path: str, total: int, done: set):
+        with open(state_path + '.tmp', 'w') as f:
+            json.dump({'total': total, 'segment_bytes': DOWNLOAD_SEGMENT_BYTES, 'done': sorted(done)}, f)
+        os.replace(state_path + '.tmp', state_path)
+
+    def _fetch_segment(self, fd: int, url: str, headers: dict, segment: tuple, written: list, index: int,
+                       stop: threading.Event):
+        start, end = segment
+        for retry in range(SEGMENT_RETRIES + 1):
+            offset = start + written[index]
+            try:
+                response = self.ydl.urlopen(
+                    yt_dlp.networking.Request(url, headers={**headers, 'Range': f'bytes={offset}-{end}'}))
+                try:
+                    if response.status != 206:
+                        raise yt_dlp.utils.DownloadError(f"Range request answered with HTTP {response.status}")
+                    while not stop.is_set():
+                        chunk = response.read(SEGMENT_READ_BYTES)
+                        if not chunk:
+                            break
+                        os.pwrite(fd, chunk, start + written[index])
+                        written[index] += len(chunk)
+                finally:
+                    response.close()
+                if stop.is_set() or start + written[index] > end:
+                    return
+                error = yt_dlp.utils.ContentTooShortError(written[index], end - start + 1)
+            except yt_dlp.networking.exceptions.HTTPError as e:
+                if e.status in (403, 404, 410):
+                    raise  # Blocked or expired URL: every range would fail the same way
+                error = e
+            except yt_dlp.utils.network_exceptions as e:
+                error = e
+            if retry == SEGMENT_RETRIES:
+                raise error
+            self.report_retry(error, retry + 1, SEGMENT_RETRIES)
+            time.sleep(min(0.5 * 2 ** retry, 4.0))
+
+    def _fetch_all(self, fd: int, url: str, headers: dict, segments: list, done: set, written: list,
+                   state_path: str, total: int, report):
+        pending = deque(index for index in range(len(segments)) if index not in done)
+        lock = threading.Lock()
+        stop = threading.Event()
+        errors = []
+        workers = {'active': 0, 'target': min(SEGMENT_START_CONNECTIONS, DOWNLOAD_CONNECTIONS)}
+
+        def worker():
+            try:
+                while True:
+                    with lock:
+                        # Exit decided and counted under one lock: when the target
+                        # drops by one, exactly one connection goes.
+                        if stop.is_set() or workers['active'] > workers['target'] or not pending:
+                            workers['active'] -= 1
+                            return
+                        index = pending.popleft()
+                    self._fetch_segment(fd, url, headers, segments[index], written, index, stop)
+                    with lock:
+                        done.add(index)
+                        self._save_state(state_path, total, done)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+                    workers['active'] -= 1
+                stop.set()
+
+        def spawn():
+            with lock:
+                workers['active'] += 1
+            threading.Thread(target=worker, name='segment-fetch', daemon=True).start()
+
+        for _ in range(workers['target']):
+            spawn()
+        started = window_start = time.time()
+        resumed = window_bytes = sum(written)
+        baseline = None  # Aggregate rate before the connection being probed was added
+        cooldown = 0
+        while True:
+            with lock:
+                if workers['active'] == 0:
+                    break
+            time.sleep(SEGMENT_PROGRESS_SECONDS)
+            now = time.time()
+            downloaded = sum(written)
+            contiguous = 0
+            for index, (start, end) in enumerate(segments):
+                contiguous += written[index]
+                if start + written[index] <= end:
+                    break
+            report({'status': 'downloading', 'downloaded_bytes': downloaded, 'total_bytes': total,
+                    'contiguous_bytes': contiguous, 'elapsed': now - started,
+                    'speed': self.calc_speed(started, now, downloaded - resumed),
+                    'eta': self.calc_eta(started, now, total - resumed, downloaded - resumed)})
+
+            if now - window_start < SEGMENT_ADJUST_SECONDS:
+                continue
+            rate = (downloaded - window_bytes) / (now - window_start)
+            window_start, window_bytes = now, downloaded
+            with lock:
+                if baseline is not None:
+                    if rate < baseline * (1 + SEGMENT_MIN_GAIN):
+                        workers['target'] -= 1  # Saturated: the extra connection only split the bandwidth
+                        cooldown = SEGMENT_COOLDOWN_TICKS
+                    baseline = None
+                    continue
+                if cooldown:
+                    cooldown -= 1
+                    continue
+                probe = workers['target'] < DOWNLOAD_CONNECTIONS and len(pending) > workers['active']
+            if probe:
+                baseline = rate
+                workers['target'] += 1
+                spawn()
+
+        if errors:
+            raise errors[0]
+        if pending or len(done) < len(segments):
+            raise yt_dlp.utils.DownloadError("Segmented download stopped before every range was fetched")
+
+
+class SegmentedYoutubeDL(yt_dlp.YoutubeDL):
+    """YoutubeDL that hands plain HTTP(S) streams to SegmentedHttpFD"""
+
+    def dl(self, name, info, subtitle=False, test=False):
+        if test or subtitle or name == '-' or not SegmentedHttpFD.suitable(info):
+            return super().dl(name, info, subtitle, test)
+        fd = SegmentedHttpFD(self, self.params)
+        for hook in self._progress_hooks:
+            fd.add_progress_hook(hook)
+        new_info = self._copy_infodict(info)
+        if new_info.get('http_headers') is None:
+            new_info['http_headers'] = self._calc_headers(new_info)
+        return fd.download(name, new_info, subtitle)
+
+
+# --- Pool process -------------------------------------------------------------
+# One task at a time from the parent: "extract" returns an info dict, "download"
+# runs process_ie_result on one and streams progress_hook / postprocessor_hook
+# events back over the pipe.
+POOL_PROGRESS_INTERVAL = 0.1  # Throttle for progress events sent over the pipe
+_POOL_PROGRESS_KEYS = ('status', 'filename', 'tmpfilename', 'downloaded_bytes', 'total_bytes',
+                       'total_bytes_estimate', 'speed', 'eta', 'contiguous_bytes')
+
+
+def child_main(conn):
+    """Entry point of a pool process: run tasks from the parent until it hangs up"""
+    if hasattr(os, 'setsid'):
+        os.setsid()  # Own process group: killing it also kills ffmpeg merges it started
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        try:
+            if task['kind'] == 'extract':
+                with yt_dlp.YoutubeDL(task['opts']) as ydl:
+                    result = ydl.sanitize_info(ydl.extract_info(task['url'], download=False))
+            else:
+                result = _child_download(conn, task['opts'], task['info'])
+        except Exception as e:
+            conn.send(('error', type(e).__name__, str(e)))
+        else:
+            conn.send(('result', result))
+
+
+def _child_download(conn, opts: dict, info: dict) -> dict:
+    last_sent = 0.0
+
+    def progress_hook(d):
+        nonlocal last_sent
+        now = time.monotonic()
+        if d['status'] == 'downloading' and now - last_sent < POOL_PROGRESS_INTERVAL:
+            return
+        last_sent = now
+        event = {key: d.get(key) for key in _POOL_PROGRESS_KEYS}
+        event['format_id'] = d['info_dict'].get('format_id')
+        conn.send(('progress', event))
+
+    def postprocessor_hook(d):
+        conn.send(('postprocessor', {'status': d['status'], 'postprocessor': d['postprocessor'],
+                                     'filepath': d['info_dict'].get('filepath')}))
+
+    opts = dict(opts, progress_hooks=[progress_hook], postprocessor_hooks=[postprocessor_hook])
+    with SegmentedYoutubeDL(opts) as ydl:
+        info = ydl.process_ie_result(info, download=True)
+        # Where the file ended up after merging/remuxing, else where it was meant to go
+        expected = ydl.prepare_filename(info)
+        candidates = [info.get('filepath'), *(d.get('filepath') for d in info.get('requested_downloads') or []),
+                      expected, os.path.splitext(expected)[0] + '.mp4']
+        downloaded_file = next((path for path in candidates if path and os.path.isfile(path)), None)
+        if downloaded_file is None:
+            raise yt_dlp.utils.DownloadError(f"Download finished but its output is missing (expected {expected})")
+        return {"title": info.get('title', 'video'), "height": info.get('height', 'unknown'),
+                "filename": os.path.basename(downloaded_file), "filesize": os.path.getsize(downloaded_file)}